@@ -0,0 +1,43 @@
+"""
+API endpoints for administrators.
+Exposes operational metrics of the running worker.
+"""
+from fastapi import APIRouter, Depends, HTTPException, status
+from pydantic import BaseModel
+
+from app.core.auth import get_current_active_user
+from app.core.user_cache import AuthenticatedUser, CacheStats, user_cache
+from app.db.pool import PoolStats
+from app.db.session import pool_stats
+
+router = APIRouter()
+
+
+class Metrics(BaseModel):
+    """Response model for the metrics of one worker process"""
+    pools: dict[str, PoolStats]
+    user_cache: CacheStats
+
+
+@router.get("/metrics", response_model=Metrics)
+async def get_metrics(current_user: AuthenticatedUser = Depends(get_current_active_user)):
+    """
+    Report the connection pool and cache metrics of this worker process.
+
+    Args:
+        current_user: Authenticated user, must be admin
+
+    Returns:
+        Pool sizes, checked out connections and checkout wait times by engine,
+        and the hits and misses of the authenticated user cache
+
+    Raises:
+        HTTPException: If user lacks permission
+    """
+    if not current_user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You do not have permission to view metrics."
+        )
+
+    return Metrics(pools=pool_stats(), user_cache=user_cache.stats())
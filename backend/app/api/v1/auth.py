@@ -3,7 +3,7 @@ Authentication API endpoints for user login and registration.
 Handles passphrase verification and JWT token generation.
 """
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.core.base_deps import get_db_session
 from app.services.auth_service import authenticate_user, create_user
 from pydantic import BaseModel
@@ -17,7 +17,7 @@ class PassphraseRequest(BaseModel):
     passphrase: str
 
 @router.post("/login")
-async def login(request: PassphraseRequest, db: Session = Depends(get_db_session)):
+async def login(request: PassphraseRequest, db: AsyncSession = Depends(get_db_session)):
     """
     Authenticates a user with their passphrase and returns a JWT token.
     
@@ -31,7 +31,7 @@ async def login(request: PassphraseRequest, db: Session = Depends(get_db_session
     Raises:
         HTTPException: If passphrase is invalid
     """
-    user = authenticate_user(db, request.passphrase)
+    user = await authenticate_user(db, request.passphrase)
 
     if not user:
         raise HTTPException(
@@ -51,7 +51,7 @@ async def login(request: PassphraseRequest, db: Session = Depends(get_db_session
 
 
 @router.get("/register")
-async def register_user(db: Session = Depends(get_db_session)):
+async def register_user(db: AsyncSession = Depends(get_db_session)):
     """
     Creates a new user and returns their passphrase and a JWT token.
     
@@ -65,7 +65,7 @@ async def register_user(db: Session = Depends(get_db_session)):
         The passphrase is only returned once and must be securely stored by the user
     """
     # Create the user
-    user, passphrase = create_user(db)
+    user, passphrase = await create_user(db)
 
     # Create JWT token
     access_token = create_access_token(data={"sub": str(user.id)})
@@ -2,35 +2,39 @@
 API endpoints for journalists to download encrypted files.
 Provides secure access to whistleblower submissions.
 """
-import uuid
-from datetime import datetime
-import zipfile
+from datetime import datetime, timedelta
 import os
-from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Header
 from fastapi.responses import FileResponse, StreamingResponse
 from uuid import UUID
-from sqlalchemy.orm import Session
-from app.services.file_upload_service import encrypt_pdf, save_aesgcm_key, encrypt_aes_key, save_encrypted_file
-from app.services.file_upload_service import allowed_type
-from app.services.file_remove_service import delete_file_from_db, delete_file_from_storage
-from app.core.dependencies import get_user_db
+from sqlalchemy import func, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.services.file_storage_service import resolve_path
+from app.services.bundle_service import BundleManifest, bundle_query, bundle_entries, manifest_entry
+from app.services.bundle_service import fill_missing_checksums
 from app.core.dependencies import get_db_session
-from app.models.models import User, SymmetricalKey
 import app.models.models as db_models
 from app.core.auth import get_current_active_user
-from app.core.exceptions import FileTypeNotAllowed
-from app.db.session import get_db
-import io
+from app.core.user_cache import AuthenticatedUser
+from app.core.zip_stream import ZipEntry, stream_zip, archive_size, archive_etag
+from app.core.cursor import encode_cursor, decode_cursor, encode_bundle_id, decode_bundle_id
+from app.core.config import settings
 from typing import Optional
 
 
 router = APIRouter()
 
+
+class FileListing(BundleManifest):
+    """Response model for a batch of new files listed for individual download"""
+    next_cursor: Optional[str] = None
+    more_available: bool
+
 @router.get("/{id}")
 async def download_file(
     id: UUID,
-    db: Session = Depends(get_db_session),
-    current_user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db_session),
+    current_user: AuthenticatedUser = Depends(get_current_active_user),
 ):
     """
     Download a specific encrypted file by ID.
@@ -53,51 +57,223 @@ async def download_file(
             detail="You do not have permission to download files."
         )
 
-    # Check if the file exists
-    file: db_models.File = db.query(db_models.File).filter(db_models.File.id == id).first()
-    if not file:
+    # Fetch the file together with its key in one query
+    result = await db.execute(
+        select(db_models.File, db_models.SymmetricalKey)
+        .join(db_models.SymmetricalKey, db_models.File.symetrical_key_id == db_models.SymmetricalKey.id)
+        .where(db_models.File.id == id)
+    )
+    row = result.first()
+    if not row:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="File not found"
         )
+    file, aes_key = row
 
-    aes_key: SymmetricalKey = db.query(db_models.SymmetricalKey).filter(db_models.SymmetricalKey.id == file.symetrical_key_id).first()
-    # Return the file
-    if not aes_key:
+    file_path = resolve_path(file.path)
+    try:
+        stat_result = os.stat(file_path)
+    except OSError:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="File not found"
         )
 
+    # Stored files never change, so id and size identify the content.
+    # FileResponse answers Range and If-Range requests with 206 Partial Content.
     return FileResponse(
-        path=file.path,
+        path=file_path,
         filename=file.file_name,
         media_type=file.content_type,
+        stat_result=stat_result,
         headers={
-            "X-Encrypted-Key": aes_key.key,  # Key in header
+            "ETag": f'"{file.id.hex}-{stat_result.st_size}"',
+            "X-Encrypted-Key": aes_key.key.decode(),  # Base64 encoded key in header
             "X-Public-Key-ID": str(aes_key.public_key_id)  # Public Key ID in header
         }
     )
 
+
+async def _next_batch(db: AsyncSession, since_date: Optional[str], cursor: Optional[str], limit: Optional[int]) -> tuple[list, bool]:
+    """
+    Select the next batch of new files together with their keys.
+
+    Args:
+        db: Database session
+        since_date: ISO format date string, used when no cursor is given
+        cursor: Opaque cursor of the previous batch
+        limit: Maximum number of files, None for the default batch size
+
+    Returns:
+        Tuple of the (File, SymmetricalKey) rows in (created_at, id) order
+        and whether more files are waiting after them
+
+    Raises:
+        HTTPException: If the date or cursor is invalid
+    """
+    # Query files after the requested position together with their keys
+    query = bundle_query()
+
+    if cursor is not None:
+        try:
+            after_created_at, after_id = decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor"
+            )
+        query = query.where(
+            tuple_(db_models.File.created_at, db_models.File.id) > tuple_(after_created_at, after_id)
+        )
+    elif since_date is not None:
+        try:
+            # Parse date string to datetime
+            since_datetime = datetime.fromisoformat(since_date)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid date format. Use ISO format (YYYY-MM-DD)"
+            )
+        query = query.where(db_models.File.created_at > since_datetime)
+
+    if settings.DOWNLOAD_SETTLE_SECONDS:
+        # created_at is set when an upload is flushed, a moment before it commits
+        query = query.where(
+            db_models.File.created_at < func.now() - timedelta(seconds=settings.DOWNLOAD_SETTLE_SECONDS)
+        )
+
+    batch_size = limit or settings.DOWNLOAD_BATCH_SIZE
+    result = await db.execute(
+        query.order_by(db_models.File.created_at, db_models.File.id)
+        .limit(batch_size + 1)
+    )
+    rows = result.all()
+    return rows[:batch_size], len(rows) > batch_size
+
+
+async def _mark_seen(db: AsyncSession, file_ids: list[UUID]):
+    """Mark every delivered file as seen with a single update."""
+    if file_ids:
+        await db.execute(
+            update(db_models.File)
+            .where(db_models.File.id.in_(file_ids))
+            .values(seen=True)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+
+
+def _requested_range(range_header: Optional[str], if_range: Optional[str], etag: str, size: int) -> Optional[tuple[int, int]]:
+    """
+    Get the byte range a client asked for.
+
+    Args:
+        range_header: Value of the Range header
+        if_range: Value of the If-Range header
+        etag: Current ETag of the representation
+        size: Size of the representation in bytes
+
+    Returns:
+        Tuple of (start, end) with end exclusive, None to send everything
+
+    Raises:
+        HTTPException: If the range starts behind the end of the representation
+    """
+    # A changed representation is sent in full, as are unparsable or multiple ranges
+    if range_header is None or (if_range is not None and if_range != etag):
+        return None
+    units, _, spec = range_header.partition("=")
+    if units.strip() != "bytes" or "," in spec:
+        return None
+
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) + 1 if last else size
+        else:
+            start = max(size - int(last), 0)
+            end = size
+    except ValueError:
+        return None
+
+    if start >= size or start >= end:
+        raise HTTPException(
+            status_code=status.HTTP_416_RANGE_NOT_SATISFIABLE,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, min(end, size)
+
+
+def _bundle_response(entries: list[ZipEntry], bundle_id: str, filename: str, byte_range: Optional[tuple[int, int]] = None,
+                     headers: Optional[dict] = None) -> StreamingResponse:
+    """
+    Stream a bundle, or one byte range of it, as a zip archive.
+
+    Args:
+        entries: Members of the archive
+        bundle_id: Stable ID the bundle can be requested again with
+        filename: Suggested file name
+        byte_range: (start, end) range to send, None for the whole archive
+        headers: Additional response headers
+
+    Returns:
+        Response streaming the archive
+    """
+    size = archive_size(entries)
+    response_headers = {
+        "Content-Disposition": f"attachment; filename={filename}",
+        "Accept-Ranges": "bytes",
+        "ETag": archive_etag(entries),
+        "X-Bundle-Id": bundle_id,
+        **(headers or {}),
+    }
+
+    # Stream the zip file, the first bytes leave before later files are read
+    if byte_range is None:
+        response_headers["Content-Length"] = str(size)
+        return StreamingResponse(stream_zip(entries), media_type="application/zip", headers=response_headers)
+
+    start, end = byte_range
+    response_headers["Content-Length"] = str(end - start)
+    response_headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    return StreamingResponse(
+        stream_zip(entries, start=start, end=end),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type="application/zip",
+        headers=response_headers
+    )
+
+
 @router.get("/new-files/")
 async def download_new_files(
-    since_date: str = Query(..., description="ISO formatted date (YYYY-MM-DD)"),
-    db: Session = Depends(get_db_session),
-    current_user: User = Depends(get_current_active_user),
+    since_date: Optional[str] = Query(None, description="ISO formatted date (YYYY-MM-DD), used when no cursor is given"),
+    cursor: Optional[str] = Query(None, description="Cursor returned by the previous batch"),
+    limit: Optional[int] = Query(None, ge=1, le=settings.DOWNLOAD_MAX_BATCH_SIZE, description="Maximum number of files"),
+    db: AsyncSession = Depends(get_db_session),
+    current_user: AuthenticatedUser = Depends(get_current_active_user),
 ):
     """
-    Download all new files since a specified date as a zip archive.
+    Download the next batch of new files as a zip archive.
+
+    Files are returned in (created_at, id) order. The X-Next-Cursor header
+    points behind the last file of the batch and X-More-Available tells
+    whether another batch is waiting, so every file is sent exactly once.
     
     Args:
-        since_date: ISO format date string (YYYY-MM-DD)
+        since_date: ISO format date string (YYYY-MM-DD), for clients without a cursor
+        cursor: Opaque cursor of the previous batch
+        limit: Maximum number of files in the batch
         db: Database session
         current_user: Authenticated user (must be admin)
         
     Returns:
-        Zip file containing all new encrypted files and their key information
+        Zip file containing the new encrypted files and their key information
         
     Raises:
-        HTTPException: If user lacks permission, date format is invalid, or no files found
+        HTTPException: If user lacks permission, date or cursor is invalid, or no files found
     """
     # Check if current user is admin
     if not current_user.is_admin:
@@ -105,65 +281,144 @@ async def download_new_files(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You do not have permission to download files."
         )
+
+    new_files, more_available = await _next_batch(db, since_date, cursor, limit)
     
-    try:
-        # Parse date string to datetime
-        since_datetime = datetime.fromisoformat(since_date)
-    except ValueError:
+    if not new_files:
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid date format. Use ISO format (YYYY-MM-DD)"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No new files found"
         )
     
-    # Query files created after the specified date
-    new_files = db.query(db_models.File).filter(
-        db_models.File.created_at > since_datetime
-    ).all()
+    await fill_missing_checksums(db, new_files)
+    entries, seen_ids = bundle_entries(new_files)
+
+    # The cursor moves past the whole batch, including files missing from storage
+    first_file = new_files[0][0]
+    last_file = new_files[-1][0]
+    next_cursor = encode_cursor(last_file.created_at, last_file.id)
+    bundle_id = encode_bundle_id((first_file.created_at, first_file.id), (last_file.created_at, last_file.id))
+    filename = f"new_files_{last_file.created_at:%Y%m%d%H%M%S}.zip"
+
+    await _mark_seen(db, seen_ids)
     
+    return _bundle_response(entries, bundle_id, filename, headers={
+        "X-Next-Cursor": next_cursor,
+        "X-More-Available": "true" if more_available else "false",
+    })
+
+
+@router.get("/new-files/manifest", response_model=FileListing)
+async def list_new_files(
+    since_date: Optional[str] = Query(None, description="ISO formatted date (YYYY-MM-DD), used when no cursor is given"),
+    cursor: Optional[str] = Query(None, description="Cursor returned by the previous batch"),
+    limit: Optional[int] = Query(None, ge=1, le=settings.DOWNLOAD_MAX_BATCH_SIZE, description="Maximum number of files"),
+    db: AsyncSession = Depends(get_db_session),
+    current_user: AuthenticatedUser = Depends(get_current_active_user),
+):
+    """
+    List the next batch of new files without sending them.
+
+    Lets a client fetch the files one by one with GET /download/{id}, for
+    example over several connections at once. Listed files count as
+    delivered and are marked as seen.
+
+    Args:
+        since_date: ISO format date string (YYYY-MM-DD), for clients without a cursor
+        cursor: Opaque cursor of the previous batch
+        limit: Maximum number of files in the batch
+        db: Database session
+        current_user: Authenticated user (must be admin)
+
+    Returns:
+        Manifest entries of the batch, the cursor after it and whether more files are waiting
+
+    Raises:
+        HTTPException: If user lacks permission or date or cursor is invalid
+    """
+    # Check if current user is admin
+    if not current_user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You do not have permission to download files."
+        )
+
+    new_files, more_available = await _next_batch(db, since_date, cursor, limit)
     if not new_files:
+        return FileListing(files=[], next_cursor=cursor, more_available=False)
+
+    await fill_missing_checksums(db, new_files)
+    files = [entry for entry in (manifest_entry(file, aes_key) for file, aes_key in new_files) if entry is not None]
+    last_file = new_files[-1][0]
+    listing = FileListing(
+        files=files,
+        next_cursor=encode_cursor(last_file.created_at, last_file.id),
+        more_available=more_available
+    )
+
+    await _mark_seen(db, [entry.id for entry in files])
+    return listing
+
+
+@router.get("/bundles/{bundle_id}")
+async def download_bundle(
+    bundle_id: str,
+    range_header: Optional[str] = Header(None, alias="Range"),
+    if_range: Optional[str] = Header(None, alias="If-Range"),
+    db: AsyncSession = Depends(get_db_session),
+    current_user: AuthenticatedUser = Depends(get_current_active_user),
+):
+    """
+    Download a bundle again, completely or from a byte offset.
+
+    A bundle holds the same files as the new-files response that named it,
+    in the same order, so a client can continue an interrupted download with
+    a Range request. If-Range makes sure the ranges come from the archive the
+    client already holds part of.
+
+    Args:
+        bundle_id: X-Bundle-Id of a new-files response
+        range_header: Range header, a single byte range
+        if_range: If-Range header, the ETag of the partial download
+        db: Database session
+        current_user: Authenticated user (must be admin)
+
+    Returns:
+        Zip file, or 206 Partial Content with the requested range of it
+
+    Raises:
+        HTTPException: If user lacks permission, bundle ID or range is invalid, or the bundle is empty
+    """
+    # Check if current user is admin
+    if not current_user.is_admin:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="No new files found since the specified date"
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You do not have permission to download files."
         )
-    
-    # Create a zip file in memory
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for file in new_files:
-            # Get the AES key for the file
-            aes_key: SymmetricalKey = db.query(db_models.SymmetricalKey).filter(
-                db_models.SymmetricalKey.id == file.symetrical_key_id
-            ).first()
-            
-            if not aes_key:
-                continue  # Skip files without keys
-
-            # Add the file to the zip archive
-            try:
-                with open(file.path, 'rb') as f:
-                    file_data = f.read()
-                    zip_file.writestr(f"{file.id}_{file.file_name}", file_data)
-                
-                # Add key information in a text file
-                key_info = f"Encrypted Key: {aes_key.key}\nNonce: {aes_key.nonce}\nPublic Key ID: {aes_key.public_key_id}"
-                zip_file.writestr(f"{file.id}_key_info.txt", key_info)
-                file.seen = True
-                db.commit()
-            except Exception as e:
-                # Log the error but continue with other files
-                print(f"Error adding file {file.id} to zip: {str(e)}")
-    
-    # Reset buffer position
-    zip_buffer.seek(0)
-    
-    # Create a filename with the date range
-    filename = f"new_files_since_{since_date}.zip"
-    
-    # Return the zip file
-    return StreamingResponse(
-        zip_buffer, 
-        media_type="application/zip",
-        headers={
-            "Content-Disposition": f"attachment; filename={filename}"
-        }
+
+    try:
+        first, last = decode_bundle_id(bundle_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid bundle ID"
+        )
+
+    position = tuple_(db_models.File.created_at, db_models.File.id)
+    result = await db.execute(
+        bundle_query()
+        .where(position >= tuple_(*first), position <= tuple_(*last))
+        .order_by(db_models.File.created_at, db_models.File.id)
     )
+    rows = result.all()
+    await fill_missing_checksums(db, rows)
+    entries, _ = bundle_entries(rows)
+    if not entries:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Bundle not found"
+        )
+
+    byte_range = _requested_range(range_header, if_range, archive_etag(entries), archive_size(entries))
+    filename = f"new_files_{last[0]:%Y%m%d%H%M%S}.zip"
+    return _bundle_response(entries, bundle_id, filename, byte_range)
@@ -2,30 +2,126 @@
 API endpoint for uploading RSA public keys.
 Allows administrators to add public keys that will be used for encryption.
 """
-import uuid
-
 from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, status
 from uuid import UUID
-from sqlalchemy.orm import Session
-from app.services.file_upload_service import encrypt_pdf, save_aesgcm_key, encrypt_aes_key, save_encrypted_file
-from app.services.file_upload_service import allowed_type
-from app.services.file_remove_service import delete_file_from_db, delete_file_from_storage
+from typing import Optional
+from pydantic import BaseModel
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.core.dependencies import get_user_db
-from app.core.dependencies import get_db_session
-from app.models.models import User
 import app.models.models as db_models
 from app.core.auth import get_current_active_user
-from app.core.exceptions import FileTypeNotAllowed
-from app.db.session import get_db
+from app.core.user_cache import AuthenticatedUser
+from app.core.key_cache import public_key_cache, parse_rsa_public_key
+from app.core.config import settings
 
 router = APIRouter()
 
+class PublicKeyItem(BaseModel):
+    """A PEM public key together with the ID the journalist assigned to it"""
+    id: UUID
+    pem: str
+
+class PublicKeyBatchRequest(BaseModel):
+    """Request model for uploading many public keys at once"""
+    keys: list[PublicKeyItem]
+
+class PublicKeyResult(BaseModel):
+    """Outcome for one key of a batch upload"""
+    id: UUID
+    status: str  # "created", "exists" or "invalid"
+    detail: Optional[str] = None
+
+class PublicKeyBatchResponse(BaseModel):
+    """Response model with one result per uploaded key, in request order"""
+    results: list[PublicKeyResult]
+
+# Declared before /{id}, which would otherwise try to parse "batch" as a key ID
+@router.post("/batch", response_model=PublicKeyBatchResponse)
+async def upload_public_key_batch(
+    request: PublicKeyBatchRequest,
+    current_user: AuthenticatedUser = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_user_db) # type: ignore
+):
+    """
+    Upload many public RSA keys in one request and one transaction.
+
+    Every key is validated on its own. Keys that already exist are reported
+    as such, so a batch whose response got lost can simply be sent again.
+
+    Args:
+        request: The keys with their IDs
+        current_user: Authenticated user (must be admin)
+        db: Database session
+
+    Returns:
+        Per key results in request order
+
+    Raises:
+        HTTPException: If user lacks permission, the batch is too large or the keys could not be stored
+    """
+    if not current_user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You do not have permission to upload public keys."
+        )
+
+    if len(request.keys) > settings.PUBLIC_KEY_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {settings.PUBLIC_KEY_BATCH_MAX_SIZE} keys can be uploaded per request."
+        )
+
+    # One lookup for all keys that are already stored
+    ids = [item.id for item in request.keys]
+    existing = set(await db.scalars(select(db_models.PublicKey.id).where(db_models.PublicKey.id.in_(ids))))
+
+    results = []
+    rows = []
+    parsed = {}
+    for item in request.keys:
+        if item.id in existing:
+            results.append(PublicKeyResult(id=item.id, status="exists"))
+            continue
+
+        pem = item.pem.encode()
+        # Parse the key once now, which also rejects anything that is not a usable RSA key
+        try:
+            parsed[item.id] = parse_rsa_public_key(pem)
+        except ValueError:
+            results.append(PublicKeyResult(id=item.id, status="invalid",
+                                           detail=f"Not a valid PEM RSA public key of at least {settings.PUBLIC_KEY_MIN_SIZE} bits."))
+            continue
+
+        existing.add(item.id)
+        rows.append({"id": item.id, "active": True, "key": pem})
+        results.append(PublicKeyResult(id=item.id, status="created"))
+
+    # Insert all valid keys with a single statement and commit once
+    if rows:
+        try:
+            await db.execute(insert(db_models.PublicKey), rows)
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Some keys were stored concurrently, please send the batch again."
+            )
+
+    # Only keys that are really stored are cached
+    for row in rows:
+        public_key_cache.put(row["id"], parsed[row["id"]])
+
+    return PublicKeyBatchResponse(results=results)
+
 @router.post("/{id}")
-def upload_public_keys(
+async def upload_public_keys(
     id: UUID,
     file: UploadFile = File(...),
-    current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_user_db) # type: ignore
+    current_user: AuthenticatedUser = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_user_db) # type: ignore
 ):
     """
     Upload a public RSA key for file encryption.
@@ -56,12 +152,31 @@ def upload_public_keys(
             detail="Only PEM files are allowed. Supported formats: PEM file, X.509 certificate"
         )
 
-    print(id)
+    pem = await file.read()
+
+    # Parse the key once now, which also rejects anything that is not a usable RSA key
+    try:
+        public_key = parse_rsa_public_key(pem)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"The file does not contain a valid PEM RSA public key of at least {settings.PUBLIC_KEY_MIN_SIZE} bits."
+        )
+
     # Insert the key into the public_keys table
-    key = db_models.PublicKey(id=id, active=True, key=file.file.read())
+    key = db_models.PublicKey(id=id, active=True, key=pem)
     db.add(key)
-    db.commit()
-    db.refresh(key)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A public key with this ID already exists."
+        )
+
+    # Only cached once stored, so the cache never holds a key the database does not
+    public_key_cache.put(id, public_key)
 
     return {
         "message": "success",
@@ -2,26 +2,44 @@
 API endpoints for file upload operations.
 Handles secure file uploads, file listings, and file deletion.
 """
-from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, status
+import os
+from datetime import datetime
+from typing import Optional
+from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, Query, Response, status
 from uuid import UUID
-from sqlalchemy.orm import Session
-from app.services.file_upload_service import encrypt_pdf, save_aesgcm_key, encrypt_aes_key, save_encrypted_file
-from app.services.file_upload_service import allowed_type
+from pydantic import BaseModel
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from app.services.file_upload_service import sanitize_and_encrypt, claim_public_key, wrap_aes_key
+from app.services.file_upload_service import create_staging_file, stage_upload_source, save_upload
+from app.services.file_upload_service import allowed_type, upload_size
 from app.services.file_remove_service import delete_file_from_db, delete_file_from_storage
+from app.services.file_storage_service import resolve_path
 from app.core.dependencies import get_user_db
-from app.core.dependencies import get_db_session
-from app.models.models import User
 import app.models.models as db_models
 from app.core.auth import get_current_active_user
-from app.core.exceptions import FileTypeNotAllowed
-from app.db.session import get_db
+from app.core.user_cache import AuthenticatedUser
+from app.core.config import settings
+from app.core.cursor import encode_cursor, decode_cursor
+from app.core.exceptions import FileTypeNotAllowed, FileTooLarge
+from app.core.workers import run_in_pool, uses_processes
 router = APIRouter()
 
+
+class UploadedFile(BaseModel):
+    """Response model for one entry of the upload listing"""
+    id: UUID
+    file_name: str
+    created_at: datetime
+    seen: bool
+
+
 @router.post("/")
 async def upload_file(
     file: UploadFile = File(...),
-    current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_user_db) # type: ignore
+    current_user: AuthenticatedUser = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_user_db) # type: ignore
 ):
     """
     Upload and encrypt a file securely.
@@ -37,52 +55,118 @@ async def upload_file(
     Raises:
         HTTPException: If file type is not allowed or encryption fails
         FileTypeNotAllowed: If file type is not supported
+        FileTooLarge: If the file exceeds MAX_UPLOAD_SIZE
     """
     # Check if the file type is allowed
     if not allowed_type(file):
         raise FileTypeNotAllowed()
 
-    # TODO: Error handling -> what if the pdf is saved but the key is not?
-    # Handle encryption + storage
-    result = encrypt_pdf(file)
+    # Sanitizing parses the whole PDF in memory, which bounds what can be accepted
+    if upload_size(file) > settings.MAX_UPLOAD_SIZE:
+        raise FileTooLarge(f"Files can be at most {settings.MAX_UPLOAD_SIZE // (1024 * 1024)} MB.")
 
+    # The ciphertext is streamed into a staging file. Sanitizing and encrypting
+    # run in the worker pool, the event loop only awaits them.
+    staged_path = create_staging_file()
+    source_path = None
     try:
-        encrypted_key, public_key_id = encrypt_aes_key(db, result.key)
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Due to high load, its not possible to upload files at the moment. Please try again later."
-        )
+        # Process pool workers cannot share the open upload, they get a copy on disk
+        if uses_processes():
+            source_path = await run_in_threadpool(stage_upload_source, file.file)
+        source = source_path or file.file
+        result = await run_in_pool(sanitize_and_encrypt, source, file.filename, staged_path)
+
+        # From here on everything is one transaction, committed by save_upload once
+        # the file is in place. The key claim is rolled back with it on failure.
+        public_key = await claim_public_key(db)
 
-    aes_key_id = save_aesgcm_key(db, encrypted_key, public_key_id, result.nonce)
+        # Wrapping with a public key takes microseconds. Queueing it behind uploads
+        # in the worker pool would hold the claimed key and the connection open.
+        encrypted_key = wrap_aes_key(public_key.id, public_key.key, result.key)
 
-    file_id: UUID = save_encrypted_file(db, result.file_name, result.ciphertext, current_user.id, aes_key_id)
+        await save_upload(
+            db, staged_path, result.file_name, current_user.id,
+            encrypted_key, public_key.id, result.nonce,
+            size=result.size, sha256=result.sha256, crc32=result.crc32
+        )
+    except Exception:
+        await db.rollback()
+        raise
+    finally:
+        # Only left behind if the upload failed before it was moved into place
+        if os.path.exists(staged_path):
+            os.remove(staged_path)
+        if source_path is not None and os.path.exists(source_path):
+            os.remove(source_path)
 
     return {"message": "success"}
 
-@router.get("/")
+@router.get("/", response_model=list[UploadedFile])
 async def get_files(
-    db: Session = Depends(get_user_db),
-    current_user: User = Depends(get_current_active_user)
+    response: Response,
+    cursor: Optional[str] = Query(None, description="Cursor returned with the previous page"),
+    limit: Optional[int] = Query(None, ge=1, le=settings.UPLOAD_LIST_MAX_PAGE_SIZE, description="Maximum number of files"),
+    db: AsyncSession = Depends(get_user_db),
+    current_user: AuthenticatedUser = Depends(get_current_active_user)
 ):
     """
-    Retrieve a list of files uploaded by the current user.
-    
+    Retrieve a page of the files uploaded by the current user, newest first.
+    The X-Next-Cursor header is set when older files follow the page.
+
     Args:
+        response: Response whose headers carry the next cursor
+        cursor: Opaque cursor of the previous page
+        limit: Maximum number of files, None for the default page size
         db: Database session
         current_user: Authenticated user
-        
+
     Returns:
         List of files belonging to the user
+
+    Raises:
+        HTTPException: If the cursor is invalid
     """
-    files = db.query(db_models.File).filter(db_models.File.user_id == current_user.id).all()
-    return files
+    # Only the listed columns are selected, rows come back as plain tuples
+    query = select(
+        db_models.File.id,
+        db_models.File.file_name,
+        db_models.File.created_at,
+        db_models.File.seen
+    ).where(db_models.File.user_id == current_user.id)
+
+    if cursor is not None:
+        try:
+            before_created_at, before_id = decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor"
+            )
+        query = query.where(
+            tuple_(db_models.File.created_at, db_models.File.id) < tuple_(before_created_at, before_id)
+        )
+
+    page_size = limit or settings.UPLOAD_LIST_PAGE_SIZE
+    result = await db.execute(
+        query.order_by(db_models.File.created_at.desc(), db_models.File.id.desc())
+        .limit(page_size + 1)
+    )
+    rows = result.all()
+
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        response.headers["X-Next-Cursor"] = encode_cursor(rows[-1].created_at, rows[-1].id)
+
+    return [
+        UploadedFile(id=row.id, file_name=row.file_name, created_at=row.created_at, seen=row.seen)
+        for row in rows
+    ]
 
 @router.delete("/{id}")
 async def delete_file(
     id: UUID,
-    db: Session = Depends(get_user_db),
-    current_user: User = Depends(get_current_active_user)
+    db: AsyncSession = Depends(get_user_db),
+    current_user: AuthenticatedUser = Depends(get_current_active_user)
 ):
     """
     Delete a file by ID.
@@ -99,7 +183,7 @@ async def delete_file(
         HTTPException: If file not found, user lacks permission, or deletion fails
     """
     # Check if the file exists
-    file: File = db.query(db_models.File).filter(db_models.File.id == id).first()
+    file: File = await db.get(db_models.File, id)
     if not file:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -113,13 +197,13 @@ async def delete_file(
         )
 
     # Delete the file from the database
-    if not delete_file_from_db(db, id):
+    if not await delete_file_from_db(db, id):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Error deleting file from database"
         )
 
-    if not delete_file_from_storage(str(file.path)):
+    if not delete_file_from_storage(resolve_path(file.path)):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Error deleting file from storage"
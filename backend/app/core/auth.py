@@ -4,15 +4,18 @@ Provides functions to create and verify access tokens for users.
 """
 from datetime import datetime, timedelta
 from typing import Optional
+from uuid import UUID
 
 from fastapi import Depends, HTTPException, status, Security
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.core.base_deps import get_db_session
 from app.models.models import User
 from app.core.config import settings
+from app.core.user_cache import AuthenticatedUser, user_cache
 import os
 
 
@@ -37,16 +40,17 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
-def get_current_user(token: str = Security(oauth2_scheme), db: Session = Depends(get_db_session)) -> User:
+async def get_current_user(token: str = Security(oauth2_scheme), db: AsyncSession = Depends(get_db_session)) -> AuthenticatedUser:
     """
     Get the current user from a JWT token.
+    Users seen recently are served from the user cache without a query.
     
     Args:
         token: JWT token string
-        db: Database session
+        db: Database session, only used on a cache miss
         
     Returns:
-        User object if authentication is successful
+        The authenticated user's ID and admin flag
         
     Raises:
         HTTPException: If token is invalid or user doesn't exist
@@ -62,27 +66,41 @@ def get_current_user(token: str = Security(oauth2_scheme), db: Session = Depends
 
     try:
         payload = jwt.decode(token, settings.AUTH_SECRET, algorithms=[settings.AUTH_ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
+        subject: str = payload.get("sub")
+        if subject is None:
             raise credentials_exception
-    except JWTError:
+        user_id = UUID(subject)
+    except (JWTError, ValueError):
         raise credentials_exception
 
-    user = db.query(User).filter(User.id == user_id).first()
-    if user is None:
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+
+    # Only the columns handlers need are loaded
+    try:
+        is_admin = (await db.execute(select(User.is_admin).where(User.id == user_id))).scalar_one_or_none()
+    finally:
+        # End the read right away. Otherwise the request's connection sits idle in
+        # transaction through the handler's worker pool jobs, holding a pool slot.
+        await db.rollback()
+    if is_admin is None:
         raise credentials_exception
+
+    user = AuthenticatedUser(id=user_id, is_admin=is_admin)
+    user_cache.put(user)
     return user
 
-def get_current_active_user(current_user: User = Depends(get_current_user)) -> User:
+async def get_current_active_user(current_user: AuthenticatedUser = Depends(get_current_user)) -> AuthenticatedUser:
     """
     Get the current active user.
     Currently just passes through the user without checking active status.
     
     Args:
-        current_user: User object from get_current_user
+        current_user: User from get_current_user
         
     Returns:
-        User object if active
+        The user if active
         
     Raises:
         HTTPException: If user is not active (commented out currently)
@@ -13,17 +13,60 @@ class Settings(BaseSettings):
     """
     # Database settings
     DATABASE_URL: str = os.getenv("DATABASE_URL_NORMAL")
+    # Connection pools, per worker process and engine
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0  # Seconds a request waits for a free connection
+    DB_POOL_PRE_PING: bool = True  # Test connections on checkout, replaces ones the server closed
+    DB_POOL_RECYCLE: int = 1800  # Seconds after which a connection is replaced
+    # Applies to the application engine only, migrations may run longer. 0 disables it
+    DB_STATEMENT_TIMEOUT_MS: int = 30000
 
     # Authentication settings
     AUTH_SECRET: str = os.getenv("AUTH_SECRET")
     AUTH_ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 10080  # 7 days
+    # Key for the indexed passphrase lookup digest. Rotating it requires
+    # clearing users.passphrase_lookup so accounts are re-keyed on next login.
+    PASSPHRASE_LOOKUP_SECRET: str = os.getenv("PASSPHRASE_LOOKUP_SECRET", os.getenv("AUTH_SECRET"))
+    AUTH_USER_CACHE_SIZE: int = 10000  # Authenticated users kept in memory per worker
+    # Seconds a cached user is trusted, which bounds how long a user deleted
+    # through another worker stays authenticated. 0 disables the cache
+    AUTH_USER_CACHE_TTL: float = 30.0
 
     # API settings
     API_PREFIX: str = "/api/v1"
 
     # Storage path
     FILE_PATH: str = "/app/storage/uploads/"  # Path to save the uploaded files
+    # Largest accepted upload in bytes, matches client_max_body_size in nginx. PyPDF2
+    # parses the whole document while sanitizing, so each running job needs a few
+    # times this much memory. Lower it together with CRYPTO_POOL_WORKERS on small hosts.
+    MAX_UPLOAD_SIZE: int = 100 * 1024 * 1024
+    ENCRYPTION_SEGMENT_SIZE: int = 64 * 1024  # Plaintext bytes per authenticated AES-GCM segment
+
+    # Worker pool for PDF sanitization and encryption
+    CRYPTO_POOL_KIND: str = "thread"  # "thread" or "process"; process jobs read a copy of the upload from a temporary file
+    CRYPTO_POOL_WORKERS: int = min(4, os.cpu_count() or 1)
+    CRYPTO_POOL_QUEUE_SIZE: int = 16  # Jobs allowed to wait for a worker before uploads are rejected
+    CRYPTO_JOB_TIMEOUT: float = 120.0  # Seconds
+
+    # Public keys claimed per database round trip and kept in memory per worker.
+    # Keys still held in memory when a worker stops are never used.
+    PUBLIC_KEY_PREFETCH: int = 1
+    PUBLIC_KEY_CACHE_SIZE: int = 1024  # Parsed public keys kept in memory per worker
+    PUBLIC_KEY_BATCH_MAX_SIZE: int = 1000  # Keys accepted per batch upload request
+    PUBLIC_KEY_MIN_SIZE: int = 2048  # Smallest RSA modulus accepted for uploaded keys, in bits
+
+    # Incremental downloads for journalists
+    DOWNLOAD_BATCH_SIZE: int = 100  # Files per batch when the client does not ask for a size
+    DOWNLOAD_MAX_BATCH_SIZE: int = 1000
+    # Files younger than this are held back, so uploads still committing cannot land behind a cursor
+    DOWNLOAD_SETTLE_SECONDS: int = 5
+
+    # Upload listing for whistleblowers
+    UPLOAD_LIST_PAGE_SIZE: int = 50  # Files per page when the client does not ask for a size
+    UPLOAD_LIST_MAX_PAGE_SIZE: int = 500
 
     # CORS settings
     CORS_ORIGINS: list = ["http://localhost:3000"]
@@ -0,0 +1,99 @@
+"""
+Opaque keyset pagination cursors.
+Encodes (created_at, id) positions so clients can resume exactly after a row.
+"""
+import base64
+import json
+from datetime import datetime
+from uuid import UUID
+
+Position = tuple[datetime, UUID]
+
+
+def _encode(payload: dict) -> str:
+    """Serialize a payload to URL safe base64 without padding."""
+    data = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def _decode(token: str) -> dict:
+    """Deserialize a payload created by _encode."""
+    padded = token + "=" * (-len(token) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded.encode()))
+
+
+def _position(value: list) -> Position:
+    """Parse a serialized [created_at, id] pair."""
+    created_at, row_id = value
+    return datetime.fromisoformat(created_at), UUID(row_id)
+
+
+def encode_cursor(created_at: datetime, row_id: UUID) -> str:
+    """
+    Encode the position of a row as an opaque, URL safe cursor.
+
+    Args:
+        created_at: Creation time of the row
+        row_id: ID of the row, breaks ties between equal timestamps
+
+    Returns:
+        Cursor string
+    """
+    return _encode({"t": created_at.isoformat(), "id": str(row_id)})
+
+
+def decode_cursor(cursor: str) -> Position:
+    """
+    Decode a cursor created by encode_cursor.
+
+    Args:
+        cursor: Cursor string
+
+    Returns:
+        Tuple of (created_at, id)
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        payload = _decode(cursor)
+        return datetime.fromisoformat(payload["t"]), UUID(payload["id"])
+    except (TypeError, KeyError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def encode_bundle_id(first: Position, last: Position) -> str:
+    """
+    Encode the range of rows in a download bundle as an opaque, URL safe ID.
+
+    Args:
+        first: (created_at, id) of the first row in the bundle
+        last: (created_at, id) of the last row in the bundle
+
+    Returns:
+        Bundle ID string
+    """
+    return _encode({
+        "from": [first[0].isoformat(), str(first[1])],
+        "to": [last[0].isoformat(), str(last[1])],
+    })
+
+
+def decode_bundle_id(bundle_id: str) -> tuple[Position, Position]:
+    """
+    Decode a bundle ID created by encode_bundle_id.
+
+    Args:
+        bundle_id: Bundle ID string
+
+    Returns:
+        Tuple of the first and last (created_at, id) positions, both inclusive
+
+    Raises:
+        ValueError: If the bundle ID is malformed
+    """
+    try:
+        payload = _decode(bundle_id)
+        return _position(payload["from"]), _position(payload["to"])
+    except (TypeError, KeyError, ValueError) as e:
+        raise ValueError("Invalid bundle ID") from e
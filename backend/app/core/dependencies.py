@@ -1,25 +1,28 @@
 """
 Dependency injection functions for the application.
-Provides database sessions with user context for row-level security.
+Provides the request's database session to handlers that require a user.
 """
 from fastapi import Depends
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.core.base_deps import get_db_session
-from app.models.models import User
 from app.core.auth import get_current_active_user
-from app.db.session import get_db
+from app.core.user_cache import AuthenticatedUser
 
-def get_user_db(current_user: User = Depends(get_current_active_user)):
+async def get_user_db(
+    current_user: AuthenticatedUser = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db_session)
+):
     """
-    Database session with user ID for row-level security.
-    
+    Database session for handlers that require an authenticated user.
+    FastAPI resolves get_db_session once per request, so this is the session
+    get_current_user used. Its lookup is rolled back at once, so the
+    connection only leaves the pool again when the handler queries.
+
     Args:
         current_user: Currently authenticated user
-        
-    Yields:
-        Database session with user context
+        db: Database session of the request
+
+    Returns:
+        Database session of the request
     """
-    db = next(get_db(user_type="normal", user_id=current_user.id))
-    try:
-        yield db
-    finally:
-        db.close()
+    return db
@@ -14,6 +14,11 @@ class FileTypeNotAllowed(HTTPException):
     def __init__(self, detail="File type not allowed"):
         super().__init__(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail=detail)
 
+class FileTooLarge(HTTPException):
+    """Exception raised when an uploaded file exceeds the size limit."""
+    def __init__(self, detail="File too large"):
+        super().__init__(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=detail)
+
 class AuthenticationError(HTTPException):
     """Exception raised when authentication fails."""
     def __init__(self, detail="Authentication failed"):
@@ -27,3 +32,13 @@ class PermissionError(HTTPException):
     """Exception raised when a user doesn't have permission to access a resource."""
     def __init__(self, detail="Not enough permissions"):
         super().__init__(status_code=status.HTTP_403_FORBIDDEN, detail=detail)
+
+class ServiceUnavailableError(HTTPException):
+    """Exception raised when the server is temporarily unable to handle a request."""
+    def __init__(self, detail="Service temporarily unavailable"):
+        super().__init__(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=detail)
+
+class NoPublicKeyAvailable(ServiceUnavailableError):
+    """Exception raised when no unused public key is left to encrypt an upload."""
+    def __init__(self, detail="Due to high load, its not possible to upload files at the moment. Please try again later."):
+        super().__init__(detail=detail)
@@ -0,0 +1,115 @@
+"""
+Cache of deserialized RSA public keys.
+Keeps PEM/ASN.1 parsing out of the upload path.
+"""
+import threading
+from collections import OrderedDict
+from uuid import UUID
+
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+
+from app.core.config import settings
+
+
+def parse_rsa_public_key(pem: bytes) -> RSAPublicKey:
+    """
+    Parse a PEM public key that uploads can wrap their AES keys with.
+
+    Args:
+        pem: PEM encoded public key
+
+    Returns:
+        The parsed RSA public key
+
+    Raises:
+        ValueError: If the PEM data is not an RSA public key of at least PUBLIC_KEY_MIN_SIZE bits
+    """
+    public_key = load_pem_public_key(pem)
+    # EC and Ed25519 keys parse as well, but cannot encrypt
+    if not isinstance(public_key, RSAPublicKey):
+        raise ValueError("Not an RSA public key.")
+    if public_key.key_size < settings.PUBLIC_KEY_MIN_SIZE:
+        raise ValueError(f"RSA keys need at least {settings.PUBLIC_KEY_MIN_SIZE} bits.")
+    return public_key
+
+
+class PublicKeyCache:
+    """
+    Bounded LRU cache of public key objects keyed by PublicKey.id.
+
+    Keys are added once they are stored and taken out again when an upload
+    consumes them. Every key is used only once, so entries never need to
+    outlive their first use.
+    """
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def warm(self, key_id: UUID, pem: bytes) -> RSAPublicKey:
+        """
+        Parse a PEM key and keep the result.
+
+        Args:
+            key_id: ID of the public key
+            pem: PEM encoded public key
+
+        Returns:
+            The parsed public key
+
+        Raises:
+            ValueError: If the PEM data is not a valid public key
+        """
+        public_key = load_pem_public_key(pem)
+        self.put(key_id, public_key)
+        return public_key
+
+    def put(self, key_id: UUID, public_key: RSAPublicKey):
+        """
+        Keep an already parsed key.
+
+        Args:
+            key_id: ID of the public key
+            public_key: The parsed public key
+        """
+        with self._lock:
+            self._keys[key_id] = public_key
+            self._keys.move_to_end(key_id)
+            while len(self._keys) > self._maxsize:
+                self._keys.popitem(last=False)
+
+    def take(self, key_id: UUID, pem: bytes) -> RSAPublicKey:
+        """
+        Get a parsed key and remove it from the cache, parsing it on a miss.
+
+        Args:
+            key_id: ID of the public key
+            pem: PEM encoded public key, used on a cache miss
+
+        Returns:
+            The parsed public key
+        """
+        with self._lock:
+            public_key = self._keys.pop(key_id, None)
+        if public_key is None:
+            public_key = load_pem_public_key(pem)
+        return public_key
+
+    def evict(self, key_id: UUID):
+        """
+        Remove a key from the cache.
+
+        Args:
+            key_id: ID of the public key
+        """
+        with self._lock:
+            self._keys.pop(key_id, None)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+# One cache per worker process, keys are warmed in the worker that received them
+public_key_cache = PublicKeyCache(settings.PUBLIC_KEY_CACHE_SIZE)
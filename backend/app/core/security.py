@@ -3,9 +3,11 @@ Security utilities for the application.
 Provides functions for passphrase generation and verification.
 """
 import hashlib
+import hmac
 import secrets
 import random
 from faker import Faker
+from app.core.config import settings
 
 faker = Faker()
 
@@ -63,6 +65,25 @@ def hash_passphrase(seed_phrase):
     hash_obj = hashlib.sha256((seed_phrase + salt).encode())
     return f"{salt}${hash_obj.hexdigest()}"
 
+def passphrase_lookup_key(seed_phrase):
+    """
+    Create a deterministic, secret-keyed digest of a passphrase.
+
+    The salted hash cannot be searched for, so this HMAC-SHA256 is stored
+    next to it in an indexed column to find the matching user in one query.
+
+    Args:
+        seed_phrase: Original passphrase
+
+    Returns:
+        Hex encoded HMAC-SHA256 digest
+    """
+    return hmac.new(
+        settings.PASSPHRASE_LOOKUP_SECRET.encode(),
+        seed_phrase.encode(),
+        hashlib.sha256
+    ).hexdigest()
+
 def verify_passphrase(input_phrase, stored_hash):
     """
     Verify a passphrase against a stored hash.
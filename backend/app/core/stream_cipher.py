@@ -0,0 +1,193 @@
+"""
+Chunked AES-GCM container for encrypted files.
+Lets uploads be encrypted and decrypted segment by segment with bounded memory.
+
+Layout:
+    header    MAGIC (8 bytes) | version (1 byte) | segment size (4 bytes, big endian)
+    segments  AES-GCM ciphertext of up to `segment size` plaintext bytes + 16 byte tag
+
+Each segment is authenticated with the header as associated data. Its nonce is
+the first 7 bytes of the file nonce, a 4 byte segment counter and a flag marking
+the final segment, so segments cannot be reordered, dropped or cut off.
+"""
+import hashlib
+import struct
+import zlib
+from typing import BinaryIO
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+MAGIC = b"WDSTREAM"
+VERSION = 1
+HEADER = struct.Struct(">8sBI")
+TAG_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+MAX_SEGMENTS = 2 ** 32
+
+
+def segment_nonce(nonce: bytes, index: int, last: bool) -> bytes:
+    """
+    Derive the nonce of a single segment.
+
+    Args:
+        nonce: 12 byte nonce stored with the file key
+        index: Position of the segment in the file
+        last: Whether this is the final segment
+
+    Returns:
+        12 byte AES-GCM nonce
+    """
+    if index >= MAX_SEGMENTS:
+        raise ValueError("File has too many segments for the stream format")
+    return nonce[:NONCE_PREFIX_SIZE] + struct.pack(">IB", index, 1 if last else 0)
+
+
+def is_stream_header(data: bytes) -> bool:
+    """
+    Check whether data starts with a stream container header.
+
+    Args:
+        data: First bytes of an encrypted file
+
+    Returns:
+        Boolean indicating if the file uses the chunked format
+    """
+    return len(data) >= HEADER.size and data[:len(MAGIC)] == MAGIC
+
+
+class StreamEncryptor:
+    """
+    Writable file-like object that encrypts everything written to it.
+    Supports write() and tell() on the plaintext, which is all PdfWriter needs.
+    Keeps a SHA-256 digest and a CRC-32 of the container as it is written.
+    """
+
+    def __init__(self, key: bytes, nonce: bytes, destination: BinaryIO, segment_size: int):
+        self._aesgcm = AESGCM(key)
+        self._nonce = nonce
+        self._destination = destination
+        self._segment_size = segment_size
+        self._header = HEADER.pack(MAGIC, VERSION, segment_size)
+        self._buffer = bytearray()
+        self._index = 0
+        self._position = 0
+        self.closed = False
+
+        destination.write(self._header)
+        self.bytes_written = len(self._header)
+        self._digest = hashlib.sha256(self._header)
+        self._crc = zlib.crc32(self._header)
+
+    def write(self, data: bytes) -> int:
+        """Buffer plaintext and encrypt every complete segment."""
+        if self.closed:
+            raise ValueError("write to closed StreamEncryptor")
+        self._buffer += data
+        self._position += len(data)
+
+        # Keep a full segment back until more data arrives, the final
+        # segment has to be flagged when the stream is closed
+        while len(self._buffer) > self._segment_size:
+            self._emit(bytes(self._buffer[:self._segment_size]), last=False)
+            del self._buffer[:self._segment_size]
+        return len(data)
+
+    @property
+    def sha256(self) -> str:
+        """Hex SHA-256 digest of the container written so far."""
+        return self._digest.hexdigest()
+
+    @property
+    def crc32(self) -> int:
+        """CRC-32 of the container written so far, as stored in ZIP archives."""
+        return self._crc
+
+    def tell(self) -> int:
+        """Return the number of plaintext bytes written so far."""
+        return self._position
+
+    def close(self):
+        """Encrypt the remaining plaintext as the final segment."""
+        if self.closed:
+            return
+        self._emit(bytes(self._buffer), last=True)
+        self._buffer.clear()
+        self.closed = True
+
+    def _emit(self, plaintext: bytes, last: bool):
+        segment = self._aesgcm.encrypt(segment_nonce(self._nonce, self._index, last), plaintext, self._header)
+        self._destination.write(segment)
+        self._digest.update(segment)
+        self._crc = zlib.crc32(segment, self._crc)
+        self.bytes_written += len(segment)
+        self._index += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+def encrypt_stream(key: bytes, nonce: bytes, source: BinaryIO, destination: BinaryIO, segment_size: int) -> int:
+    """
+    Encrypt a readable stream into the chunked format.
+
+    Args:
+        key: 256 bit AES key
+        nonce: 12 byte file nonce
+        source: Plaintext stream
+        destination: Stream receiving the container
+        segment_size: Plaintext bytes per segment
+
+    Returns:
+        Number of bytes written to destination
+    """
+    with StreamEncryptor(key, nonce, destination, segment_size) as encryptor:
+        while chunk := source.read(segment_size):
+            encryptor.write(chunk)
+    return encryptor.bytes_written
+
+
+def decrypt_stream(key: bytes, nonce: bytes, source: BinaryIO, destination: BinaryIO) -> int:
+    """
+    Decrypt a chunked container.
+
+    Args:
+        key: 256 bit AES key
+        nonce: 12 byte file nonce
+        source: Stream positioned at the container header
+        destination: Stream receiving the plaintext
+
+    Returns:
+        Number of plaintext bytes written
+
+    Raises:
+        ValueError: If the header is invalid or the stream is truncated
+        cryptography.exceptions.InvalidTag: If a segment fails authentication
+    """
+    header = source.read(HEADER.size)
+    if not is_stream_header(header):
+        raise ValueError("Not a chunked AES-GCM container")
+    _, version, segment_size = HEADER.unpack(header)
+    if version != VERSION:
+        raise ValueError(f"Unsupported container version {version}")
+
+    aesgcm = AESGCM(key)
+    segment_length = segment_size + TAG_SIZE
+    written = 0
+    index = 0
+    segment = source.read(segment_length)
+    while True:
+        if len(segment) < TAG_SIZE:
+            raise ValueError("Encrypted stream is truncated")
+        next_segment = source.read(segment_length)
+        last = not next_segment
+        plaintext = aesgcm.decrypt(segment_nonce(nonce, index, last), segment, header)
+        destination.write(plaintext)
+        written += len(plaintext)
+        if last:
+            return written
+        segment = next_segment
+        index += 1
@@ -0,0 +1,120 @@
+"""
+Cache of authenticated users.
+Lets repeated requests with the same token skip the user lookup.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from uuid import UUID
+
+from pydantic import BaseModel
+from sqlalchemy import event
+
+from app.core.config import settings
+from app.models.models import User
+
+
+class AuthenticatedUser(BaseModel):
+    """
+    The fields of a user that request handling needs.
+    """
+    id: UUID
+    is_admin: bool
+
+
+class CacheStats(BaseModel):
+    """
+    Snapshot of the user cache and its counters.
+    """
+    size: int
+    hits: int
+    misses: int
+
+
+class UserCache:
+    """
+    Bounded LRU cache of authenticated users keyed by token subject.
+
+    Entries are dropped when the user row is updated or deleted through the ORM
+    in this process. Other workers and changes made outside the ORM are only
+    noticed once an entry expires, so the time to live bounds how long a removed
+    user stays authenticated.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, user_id: UUID) -> Optional[AuthenticatedUser]:
+        """
+        Look up a user that was authenticated recently.
+
+        Args:
+            user_id: Subject of the access token
+
+        Returns:
+            The cached user, None if it is unknown or expired
+        """
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None or entry[1] < time.monotonic():
+                self._users.pop(user_id, None)
+                self._misses += 1
+                return None
+            self._users.move_to_end(user_id)
+            self._hits += 1
+            return entry[0]
+
+    def put(self, user: AuthenticatedUser):
+        """
+        Remember an authenticated user until the time to live has passed.
+
+        Args:
+            user: User loaded from the database
+        """
+        if self._ttl <= 0:
+            return
+        with self._lock:
+            self._users[user.id] = (user, time.monotonic() + self._ttl)
+            self._users.move_to_end(user.id)
+            while len(self._users) > self._maxsize:
+                self._users.popitem(last=False)
+
+    def evict(self, user_id: UUID):
+        """
+        Remove a user from the cache.
+
+        Args:
+            user_id: ID of the user
+        """
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def stats(self) -> CacheStats:
+        """
+        Get the size and hit/miss counters of the cache.
+
+        Returns:
+            Cache statistics
+        """
+        with self._lock:
+            return CacheStats(size=len(self._users), hits=self._hits, misses=self._misses)
+
+    def __len__(self):
+        return len(self._users)
+
+
+# One cache per worker process
+user_cache = UserCache(settings.AUTH_USER_CACHE_SIZE, settings.AUTH_USER_CACHE_TTL)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _evict_changed_user(mapper, connection, target):
+    """Drop users whose admin flag may have changed or who no longer exist."""
+    user_cache.evict(target.id)
@@ -0,0 +1,90 @@
+"""
+Worker pool for the CPU heavy stages of an upload.
+Keeps PDF sanitization, AES-GCM and RSA-OAEP work off the event loop.
+"""
+import asyncio
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from app.core.config import settings
+from app.core.exceptions import ServiceUnavailableError
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Jobs running plus jobs waiting for a worker, anything beyond is rejected
+_slots = threading.BoundedSemaphore(settings.CRYPTO_POOL_WORKERS + settings.CRYPTO_POOL_QUEUE_SIZE)
+
+
+def uses_processes() -> bool:
+    """
+    Check whether jobs run in separate processes.
+    Process jobs only receive picklable arguments, e.g. file paths instead of open files.
+
+    Returns:
+        Boolean indicating if the pool is a process pool
+    """
+    return settings.CRYPTO_POOL_KIND == "process"
+
+
+def get_executor() -> Executor:
+    """
+    Get the shared executor, creating it on first use.
+
+    Returns:
+        Thread or process pool executor depending on the settings
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            if uses_processes():
+                _executor = ProcessPoolExecutor(max_workers=settings.CRYPTO_POOL_WORKERS)
+            else:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.CRYPTO_POOL_WORKERS,
+                    thread_name_prefix="crypto"
+                )
+        return _executor
+
+
+def shutdown_executor():
+    """
+    Shut the executor down, waiting for running jobs to finish.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True, cancel_futures=True)
+            _executor = None
+
+
+async def run_in_pool(fn, *args):
+    """
+    Run a function in the worker pool and await its result.
+
+    Args:
+        fn: Module level function to run
+        *args: Arguments passed to the function
+
+    Returns:
+        Return value of the function
+
+    Raises:
+        ServiceUnavailableError: If the queue is full or the job timed out
+    """
+    if not _slots.acquire(blocking=False):
+        raise ServiceUnavailableError("The server is busy processing uploads. Please try again later.")
+
+    try:
+        future = get_executor().submit(fn, *args)
+    except BaseException:
+        _slots.release()
+        raise
+
+    # The slot is held until the job has really finished, even after a timeout
+    future.add_done_callback(lambda _: _slots.release())
+
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=settings.CRYPTO_JOB_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise ServiceUnavailableError("Processing the upload took too long. Please try again later.")
@@ -0,0 +1,275 @@
+"""
+Streaming ZIP writer for file bundles.
+Produces an archive chunk by chunk without holding its members in memory.
+
+Members are STORED, never deflated: they are AES-GCM ciphertext, which does
+not compress. Each member's CRC-32 is written into a data descriptor after its
+content, and comes either from the entry or from the same read that sends the
+content. Every file is read at most once, and a range that starts after a file
+with a known CRC-32 does not read it at all. The same entries
+always produce the same bytes, which lets an interrupted download continue
+from a byte offset.
+"""
+import hashlib
+import struct
+import zlib
+from datetime import datetime
+from typing import Iterable, Iterator, Optional
+
+from pydantic import BaseModel
+
+CHUNK_SIZE = 64 * 1024
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<IHHHHIIH")
+ZIP64_END_RECORD = struct.Struct("<IQHHIIQQQQ")
+ZIP64_END_LOCATOR = struct.Struct("<IIQI")
+DATA_DESCRIPTOR = struct.Struct("<IIII")
+ZIP64_DATA_DESCRIPTOR = struct.Struct("<IIQQ")
+
+LOCAL_SIGNATURE = 0x04034B50
+CENTRAL_SIGNATURE = 0x02014B50
+END_SIGNATURE = 0x06054B50
+ZIP64_END_SIGNATURE = 0x06064B50
+ZIP64_LOCATOR_SIGNATURE = 0x07064B50
+DESCRIPTOR_SIGNATURE = 0x08074B50
+ZIP64_EXTRA_ID = 0x0001
+
+UTF8_FLAG = 0x0800
+DESCRIPTOR_FLAG = 0x0008  # CRC-32 and sizes follow the content in a data descriptor
+FLAGS = UTF8_FLAG | DESCRIPTOR_FLAG
+STORED = 0
+VERSION = 20
+VERSION_ZIP64 = 45
+MAX_32 = 0xFFFFFFFF
+MAX_16 = 0xFFFF
+
+
+class ZipEntry(BaseModel):
+    """
+    A member of a streamed archive, backed by a file on disk or by bytes.
+    """
+    name: str
+    size: int
+    modified: datetime
+    path: Optional[str] = None
+    data: Optional[bytes] = None
+    crc32: Optional[int] = None  # Computed while streaming when not known up front
+
+
+def _dos_datetime(value: datetime) -> tuple[int, int]:
+    """Convert a datetime to the MS-DOS time and date fields."""
+    year = min(max(value.year, 1980), 2107)
+    time = (value.hour << 11) | (value.minute << 5) | (value.second // 2)
+    date = ((year - 1980) << 9) | (value.month << 5) | value.day
+    return time, date
+
+
+def _read_chunks(entry: ZipEntry, chunk_size: int, skip: int = 0, length: Optional[int] = None) -> Iterator[bytes]:
+    """Yield length bytes of an entry's content from skip on, checking the content is still there."""
+    if length is None:
+        length = entry.size - skip
+    if entry.data is not None:
+        yield entry.data[skip:skip + length]
+        return
+
+    remaining = length
+    with open(entry.path, "rb") as f:
+        f.seek(skip)
+        while remaining and (chunk := f.read(min(chunk_size, remaining))):
+            remaining -= len(chunk)
+            yield chunk
+    if remaining != 0:
+        raise IOError(f"{entry.path} changed size while it was being archived")
+
+
+def _content(entry: ZipEntry, chunk_size: int, skip: int, length: int, checksum: bool) -> Iterator[bytes]:
+    """
+    Yield length bytes of an entry's content from skip on.
+    With checksum set the whole content is read once and its CRC-32 is returned.
+    """
+    if not checksum:
+        if length:
+            yield from _read_chunks(entry, chunk_size, skip, length)
+        return None
+
+    crc = 0
+    position = 0
+    for chunk in _read_chunks(entry, chunk_size):
+        crc = zlib.crc32(chunk, crc)
+        first = max(skip - position, 0)
+        last = min(skip + length - position, len(chunk))
+        if last > first:
+            yield chunk if (first, last) == (0, len(chunk)) else chunk[first:last]
+        position += len(chunk)
+    return crc
+
+
+def _local_header(entry: ZipEntry, name: bytes) -> bytes:
+    """Build the local file header of an entry, its CRC-32 and sizes follow in the data descriptor."""
+    time, date = _dos_datetime(entry.modified)
+    if entry.size >= MAX_32:
+        extra = struct.pack("<HHQQ", ZIP64_EXTRA_ID, 16, 0, 0)
+        size, version = MAX_32, VERSION_ZIP64
+    else:
+        extra = b""
+        size, version = 0, VERSION
+
+    return LOCAL_HEADER.pack(
+        LOCAL_SIGNATURE, version, FLAGS, STORED, time, date,
+        0, size, size, len(name), len(extra)
+    ) + name + extra
+
+
+def _data_descriptor(entry: ZipEntry, crc: int) -> bytes:
+    """Build the data descriptor written after an entry's content."""
+    if entry.size >= MAX_32:
+        return ZIP64_DATA_DESCRIPTOR.pack(DESCRIPTOR_SIGNATURE, crc, entry.size, entry.size)
+    return DATA_DESCRIPTOR.pack(DESCRIPTOR_SIGNATURE, crc, entry.size, entry.size)
+
+
+def _central_header(entry: ZipEntry, name: bytes, crc: int, offset: int) -> bytes:
+    """Build the central directory record of an entry."""
+    time, date = _dos_datetime(entry.modified)
+    zip64_fields = []
+    size = entry.size
+    if size >= MAX_32:
+        zip64_fields += [entry.size, entry.size]
+        size = MAX_32
+    if offset >= MAX_32:
+        zip64_fields.append(offset)
+        offset = MAX_32
+
+    extra = b""
+    version = VERSION
+    if zip64_fields:
+        extra = struct.pack(f"<HH{len(zip64_fields)}Q", ZIP64_EXTRA_ID, 8 * len(zip64_fields), *zip64_fields)
+        version = VERSION_ZIP64
+
+    return CENTRAL_HEADER.pack(
+        CENTRAL_SIGNATURE, version, version, FLAGS, STORED, time, date,
+        crc, size, size, len(name), len(extra), 0, 0, 0, 0, offset
+    ) + name + extra
+
+
+def _end_records(count: int, directory_offset: int, directory_size: int) -> bytes:
+    """Build the end of central directory records, with ZIP64 records if needed."""
+    records = b""
+    if count >= MAX_16 or directory_offset >= MAX_32 or directory_size >= MAX_32:
+        zip64_offset = directory_offset + directory_size
+        records += ZIP64_END_RECORD.pack(
+            ZIP64_END_SIGNATURE, ZIP64_END_RECORD.size - 12, VERSION_ZIP64, VERSION_ZIP64,
+            0, 0, count, count, directory_size, directory_offset
+        )
+        records += ZIP64_END_LOCATOR.pack(ZIP64_LOCATOR_SIGNATURE, 0, zip64_offset, 1)
+
+    return records + END_RECORD.pack(
+        END_SIGNATURE, 0, 0,
+        min(count, MAX_16), min(count, MAX_16),
+        min(directory_size, MAX_32), min(directory_offset, MAX_32), 0
+    )
+
+
+def _window(position: int, length: int, start: int, end: Optional[int]) -> tuple[int, int]:
+    """Get the part of a piece at position that falls into [start, end) as (skip, length)."""
+    skip = max(start - position, 0)
+    stop = length if end is None else min(end - position, length)
+    return skip, max(stop - skip, 0)
+
+
+def archive_size(entries: Iterable[ZipEntry]) -> int:
+    """
+    Compute the size of the archive stream_zip writes, without reading any file.
+
+    Args:
+        entries: Members of the archive, in order
+
+    Returns:
+        Archive size in bytes
+    """
+    offset = 0
+    count = 0
+    directory_size = 0
+    for entry in entries:
+        name = entry.name.encode("utf-8")
+        # The checksum does not change the length of a record
+        directory_size += len(_central_header(entry, name, 0, offset))
+        offset += len(_local_header(entry, name)) + entry.size + len(_data_descriptor(entry, 0))
+        count += 1
+    return offset + directory_size + len(_end_records(count, offset, directory_size))
+
+
+def archive_etag(entries: Iterable[ZipEntry]) -> str:
+    """
+    Build a strong ETag for the archive of a list of entries.
+
+    Args:
+        entries: Members of the archive, in order
+
+    Returns:
+        Quoted entity tag, equal for archives with identical content
+    """
+    digest = hashlib.sha256()
+    for entry in entries:
+        digest.update(f"{entry.name}\0{entry.size}\0{entry.modified.isoformat()}\0".encode("utf-8"))
+        if entry.data is not None:
+            digest.update(hashlib.sha256(entry.data).digest())
+    return f'"{digest.hexdigest()}"'
+
+
+def stream_zip(
+    entries: Iterable[ZipEntry],
+    chunk_size: int = CHUNK_SIZE,
+    start: int = 0,
+    end: Optional[int] = None,
+) -> Iterator[bytes]:
+    """
+    Write a ZIP archive of STORED entries as a stream of chunks.
+
+    Args:
+        entries: Members of the archive, in order
+        chunk_size: Number of bytes read from disk at a time
+        start: Offset of the first byte to write
+        end: Offset after the last byte to write, None for the end of the archive
+
+    Yields:
+        Consecutive pieces of the archive
+    """
+    offset = 0
+    directory = []
+    for entry in entries:
+        if end is not None and offset >= end:
+            return
+
+        name = entry.name.encode("utf-8")
+        header = _local_header(entry, name)
+        skip, length = _window(offset, len(header), start, end)
+        if length:
+            yield header[skip:skip + length]
+
+        # An unknown checksum is only needed when the data descriptor or the
+        # central directory are sent, which always follow the content
+        data_end = offset + len(header) + entry.size
+        needed = end is None or end > data_end
+        checksum = needed and entry.crc32 is None
+        skip, length = _window(offset + len(header), entry.size, start, end)
+        crc = yield from _content(entry, chunk_size, skip, length, checksum)
+        if not needed:
+            return
+        if crc is None:
+            crc = entry.crc32
+
+        descriptor = _data_descriptor(entry, crc)
+        skip, length = _window(data_end, len(descriptor), start, end)
+        if length:
+            yield descriptor[skip:skip + length]
+
+        directory.append(_central_header(entry, name, crc, offset))
+        offset = data_end + len(descriptor)
+
+    directory_size = sum(len(record) for record in directory)
+    trailer = b"".join(directory) + _end_records(len(directory), offset, directory_size)
+    skip, length = _window(offset, len(trailer), start, end)
+    if length:
+        yield trailer[skip:skip + length]
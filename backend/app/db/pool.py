@@ -0,0 +1,102 @@
+"""
+Connection pool instrumentation.
+Records how long requests wait to check out a database connection.
+"""
+import threading
+import time
+
+from pydantic import BaseModel
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+
+class PoolStats(BaseModel):
+    """
+    Snapshot of a connection pool and its checkout metrics.
+    """
+    size: int
+    checked_out: int
+    overflow: int
+    checkouts: int
+    timeouts: int  # Checkouts that gave up after the pool timeout
+    wait_seconds_total: float
+    wait_seconds_max: float
+
+
+class PoolMetrics:
+    """
+    Thread safe counters for the checkouts of one pool.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def record(self, wait: float, timed_out: bool = False):
+        """
+        Record one checkout.
+
+        Args:
+            wait: Seconds spent waiting for the connection
+            timed_out: Whether the checkout failed because the pool was exhausted
+        """
+        with self._lock:
+            self._checkouts += 1
+            self._timeouts += timed_out
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+
+    def snapshot(self, pool: QueuePool) -> PoolStats:
+        """
+        Combine the counters with the current state of the pool.
+
+        Args:
+            pool: The pool the counters belong to
+
+        Returns:
+            Pool statistics
+        """
+        with self._lock:
+            return PoolStats(
+                size=pool.size(),
+                checked_out=pool.checkedout(),
+                overflow=pool.overflow(),
+                checkouts=self._checkouts,
+                timeouts=self._timeouts,
+                wait_seconds_total=self._wait_total,
+                wait_seconds_max=self._wait_max,
+            )
+
+
+# Counters by pool logging name, they outlive pools recreated by engine.dispose()
+pool_metrics: dict[str, PoolMetrics] = {}
+
+
+class _MeasuredCheckouts:
+    """
+    Pool mixin that records the time every checkout waits for a connection.
+    Pools are told apart by their logging name, see create_engine(pool_logging_name=...).
+    """
+
+    def connect(self):
+        metrics = pool_metrics.setdefault(self.logging_name, PoolMetrics())
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            metrics.record(time.perf_counter() - start, timed_out)
+
+
+class MeasuredQueuePool(_MeasuredCheckouts, QueuePool):
+    """QueuePool with checkout metrics, for synchronous engines."""
+
+
+class MeasuredAsyncQueuePool(_MeasuredCheckouts, AsyncAdaptedQueuePool):
+    """QueuePool with checkout metrics, for asyncio engines."""
@@ -4,12 +4,15 @@ Handles connection setup, user roles, and database initialization.
 """
 import uuid
 
-from ..models.models import Base
-
-from sqlalchemy import create_engine, text
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, make_url, text
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
-from app.core.security import hash_passphrase
+from app.core.config import settings
+from app.core.security import hash_passphrase, passphrase_lookup_key
+from app.db.pool import MeasuredAsyncQueuePool, MeasuredQueuePool, PoolMetrics, PoolStats, pool_metrics
 import os
 from sqlalchemy import text
 load_dotenv()
@@ -18,15 +21,115 @@ load_dotenv()
 DATABASE_URL_NORMAL = os.getenv("DATABASE_URL_NORMAL")
 DATABASE_URL_ADMIN = os.getenv("DATABASE_URL_ADMIN")
 
-# Separate engines for different access levels
-normal_engine = create_engine(DATABASE_URL_NORMAL)
-admin_engine = create_engine(DATABASE_URL_ADMIN)
 
-# Separate sessions
-NormalSessionLocal = sessionmaker(bind=normal_engine)
+def _pool_options(name: str) -> dict:
+    """Pool arguments shared by both engines, taken from the settings."""
+    return dict(
+        pool_logging_name=name,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+    )
+
+
+def create_pooled_engine(url: str, name: str):
+    """
+    Create a synchronous engine with a pool sized and instrumented from the settings.
+
+    Args:
+        url: Database URL
+        name: Name of the pool in the metrics
+
+    Returns:
+        SQLAlchemy engine
+    """
+    if make_url(url).get_backend_name() == "sqlite":
+        # SQLite connections are not pooled the same way, used by the tests
+        return create_engine(url)
+
+    return create_engine(url, poolclass=MeasuredQueuePool, **_pool_options(name))
+
+
+def create_async_pooled_engine(url: str, name: str, statement_timeout_ms: int = 0) -> AsyncEngine:
+    """
+    Create an asyncio engine with a pool sized and instrumented from the settings.
+    PostgreSQL is reached through asyncpg, whatever driver the URL names.
+
+    Args:
+        url: Database URL
+        name: Name of the pool in the metrics
+        statement_timeout_ms: Server side limit per statement, 0 for none
+
+    Returns:
+        SQLAlchemy asyncio engine
+    """
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite":
+        # SQLite connections are not pooled the same way, used by the tests
+        return create_async_engine(url.set(drivername="sqlite+aiosqlite"))
+
+    connect_args = {}
+    if statement_timeout_ms:
+        connect_args["server_settings"] = {"statement_timeout": str(statement_timeout_ms)}
+
+    return create_async_engine(
+        url.set(drivername="postgresql+asyncpg"),
+        poolclass=MeasuredAsyncQueuePool,
+        connect_args=connect_args,
+        **_pool_options(name)
+    )
+
+# Request handlers share the asyncio engine. The admin engine runs migrations
+# and maintenance commands, which are synchronous.
+normal_engine = create_async_pooled_engine(DATABASE_URL_NORMAL, "normal", settings.DB_STATEMENT_TIMEOUT_MS)
+admin_engine = create_pooled_engine(DATABASE_URL_ADMIN, "admin")
+
+# Separate sessions. Loaded objects stay usable after a commit, since
+# refreshing them implicitly would need IO outside of an await.
+NormalSessionLocal = async_sessionmaker(bind=normal_engine, expire_on_commit=False)
 AdminSessionLocal = sessionmaker(bind=admin_engine)
 
 
+def pool_stats() -> dict[str, PoolStats]:
+    """
+    Get the current state and checkout metrics of the connection pools.
+
+    Returns:
+        Pool statistics by engine name, empty for unpooled engines
+    """
+    stats = {}
+    for name, pool in (("normal", normal_engine.pool), ("admin", admin_engine.pool)):
+        if isinstance(pool, (MeasuredQueuePool, MeasuredAsyncQueuePool)):
+            metrics = pool_metrics.setdefault(name, PoolMetrics())
+            stats[name] = metrics.snapshot(pool)
+    return stats
+
+
+# Migrations live next to the app package, see migrations/versions
+ALEMBIC_INI = os.path.join(os.path.dirname(__file__), "..", "..", "alembic.ini")
+
+
+def _create_role_if_missing(name: str, login: bool = False) -> str:
+    """
+    Build a statement creating a role unless it exists, PostgreSQL has no CREATE ROLE IF NOT EXISTS.
+
+    Args:
+        name: Name of the role
+        login: Whether the role is a user that can log in
+
+    Returns:
+        SQL statement
+    """
+    return (
+        f"DO $$ BEGIN "
+        f"IF NOT EXISTS (SELECT FROM pg_roles WHERE rolname = '{name}') THEN "
+        f"CREATE ROLE {name}{' LOGIN' if login else ''}; "
+        f"END IF; END $$;"
+    )
+
+
 def init_db():
     """
     Initialize the database schema, tables, and permissions.
@@ -38,32 +141,27 @@ def init_db():
     conn = admin_engine.connect()
 
     try:
-        # Reset schema
-        conn.execute(text("DROP SCHEMA IF EXISTS public CASCADE;"))
-        conn.execute(text("CREATE SCHEMA public;"))
-        conn.commit()
-
-        # Create tables
-        Base.metadata.create_all(bind=admin_engine)
+        # Create or upgrade tables, existing data is kept
+        upgrade_db(conn)
 
         # Create users and roles
         normal_password = os.getenv("POSTGRES_PASSWORD")
         admin_password = os.getenv("POSTGRES_ADMIN_PASSWORD")
 
-        # Safer: Separate commands for users and roles
+        # Roles and users are created on the first run and kept afterwards. They
+        # hold privileges on the kept tables, so they cannot simply be dropped.
         setup_commands = [
+            'CREATE EXTENSION IF NOT EXISTS "uuid-ossp";',
+
             # Create roles
-            'CREATE EXTENSION IF NOT EXISTS "uuid-ossp";'
-            "DROP ROLE IF EXISTS normal_role;",
-            "DROP ROLE IF EXISTS admin_role;",
-            "CREATE ROLE normal_role;",
-            "CREATE ROLE admin_role;",
+            _create_role_if_missing("normal_role"),
+            _create_role_if_missing("admin_role"),
 
             # Create or update users
-            f"DROP USER IF EXISTS normal_db_user;",
-            f"DROP USER IF EXISTS admin_db_user;",
-            f"CREATE USER normal_db_user WITH PASSWORD '{normal_password}';",
-            f"CREATE USER admin_db_user WITH PASSWORD '{admin_password}';",
+            _create_role_if_missing("normal_db_user", login=True),
+            _create_role_if_missing("admin_db_user", login=True),
+            f"ALTER USER normal_db_user WITH PASSWORD '{normal_password}';",
+            f"ALTER USER admin_db_user WITH PASSWORD '{admin_password}';",
 
             # Assign roles
             "GRANT normal_role TO normal_db_user;",
@@ -87,6 +185,29 @@ def init_db():
     finally:
         conn.close()
 
+def upgrade_db(conn=None):
+    """
+    Apply all pending Alembic migrations.
+
+    Args:
+        conn: Admin connection to migrate on, a new one is opened if None
+    """
+    if conn is None:
+        with admin_engine.connect() as conn:
+            return upgrade_db(conn)
+
+    config = Config(ALEMBIC_INI)
+    config.attributes["connection"] = conn
+    command.upgrade(config, "head")
+    conn.commit()
+
+def migrate_db():
+    """
+    Bring an existing database up to the current schema without dropping data.
+    Existing users get their passphrase lookup digest on their next login.
+    """
+    upgrade_db()
+
 def create_admin_account(passphrase):
     """
     Create an administrator account in the database.
@@ -98,28 +219,25 @@ def create_admin_account(passphrase):
         # Create admin account
         admin_password = passphrase
         hashed_password = hash_passphrase(admin_password)
-        conn.execute(text(f"INSERT INTO users (id, passphrase_hash, is_admin) VALUES ('{uuid.uuid4()}', '{hashed_password}', true);"))
+        conn.execute(
+            text("INSERT INTO users (id, passphrase_hash, passphrase_lookup, is_admin) "
+                 "VALUES (:id, :passphrase_hash, :passphrase_lookup, true);"),
+            {
+                "id": str(uuid.uuid4()),
+                "passphrase_hash": hashed_password,
+                "passphrase_lookup": passphrase_lookup_key(admin_password),
+            }
+        )
         conn.commit()
     finally:
         conn.close()
 
-def get_db(user_type="normal", user_id=None):
+async def get_db():
     """
-    Get a database session with appropriate permissions.
-    
-    Args:
-        user_type: Type of user ("normal" or "admin")
-        user_id: Optional user ID for context
-        
+    Get an asyncio database session for a request.
+
     Yields:
         A database session that will be automatically closed
     """
-    if user_type == "admin":
-        db = AdminSessionLocal()
-    else:
-        db = NormalSessionLocal()
-
-    try:
+    async with NormalSessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -3,11 +3,29 @@ Database models for the application.
 Defines the structure of database tables using SQLAlchemy ORM.
 """
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import ForeignKey, Boolean, VARCHAR, UUID, TIMESTAMP, func
-from sqlalchemy import Column, Integer, LargeBinary
+from sqlalchemy import ForeignKey, Boolean, VARCHAR, UUID, TIMESTAMP, func, text
+from sqlalchemy import Column, Index, Integer, BigInteger, LargeBinary
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
 import uuid
 Base = declarative_base()
 
+class statement_timestamp(FunctionElement):
+    """
+    Wall clock time at which an INSERT runs.
+    PostgreSQL's now() is fixed when the transaction starts instead.
+    """
+    type = TIMESTAMP()
+    inherit_cache = True
+
+@compiles(statement_timestamp)
+def _compile_statement_timestamp(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+@compiles(statement_timestamp, "postgresql")
+def _compile_statement_timestamp_postgresql(element, compiler, **kw):
+    return "clock_timestamp()"
+
 class SymmetricalKey(Base):
     """
     Model for storing AES encryption keys.
@@ -31,6 +49,11 @@ class PublicKey(Base):
     active = Column(Boolean, nullable=False)     # Whether this key is available for new encryptions
     key = Column(LargeBinary, nullable=False)    # The PEM-encoded public key
 
+    __table_args__ = (
+        # Key claims only ever look at the shrinking set of active keys
+        Index('ix_public_keys_active', 'id', postgresql_where=text('active')),
+    )
+
 class File(Base):
     """
     Model for storing encrypted file metadata.
@@ -41,11 +64,27 @@ class File(Base):
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(UUID(as_uuid=True), ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     symetrical_key_id = Column(UUID(as_uuid=True), ForeignKey('symmetrical_keys.id', ondelete='CASCADE'), nullable=False)
-    path = Column(VARCHAR(255), nullable=False)  # Path to stored encrypted file
+    path = Column(VARCHAR(255), nullable=False)  # Storage key of the encrypted file, relative to FILE_PATH
     file_name = Column(VARCHAR(255), nullable=False)
-    created_at = Column(TIMESTAMP, server_default=func.now(), nullable=False)
+    # Taken when the row is flushed, just before the upload commits, so download
+    # cursors do not pass it while its transaction is still open
+    created_at = Column(TIMESTAMP, server_default=func.now(), default=statement_timestamp(), nullable=False)
     content_type = Column(VARCHAR(100), nullable=False)
     seen = Column(Boolean, nullable=False, default=False)  # Whether the file has been accessed
+    size = Column(BigInteger, nullable=True)  # Size of the encrypted file, unknown for old uploads
+    sha256 = Column(VARCHAR(64), nullable=True)  # Hex digest of the encrypted file, unknown for old uploads
+    crc32 = Column(BigInteger, nullable=True)  # CRC-32 of the encrypted file for bundle archives, unknown for old uploads
+
+    # Indexes are created by the migrations in migrations/versions
+    __table_args__ = (
+        # Serves the per-user upload listing, newest first, page by page
+        Index('ix_files_user_created', 'user_id', 'created_at', 'id'),
+        # Bulk downloads page through all files in (created_at, id) order
+        Index('ix_files_created', 'created_at', 'id'),
+        # Only unseen files are waiting for the journalist
+        Index('ix_files_unseen', 'created_at', 'id', postgresql_where=text('NOT seen')),
+        Index('ix_files_symetrical_key_id', 'symetrical_key_id'),
+    )
 
 class User(Base):
     """
@@ -56,5 +95,6 @@ class User(Base):
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     passphrase_hash = Column(VARCHAR(255), nullable=False)  # Hashed passphrase for authentication
+    passphrase_lookup = Column(VARCHAR(64), nullable=True, unique=True, index=True)  # Keyed digest for indexed login lookup
     is_admin = Column(Boolean, nullable=False, default=False)  # Admin privileges flag
     created_at = Column(TIMESTAMP, server_default=func.now(), nullable=False)
@@ -2,13 +2,14 @@
 Authentication service for user validation and creation.
 Handles passphrase verification and user registration.
 """
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.models.models import User
-from app.core.security import verify_passphrase, hash_passphrase, generate_passphrase
+from app.core.security import verify_passphrase, hash_passphrase, generate_passphrase, passphrase_lookup_key
 
 import uuid
 
-def authenticate_user(db: Session, passphrase: str):
+async def authenticate_user(db: AsyncSession, passphrase: str):
     """
     Authenticate a user with the provided passphrase.
     
@@ -19,16 +20,29 @@ def authenticate_user(db: Session, passphrase: str):
     Returns:
         User object if authenticated, None otherwise
     """
-    # Retrieve all users
-    users = db.query(User).all()
-    for user in users:
+    lookup = passphrase_lookup_key(passphrase)
+
+    # Indexed lookup, followed by a single verification of the salted hash
+    user = await db.scalar(select(User).where(User.passphrase_lookup == lookup))
+    if user:
+        if verify_passphrase(passphrase, user.passphrase_hash):
+            return user
+        return None
+
+    # Accounts created before the lookup column existed are still matched by
+    # scanning, and get their digest stored so the next login is indexed
+    legacy_users = await db.scalars(select(User).where(User.passphrase_lookup.is_(None)))
+    for user in legacy_users.all():
         if user.passphrase_hash and verify_passphrase(passphrase, user.passphrase_hash):
+            user.passphrase_lookup = lookup
+            await db.commit()
+            await db.refresh(user)
             return user
 
     return None
 
 
-def create_user(db: Session):
+async def create_user(db: AsyncSession):
     """
     Create a new user with a generated passphrase.
     
@@ -44,12 +58,13 @@ def create_user(db: Session):
     # Create a new user
     user = User(
         id=uuid.uuid4(),
-        passphrase_hash=hash_passphrase(passphrase)
+        passphrase_hash=hash_passphrase(passphrase),
+        passphrase_lookup=passphrase_lookup_key(passphrase)
     )
 
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
 
     # Return the user and passphrase
     return user, passphrase
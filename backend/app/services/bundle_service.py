@@ -0,0 +1,210 @@
+"""
+Download bundle service.
+Collects new files, their keys and a manifest into archive entries.
+"""
+import hashlib
+import json
+import os
+import zlib
+from base64 import b64encode
+from typing import Optional
+from uuid import UUID
+
+from pydantic import BaseModel
+from sqlalchemy import or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app.core.zip_stream import ZipEntry
+from .file_storage_service import resolve_path, safe_file_name
+from ..models.models import File, SymmetricalKey
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+
+class ManifestEntry(BaseModel):
+    """
+    Everything a journalist needs to verify and decrypt one file of a bundle.
+    """
+    id: UUID
+    name: str  # Archive member holding the encrypted file
+    public_key_id: UUID
+    encrypted_key: str  # Base64 of the RSA-OAEP encrypted AES key
+    nonce: str  # Base64 of the AES-GCM nonce
+    size: int
+    sha256: str  # Hex digest of the encrypted file
+
+
+class BundleManifest(BaseModel):
+    """
+    The first member of every bundle, describing all files that follow it.
+    """
+    version: int = MANIFEST_VERSION
+    files: list[ManifestEntry]
+
+
+def bundle_query():
+    """
+    Select files together with their keys, files without a key are left out by the join.
+
+    Returns:
+        Select statement yielding (File, SymmetricalKey) rows
+    """
+    return select(File, SymmetricalKey).join(SymmetricalKey, File.symetrical_key_id == SymmetricalKey.id)
+
+
+def file_checksums(path: str, chunk_size: int = 64 * 1024) -> tuple[int, str, int]:
+    """
+    Compute the size, SHA-256 digest and CRC-32 of a file in one read.
+
+    Args:
+        path: Path of the file
+        chunk_size: Number of bytes read at a time
+
+    Returns:
+        Tuple of (size, hex digest, CRC-32)
+    """
+    size = 0
+    digest = hashlib.sha256()
+    crc = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            size += len(chunk)
+            digest.update(chunk)
+            crc = zlib.crc32(chunk, crc)
+    return size, digest.hexdigest(), crc
+
+
+def _missing_checksums():
+    """Condition for files uploaded before their size, digest and CRC-32 were stored."""
+    return or_(File.size.is_(None), File.sha256.is_(None), File.crc32.is_(None))
+
+
+async def fill_missing_checksums(db: AsyncSession, rows):
+    """
+    Compute and store the checksums of old uploads among rows, so they are hashed once.
+    Hashing runs in a thread, off the event loop.
+
+    Args:
+        db: Database session
+        rows: (File, SymmetricalKey) pairs
+    """
+    changed = False
+    for file, _ in rows:
+        if file.size is not None and file.sha256 is not None and file.crc32 is not None:
+            continue
+        try:
+            file.size, file.sha256, file.crc32 = await run_in_threadpool(file_checksums, resolve_path(file.path))
+        except OSError:
+            # Reported by manifest_entry, which leaves the file out
+            continue
+        changed = True
+
+    if changed:
+        await db.commit()
+
+
+def backfill_checksums(db: Session, batch_size: int = 500) -> int:
+    """
+    Store the checksums of every file uploaded before they were recorded.
+    Safe to run repeatedly and to resume after an interruption.
+
+    Args:
+        db: Database session
+        batch_size: Number of rows updated per transaction
+
+    Returns:
+        Number of updated files
+    """
+    updated = 0
+    last_id = None
+    while True:
+        query = db.query(File).filter(_missing_checksums())
+        if last_id is not None:
+            query = query.filter(File.id > last_id)
+        files = query.order_by(File.id).limit(batch_size).all()
+        if not files:
+            return updated
+
+        for file in files:
+            try:
+                file.size, file.sha256, file.crc32 = file_checksums(resolve_path(file.path))
+            except OSError as e:
+                print(f"File {file.id} could not be read, skipped: {e}")
+                continue
+            updated += 1
+
+        last_id = files[-1].id
+        db.commit()
+
+
+def manifest_entry(file: File, aes_key: SymmetricalKey) -> Optional[ManifestEntry]:
+    """
+    Describe a stored file for the manifest.
+
+    Args:
+        file: File record
+        aes_key: Key record of the file
+
+    Returns:
+        The manifest entry, None if the file is missing from storage or its digest is unknown
+    """
+    try:
+        file_path = resolve_path(file.path)
+        file_size = os.path.getsize(file_path)
+    except OSError as e:
+        # Log the error but continue with other files
+        print(f"Error adding file {file.id} to zip: {str(e)}")
+        return None
+    if file.sha256 is None:
+        # fill_missing_checksums could not read it either
+        print(f"Error adding file {file.id} to zip: digest unknown")
+        return None
+
+    return ManifestEntry(
+        id=file.id,
+        # Records written before names were sanitized are cleaned up here
+        name=f"{file.id}_{safe_file_name(file.file_name)}",
+        public_key_id=aes_key.public_key_id,
+        encrypted_key=aes_key.key.decode(),  # Stored base64 encoded already
+        nonce=b64encode(aes_key.nonce).decode(),
+        size=file_size,
+        sha256=file.sha256
+    )
+
+
+def bundle_entries(rows) -> tuple[list[ZipEntry], list[UUID]]:
+    """
+    Build the archive members for files and their keys.
+
+    Args:
+        rows: (File, SymmetricalKey) pairs in bundle order
+
+    Returns:
+        Tuple of the zip entries, manifest first, and the IDs of the files they contain
+    """
+    # Collect the archive members, the files themselves are read while streaming
+    entries = []
+    manifest = BundleManifest(files=[])
+    for file, aes_key in rows:
+        entry = manifest_entry(file, aes_key)
+        if entry is None:
+            continue
+
+        entries.append(ZipEntry(
+            name=entry.name,
+            path=resolve_path(file.path),
+            size=entry.size,
+            modified=file.created_at,
+            crc32=file.crc32
+        ))
+        manifest.files.append(entry)
+
+    if not entries:
+        return [], []
+
+    data = json.dumps(manifest.model_dump(mode="json"), separators=(",", ":")).encode()
+    entries.insert(0, ZipEntry(name=MANIFEST_NAME, data=data, size=len(data), modified=entries[0].modified))
+    return entries, [entry.id for entry in manifest.files]
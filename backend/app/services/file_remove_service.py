@@ -4,7 +4,7 @@ Handles both database record deletion and file system cleanup.
 """
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import UUID
 from ..models.models import SymmetricalKey, File, User, PublicKey
 import uuid
@@ -29,7 +29,7 @@ def delete_file_from_storage(file_path: str):
     except OSError as e:
         return False
 
-def delete_file_from_db(db: Session, file_id: UUID):
+async def delete_file_from_db(db: AsyncSession, file_id: UUID):
     """
     Delete a file record from the database.
     
@@ -40,11 +40,11 @@ def delete_file_from_db(db: Session, file_id: UUID):
     Returns:
         Boolean indicating success or failure
     """
-    db_file = db.query(File).filter(File.id == file_id).first()
+    db_file = await db.get(File, file_id)
 
     if db_file:
-        db.delete(db_file)
-        db.commit()
+        await db.delete(db_file)
+        await db.commit()
         return True
     else:
         return False
@@ -0,0 +1,127 @@
+"""
+Storage layout service for encrypted files.
+Maps files to sharded, collision-free paths below the storage directory.
+"""
+import os
+import re
+from uuid import UUID
+
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from ..models.models import File
+
+# Characters kept in file names handed to clients, everything else becomes "_"
+UNSAFE_NAME_CHARACTERS = re.compile(r"[^A-Za-z0-9._-]")
+MAX_NAME_LENGTH = 200
+
+
+def storage_key(file_id: UUID) -> str:
+    """
+    Build the storage key of a file from its ID.
+
+    The first two byte pairs of the UUID select nested directories, so no
+    single directory grows beyond a few entries per 65536 files.
+
+    Args:
+        file_id: UUID of the file record
+
+    Returns:
+        Relative key in the form "ab/cd/<uuid>"
+    """
+    name = file_id.hex
+    return f"{name[0:2]}/{name[2:4]}/{name}"
+
+
+def safe_file_name(file_name: str, fallback: str = "file") -> str:
+    """
+    Reduce a user supplied file name to a single, harmless path component.
+
+    Journalist clients write files under this name, so directories, leading
+    dots and characters outside a small whitelist are dropped.
+
+    Args:
+        file_name: Name as sent by the uploader
+        fallback: Name used when nothing usable remains
+
+    Returns:
+        File name without any path component
+    """
+    name = os.path.basename(file_name.replace("\\", "/"))
+    name = UNSAFE_NAME_CHARACTERS.sub("_", name).lstrip(".")
+    return name[:MAX_NAME_LENGTH] or fallback
+
+
+def resolve_path(path: str) -> str:
+    """
+    Get the absolute location of a stored file.
+
+    Args:
+        path: Value of File.path, a storage key or a legacy absolute path
+
+    Returns:
+        Absolute file system path
+    """
+    if os.path.isabs(path):
+        return path
+    return os.path.join(settings.FILE_PATH, path)
+
+
+def move_into_storage(staged_path: str, file_path: str):
+    """
+    Atomically move a staged file to its final path and make the rename durable.
+
+    Args:
+        staged_path: Path of the fully written staging file
+        file_path: Final storage path
+    """
+    directory = os.path.dirname(file_path)
+    os.makedirs(directory, exist_ok=True)
+    os.replace(staged_path, file_path)
+
+    # Persist the directory entry before a database row points at it
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def migrate_storage_layout(db: Session, batch_size: int = 500) -> int:
+    """
+    Move files stored under the old flat, name based layout to storage keys.
+    Safe to run repeatedly and to resume after an interruption.
+
+    Args:
+        db: Database session
+        batch_size: Number of rows updated per transaction
+
+    Returns:
+        Number of migrated files
+    """
+    migrated = 0
+    last_id = None
+    while True:
+        query = db.query(File).filter(File.path.like("/%"))
+        if last_id is not None:
+            query = query.filter(File.id > last_id)
+        files = query.order_by(File.id).limit(batch_size).all()
+        if not files:
+            return migrated
+
+        for file in files:
+            key = storage_key(file.id)
+            target = resolve_path(key)
+
+            if os.path.exists(file.path):
+                move_into_storage(file.path, target)
+            elif not os.path.exists(target):
+                # Neither location exists, keep the row as it is for inspection
+                print(f"File {file.id} not found at {file.path}, skipped")
+                continue
+
+            file.path = key
+            migrated += 1
+
+        last_id = files[-1].id
+        db.commit()
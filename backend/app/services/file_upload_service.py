@@ -4,45 +4,75 @@ Handles secure file storage with AES-GCM encryption and RSA key protection.
 """
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy import UUID
-from ..models.models import SymmetricalKey, File, User, PublicKey
+from ..models.models import SymmetricalKey, File
 import uuid
 import os
 from fastapi import UploadFile
 from app.core.config import settings
+from app.core.stream_cipher import StreamEncryptor
+from app.services.key_allocator import key_allocator, ClaimedPublicKey
+from app.services.file_storage_service import storage_key, resolve_path, move_into_storage, safe_file_name
 from PyPDF2 import PdfReader, PdfWriter
-import io, os
-
-class EncryptedFileResult(BaseModel):
+import shutil
+import tempfile
+from typing import BinaryIO, Optional
+from base64 import b64encode
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives import hashes
+from app.core.key_cache import public_key_cache
+
+# Padding used to wrap AES keys, shared by every upload
+OAEP_PADDING = padding.OAEP(
+    mgf=padding.MGF1(algorithm=hashes.SHA256()),
+    algorithm=hashes.SHA256(),
+    label=None
+)
+
+class EncryptedStreamResult(BaseModel):
     """
-    Result model for an encrypted file operation.
-    Contains the encrypted data and related encryption parameters.
+    Result model for a file encrypted straight into storage.
+    Contains the encryption parameters, the size and the checksums of the written container.
     """
     file_name: str
-    ciphertext: bytes
     nonce: bytes
     key: bytes
+    size: int
+    sha256: str
+    crc32: int
 
 
-def encrypt_pdf(file: UploadFile) -> EncryptedFileResult:
+def sanitize_and_encrypt(source: BinaryIO | str, file_name: str, output_path: str) -> EncryptedStreamResult:
     """
-    Encrypt a PDF file using AES-GCM.
+    Remove PDF metadata and encrypt the result segment by segment into a file.
+    A worker pool job, takes the raw upload instead of an UploadFile so it can
+    run in another process. Only the ciphertext is streamed.
+
+    PyPDF2 loads every object and content stream of the document, so peak
+    memory is a small multiple of the upload size. The upload endpoint
+    rejects files above MAX_UPLOAD_SIZE before they get here.
 
     Args:
-        file: Uploaded file to encrypt
+        source: Spooled upload file, or the path of a copy when run in a process pool
+        file_name: Original name of the uploaded file
+        output_path: Path the chunked AES-GCM container is written to
 
     Returns:
-        EncryptedFileResult containing ciphertext and encryption parameters
+        EncryptedStreamResult containing the encryption parameters
     """
-    key = AESGCM.generate_key(256)
-    aesgcm = AESGCM(key)
+    if isinstance(source, str):
+        # PyPDF2 reads objects lazily, the file stays open until the output is written
+        with open(source, "rb") as f:
+            return sanitize_and_encrypt(f, file_name, output_path)
 
-    # Read uploaded file into memory (nur einmal lesen)
-    original_bytes = file.file.read()
+    key = AESGCM.generate_key(256)
+    nonce = os.urandom(12)
 
-    # Step 1: Remove metadata safely using PyPDF2
-    input_pdf = PdfReader(io.BytesIO(original_bytes))
+    # Step 1: Remove metadata safely using PyPDF2, which parses the whole document
+    source.seek(0)
+    input_pdf = PdfReader(source)
     output_pdf = PdfWriter()
 
     for page in input_pdf.pages:
@@ -50,144 +80,184 @@ def encrypt_pdf(file: UploadFile) -> EncryptedFileResult:
 
     output_pdf.add_metadata({})  # remove all metadata
 
-    # Step 2: Write cleaned PDF to memory
-    cleaned_pdf_io = io.BytesIO()
-    output_pdf.write(cleaned_pdf_io)
-    cleaned_pdf_io.seek(0)
-    cleaned_bytes = cleaned_pdf_io.read()
-
-    nonce = os.urandom(12)
-
-    ciphertext = aesgcm.encrypt(nonce, cleaned_bytes, associated_data=None)
-
-    return EncryptedFileResult(
-        file_name=file.filename,
-        ciphertext=ciphertext,
+    # Step 2: Write the cleaned PDF through the encryptor into the output file
+    with open(output_path, "wb") as f:
+        encryptor = StreamEncryptor(key, nonce, f, settings.ENCRYPTION_SEGMENT_SIZE)
+        output_pdf.write(encryptor)
+        encryptor.close()
+        # The bytes have to be on disk before the upload is committed
+        f.flush()
+        os.fsync(f.fileno())
+
+    return EncryptedStreamResult(
+        file_name=file_name,
         nonce=nonce,
-        key=key
+        key=key,
+        size=encryptor.bytes_written,
+        sha256=encryptor.sha256,
+        crc32=encryptor.crc32
     )
 
-def save_encrypted_file(db: Session, file_name: str, ciphertext: bytes, user_id: UUID, symetricla_key_id: UUID) -> UUID:
+def upload_size(file: UploadFile) -> int:
     """
-    Save an encrypted file to storage and record in database.
-    
+    Get the size of an uploaded file without reading it.
+
     Args:
-        db: Database session
-        file_name: Name of the file
-        ciphertext: Encrypted file content
-        user_id: ID of the file owner
-        symetricla_key_id: ID of the associated symmetric key
-        
+        file: Uploaded file, spooled by the server
+
     Returns:
-        UUID of the created file record
+        Size of the upload in bytes
     """
-    file_name = file_name.split(".")[0] + "_encrypted"
-    file_path = os.path.join(settings.FILE_PATH, file_name)
+    if file.size is not None:
+        return file.size
+    position = file.file.tell()
+    size = file.file.seek(0, os.SEEK_END)
+    file.file.seek(position)
+    return size
+
+def stage_upload_source(source: BinaryIO) -> str:
+    """
+    Copy a spooled upload into a temporary file a process pool worker can open.
+    The upload is copied chunk by chunk, never held in memory as a whole.
 
-    db_file = File(id=uuid.uuid4(),
-                   user_id=user_id,
-                   symetrical_key_id=symetricla_key_id,
-                   path=file_path,
-                   file_name=file_name,
-                   content_type="application/pdf",
-                   seen=False
-                   )
+    Args:
+        source: Spooled upload file
 
-    # Save the encrypted file to the database
-    db.add(db_file)
-    db.commit()
-    db.refresh(db_file)
+    Returns:
+        Path of the copy, removed by the caller
+    """
+    fd, path = tempfile.mkstemp(prefix=".upload-source-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            source.seek(0)
+            shutil.copyfileobj(source, f, settings.ENCRYPTION_SEGMENT_SIZE)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+def create_staging_file() -> str:
+    """
+    Create an empty file in the storage directory to encrypt an upload into.
+    Living on the same file system lets it be moved into place with a rename.
 
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    Returns:
+        Path of the staging file
+    """
+    os.makedirs(settings.FILE_PATH, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=settings.FILE_PATH, prefix=".upload-")
+    os.close(fd)
+    return path
 
-    counter = 0
-    new_file_path = file_path
-    while os.path.exists(new_file_path):
-        counter += 1
-        name, ext = os.path.splitext(file_path)
-        new_file_path = f"{name}_{counter}{ext}"
+def _stored_file_name(file_name: str) -> str:
+    """
+    Derive the name shown for an encrypted upload.
 
-    if new_file_path != file_path:
-        db_file.path = new_file_path
-        db.commit()
-        file_path = new_file_path
+    Args:
+        file_name: Original name of the uploaded file
 
-    # Write file to storage
-    with open(file_path, "wb") as f:
-        f.write(ciphertext)
+    Returns:
+        Name stored in the file record
+    """
+    return safe_file_name(file_name).split(".")[0] + "_encrypted"
 
-    print(f"File saved at {file_path}")
+async def save_upload(db: AsyncSession, staged_path: str, file_name: str, user_id: UUID,
+                encrypted_key: bytes, public_key_id: UUID, nonce: bytes,
+                size: Optional[int] = None, sha256: Optional[str] = None,
+                crc32: Optional[int] = None) -> UUID:
+    """
+    Persist an upload encrypted into a staging file in a single transaction.
 
-    return db_file.id
+    The key and file rows are flushed, the ciphertext is moved into place and
+    only then is the transaction committed. On any failure it is rolled back,
+    together with the caller's public key claim, so no row points at a file
+    that is not on disk.
 
-def save_aesgcm_key(db: Session, aes_key: bytes, public_key_id: UUID, nonce: bytes) -> UUID:
-    """
-    Save an AES-GCM key to the database.
-    
     Args:
         db: Database session
-        aes_key: Encrypted AES key
+        staged_path: Path of the encrypted staging file
+        file_name: Original name of the uploaded file
+        user_id: ID of the file owner
+        encrypted_key: RSA encrypted AES key
         public_key_id: ID of the public key used for encryption
-        nonce: Initialization vector used with AES-GCM
-        
+        nonce: Nonce used with AES-GCM
+        size: Size of the encrypted file in bytes
+        sha256: Hex SHA-256 digest of the encrypted file
+        crc32: CRC-32 of the encrypted file
+
     Returns:
-        UUID of the created symmetric key record
+        UUID of the created file record
     """
-    # Save the AESGCM key securely
-    db_key = SymmetricalKey(key=aes_key, public_key_id=public_key_id, nonce=nonce)
-    db.add(db_key)
-    db.commit()
-    db.refresh(db_key)
-    print(f"Key saved with ID {db_key.id}")
-    return db_key.id
+    file_id = uuid.uuid4()
+    file_path = resolve_path(storage_key(file_id))
 
+    db_key = SymmetricalKey(id=uuid.uuid4(), key=encrypted_key, public_key_id=public_key_id, nonce=nonce)
+    db_file = File(id=file_id,
+                   user_id=user_id,
+                   symetrical_key_id=db_key.id,
+                   path=storage_key(file_id),
+                   file_name=_stored_file_name(file_name),
+                   content_type="application/pdf",
+                   seen=False,
+                   size=size,
+                   sha256=sha256,
+                   crc32=crc32
+                   )
+    db.add(db_key)
+    db.add(db_file)
 
-def encrypt_aes_key(db: Session, aes_key: bytes) -> tuple[bytes, UUID]:
+    moved = False
+    try:
+        # Constraint violations show up here, before storage is touched
+        await db.flush()
+        # Renaming and syncing the directory block, keep them off the event loop
+        await run_in_threadpool(move_into_storage, staged_path, file_path)
+        moved = True
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        if moved and os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+
+    return file_id
+
+async def claim_public_key(db: AsyncSession) -> ClaimedPublicKey:
     """
-    Encrypt an AES key with a public RSA key.
-    
+    Take the next active public key and mark it as used.
+
     Args:
         db: Database session
-        aes_key: AES key to encrypt
-        
+
     Returns:
-        Tuple of (encrypted key, public key ID)
-        
+        The claimed public key
+
     Raises:
-        Exception: If no active public key is available
+        NoPublicKeyAvailable: If no active public key is available
     """
-    from cryptography.hazmat.primitives.asymmetric import padding
-    from cryptography.hazmat.primitives import hashes
-    from cryptography.hazmat.primitives.serialization import load_pem_public_key
-    from base64 import b64encode
+    return await key_allocator.claim(db)
 
-    # Get the next active public key
-    pub_key: PublicKey = db.query(PublicKey).filter(PublicKey.active == True).first()
+def wrap_aes_key(public_key_id: UUID, public_key_pem: bytes, aes_key: bytes) -> bytes:
+    """
+    Encrypt an AES key with a public RSA key.
+    A public key operation takes microseconds, so it runs on the event loop.
 
-    if not pub_key:
-        raise Exception("Due to high usage of the system, uploading files is currently not possible. Please try again later.")
-    # Mark the public key as inactive
-    pub_key.active = False
-    db.commit()
-    db.refresh(pub_key)
+    Args:
+        public_key_id: ID of the public key, used to find it already parsed
+        public_key_pem: PEM encoded public key, parsed if not cached
+        aes_key: AES key to encrypt
 
-    # Deserialize the public key
-    public_key = load_pem_public_key(pub_key.key)
+    Returns:
+        Base64 encoded encrypted key
+    """
+    # The key is consumed by this upload, so it leaves the cache
+    public_key = public_key_cache.take(public_key_id, public_key_pem)
 
     # Encrypt the AES key with the public RSA key
-    encrypted_key = public_key.encrypt(
-        aes_key,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
+    encrypted_key = public_key.encrypt(aes_key, OAEP_PADDING)
 
     # Encode the encrypted key as Base64 for storage
-    encrypted_key_b64 = b64encode(encrypted_key)
-
-    return encrypted_key_b64, pub_key.id
+    return b64encode(encrypted_key)
 
 def allowed_type(file: UploadFile) -> bool:
     """
@@ -204,27 +274,3 @@ def allowed_type(file: UploadFile) -> bool:
         print("Invalid file type. Only PDF files are allowed.")
         return False
     return True
-
-# only for testing purposes
-def insert_random_user(db: Session) -> UUID:
-    """
-    Insert a random test user into the database.
-    For testing purposes only.
-    
-    Args:
-        db: Database session
-        
-    Returns:
-        UUID of the created test user
-    """
-    # Insert a random user into the database
-    # This is a placeholder for the actual user insertion logic
-    # You would use a user creation function here
-    user = User(alias="test_user")
-    db.add(user)
-    db.commit()
-    db.refresh(user)
-    print(f"Inserted random user with ID {user.id}")
-    return user.id
-
-
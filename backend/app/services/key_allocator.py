@@ -0,0 +1,102 @@
+"""
+Public key allocation service.
+Hands every upload its own RSA public key without uploads contending for rows.
+"""
+import threading
+from collections import deque
+
+from pydantic import BaseModel
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from uuid import UUID
+
+from app.core.config import settings
+from app.core.exceptions import NoPublicKeyAvailable
+from ..models.models import PublicKey
+
+
+class ClaimedPublicKey(BaseModel):
+    """
+    A public key that has been taken out of the active pool.
+    """
+    id: UUID
+    key: bytes
+
+
+class PublicKeyAllocator:
+    """
+    Claims active public keys so that each one is used for exactly one upload.
+
+    A claim is a single UPDATE ... RETURNING whose candidate rows are locked with
+    FOR UPDATE SKIP LOCKED, so concurrent uploads take different keys instead of
+    queueing on the same row. A single key is claimed inside the caller's
+    transaction and returns to the pool if the upload is rolled back.
+
+    With a prefetch size above one, a batch is claimed and committed per round
+    trip and the spare keys are handed out from memory.
+    """
+
+    def __init__(self, prefetch: int = 1):
+        self._prefetch = max(1, prefetch)
+        self._keys = deque()
+        self._lock = threading.Lock()
+
+    async def claim(self, db: AsyncSession) -> ClaimedPublicKey:
+        """
+        Claim a public key for one upload.
+
+        Args:
+            db: Database session
+
+        Returns:
+            The claimed public key
+
+        Raises:
+            NoPublicKeyAvailable: If every public key has been used
+        """
+        with self._lock:
+            if self._keys:
+                return self._keys.popleft()
+
+        claimed = await self._claim_batch(db, self._prefetch)
+        if not claimed:
+            raise NoPublicKeyAvailable()
+
+        with self._lock:
+            self._keys.extend(claimed[1:])
+        return claimed[0]
+
+    async def _claim_batch(self, db: AsyncSession, count: int) -> list[ClaimedPublicKey]:
+        """
+        Atomically mark up to count active keys as used and return them.
+
+        Args:
+            db: Database session
+            count: Maximum number of keys to claim
+
+        Returns:
+            List of claimed keys, empty if none are left
+        """
+        candidates = (
+            select(PublicKey.id)
+            .where(PublicKey.active == True)
+            .limit(count)
+            .with_for_update(skip_locked=True)
+        )
+        stmt = (
+            update(PublicKey)
+            .where(PublicKey.id.in_(candidates))
+            .values(active=False)
+            .returning(PublicKey.id, PublicKey.key)
+            .execution_options(synchronize_session=False)
+        )
+        rows = (await db.execute(stmt)).all()
+        if count > 1:
+            # Spare keys outlive this request, their claim cannot be rolled back
+            await db.commit()
+
+        return [ClaimedPublicKey(id=row.id, key=row.key) for row in rows]
+
+
+# One allocator per worker process
+key_allocator = PublicKeyAllocator(prefetch=settings.PUBLIC_KEY_PREFETCH)
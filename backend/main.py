@@ -7,11 +7,20 @@ from app.api.v1.upload import router as upload_router
 from app.api.v1.auth import router as auth_router
 from app.api.v1.download import router as download_router
 from app.api.v1.rsa_upload import router as public_key_router
+from app.api.v1.admin import router as admin_router
 from app.core.config import settings
 from app.db.session import init_db
-from app.db.session import init_db, create_admin_account
+from app.db.session import init_db, create_admin_account, migrate_db
+from app.core.workers import shutdown_executor
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Let running encryption jobs finish before the worker exits
+    shutdown_executor()
+
+app = FastAPI(lifespan=lifespan)
 
 # @app.on_event("startup")
 # async def startup_event():
@@ -29,6 +38,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # init_db()
@@ -39,6 +49,7 @@ app.include_router(upload_router, prefix=settings.API_PREFIX + "/upload")
 app.include_router(auth_router, prefix=settings.API_PREFIX + "/auth")
 app.include_router(public_key_router, prefix=settings.API_PREFIX + "/publickey")
 app.include_router(download_router, prefix=settings.API_PREFIX + "/download")
+app.include_router(admin_router, prefix=settings.API_PREFIX + "/admin")
 
 if __name__ == "__main__":
     import sys
@@ -58,6 +69,27 @@ if __name__ == "__main__":
     if "--init" in sys.argv:
         init_db()
         print(f"database was initialized successfully.")
+    elif "--migrate" in sys.argv:
+        migrate_db()
+        print(f"database was migrated successfully.")
+    elif "--migrate-storage" in sys.argv:
+        from app.db.session import AdminSessionLocal
+        from app.services.file_storage_service import migrate_storage_layout
+        db = AdminSessionLocal()
+        try:
+            migrated = migrate_storage_layout(db)
+        finally:
+            db.close()
+        print(f"{migrated} file(s) were moved to the new storage layout.")
+    elif "--backfill-checksums" in sys.argv:
+        from app.db.session import AdminSessionLocal
+        from app.services.bundle_service import backfill_checksums
+        db = AdminSessionLocal()
+        try:
+            updated = backfill_checksums(db)
+        finally:
+            db.close()
+        print(f"Checksums of {updated} file(s) were stored.")
     else:
         print("Normal start")
         uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=False)
\ No newline at end of file
@@ -0,0 +1,64 @@
+"""
+Baseline schema, as created by the original init_db().
+Tables that already exist are left untouched, so live databases can be stamped
+by simply upgrading.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "public_keys",
+        sa.Column("id", sa.UUID(as_uuid=True), primary_key=True),
+        sa.Column("active", sa.Boolean(), nullable=False),
+        sa.Column("key", sa.LargeBinary(), nullable=False),
+        if_not_exists=True,
+    )
+    op.create_table(
+        "users",
+        sa.Column("id", sa.UUID(as_uuid=True), primary_key=True),
+        sa.Column("passphrase_hash", sa.VARCHAR(255), nullable=False),
+        sa.Column("is_admin", sa.Boolean(), nullable=False),
+        sa.Column("created_at", sa.TIMESTAMP(), server_default=sa.func.now(), nullable=False),
+        if_not_exists=True,
+    )
+    op.create_table(
+        "symmetrical_keys",
+        sa.Column("id", sa.UUID(as_uuid=True), primary_key=True),
+        sa.Column("public_key_id", sa.UUID(as_uuid=True),
+                  sa.ForeignKey("public_keys.id", ondelete="CASCADE"), nullable=False),
+        sa.Column("nonce", sa.LargeBinary(), nullable=False),
+        sa.Column("key", sa.LargeBinary(), nullable=False),
+        if_not_exists=True,
+    )
+    op.create_table(
+        "files",
+        sa.Column("id", sa.UUID(as_uuid=True), primary_key=True),
+        sa.Column("user_id", sa.UUID(as_uuid=True),
+                  sa.ForeignKey("users.id", ondelete="CASCADE"), nullable=False),
+        sa.Column("symetrical_key_id", sa.UUID(as_uuid=True),
+                  sa.ForeignKey("symmetrical_keys.id", ondelete="CASCADE"), nullable=False),
+        sa.Column("path", sa.VARCHAR(255), nullable=False),
+        sa.Column("file_name", sa.VARCHAR(255), nullable=False),
+        sa.Column("created_at", sa.TIMESTAMP(), server_default=sa.func.now(), nullable=False),
+        sa.Column("content_type", sa.VARCHAR(100), nullable=False),
+        sa.Column("seen", sa.Boolean(), nullable=False),
+        if_not_exists=True,
+    )
+
+
+def downgrade():
+    op.drop_table("files")
+    op.drop_table("symmetrical_keys")
+    op.drop_table("users")
+    op.drop_table("public_keys")
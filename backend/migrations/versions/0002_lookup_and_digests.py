@@ -0,0 +1,29 @@
+"""
+Passphrase lookup digests and stored file sizes and digests.
+Replaces the statements --migrate used to run, which may already have been applied.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("users", sa.Column("passphrase_lookup", sa.VARCHAR(64), nullable=True), if_not_exists=True)
+    op.create_index("ix_users_passphrase_lookup", "users", ["passphrase_lookup"], unique=True, if_not_exists=True)
+    op.add_column("files", sa.Column("size", sa.BigInteger(), nullable=True), if_not_exists=True)
+    op.add_column("files", sa.Column("sha256", sa.VARCHAR(64), nullable=True), if_not_exists=True)
+
+
+def downgrade():
+    op.drop_column("files", "sha256")
+    op.drop_column("files", "size")
+    op.drop_index("ix_users_passphrase_lookup", table_name="users")
+    op.drop_column("users", "passphrase_lookup")
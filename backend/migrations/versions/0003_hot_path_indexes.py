@@ -0,0 +1,46 @@
+"""
+Indexes for the upload listing, bulk downloads and public key claims.
+Built CONCURRENTLY, so uploads and downloads keep working while they are created.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    # Upload listing: one user's files, newest first
+    ("ix_files_user_created", "files", ["user_id", "created_at", "id"], None),
+    # Bulk downloads page through all files in (created_at, id) order
+    ("ix_files_created", "files", ["created_at", "id"], None),
+    # Only unseen files are waiting for the journalist
+    ("ix_files_unseen", "files", ["created_at", "id"], sa.text("NOT seen")),
+    # Joins from files to their keys and the cascade from symmetrical_keys
+    ("ix_files_symetrical_key_id", "files", ["symetrical_key_id"], None),
+    # Key claims only ever look at the shrinking set of active keys
+    ("ix_public_keys_active", "public_keys", ["id"], sa.text("active")),
+]
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in INDEXES:
+            op.create_index(
+                name, table, columns,
+                postgresql_where=where,
+                postgresql_concurrently=True,
+                if_not_exists=True,
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
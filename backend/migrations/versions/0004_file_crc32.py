@@ -0,0 +1,23 @@
+"""
+Stored CRC-32 of encrypted files.
+Lets bundle downloads resume without reading the files before the range.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("files", sa.Column("crc32", sa.BigInteger(), nullable=True), if_not_exists=True)
+
+
+def downgrade():
+    op.drop_column("files", "crc32")
@@ -0,0 +1,83 @@
+import uuid
+from datetime import datetime
+from typing import Optional
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.core.user_cache import AuthenticatedUser
+from app.models.models import Base, File, PublicKey, SymmetricalKey, User
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def sqlite_db():
+    # In-memory database with one user and one active public key, used like a request's session
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    db = async_sessionmaker(bind=engine, expire_on_commit=False)()
+    user = User(id=uuid.uuid4(), passphrase_hash="salt$hash")
+    public_key = PublicKey(id=uuid.uuid4(), active=True, key=b"pem")
+    db.add_all([user, public_key])
+    await db.commit()
+
+    yield db, user.id, public_key.id
+
+    await db.close()
+    await engine.dispose()
+
+
+@pytest.fixture
+def sqlite_admin_db():
+    # Synchronous in-memory database, as used by the maintenance commands
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    user = User(id=uuid.uuid4(), passphrase_hash="salt$hash")
+    public_key = PublicKey(id=uuid.uuid4(), active=True, key=b"pem")
+    db.add_all([user, public_key])
+    db.commit()
+
+    yield db, user.id, public_key.id
+
+    db.close()
+    engine.dispose()
+
+
+class StoredFiles:
+    """Adds encrypted files to storage and the database of a test, for downloads by admin"""
+
+    def __init__(self, db, user_id, public_key_id, directory):
+        self.db = db
+        self.user_id = user_id
+        self.public_key_id = public_key_id
+        self.directory = directory
+        self.admin = AuthenticatedUser(id=uuid.uuid4(), is_admin=True)
+
+    async def add(self, name: str, content: bytes = b"ciphertext", created_at: Optional[datetime] = None,
+                  key: bytes = b"key", nonce: bytes = b"nonce", **columns) -> File:
+        (self.directory / name).write_bytes(content)
+        aes_key = SymmetricalKey(id=uuid.uuid4(), key=key, public_key_id=self.public_key_id, nonce=nonce)
+        file = File(id=uuid.uuid4(), user_id=self.user_id, symetrical_key_id=aes_key.id, path=name,
+                    file_name=name, content_type="application/pdf", seen=False, **columns)
+        if created_at is not None:
+            file.created_at = created_at
+        self.db.add_all([aes_key, file])
+        await self.db.commit()
+        return file
+
+
+@pytest.fixture
+def stored_files(mocker, tmp_path, sqlite_db):
+    # Storage lives in tmp_path and new files are offered for download right away
+    mocker.patch("app.services.file_storage_service.settings.FILE_PATH", str(tmp_path))
+    mocker.patch("app.api.v1.download.settings.DOWNLOAD_SETTLE_SECONDS", 0)
+    db, user_id, public_key_id = sqlite_db
+    return StoredFiles(db, user_id, public_key_id, tmp_path)
@@ -0,0 +1,90 @@
+import asyncio
+import uuid
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+
+from app.api.v1.admin import get_metrics
+from app.core.auth import create_access_token
+from app.core.base_deps import get_db_session
+from app.core.user_cache import AuthenticatedUser
+from app.db.pool import MeasuredAsyncQueuePool, MeasuredQueuePool, pool_metrics
+from app.models.models import Base, User
+from main import app
+
+
+def test_measured_pool_records_checkout_waits(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'pool.db'}", poolclass=MeasuredQueuePool,
+                           pool_logging_name="test-pool", pool_size=1, max_overflow=0, pool_timeout=0.05)
+    held = engine.connect()
+    try:
+        with pytest.raises(Exception):
+            engine.connect()
+    finally:
+        held.close()
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+
+    stats = pool_metrics["test-pool"].snapshot(engine.pool)
+    assert stats.checkouts == 3
+    assert stats.timeouts == 1
+    assert stats.wait_seconds_max >= 0.05
+    assert stats.checked_out == 0
+    engine.dispose()
+
+
+@pytest.mark.anyio
+async def test_measured_async_pool_records_checkouts(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}", poolclass=MeasuredAsyncQueuePool,
+                                 pool_logging_name="test-async-pool")
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+
+    stats = pool_metrics["test-async-pool"].snapshot(engine.pool)
+    assert (stats.checkouts, stats.checked_out) == (1, 0)
+    await engine.dispose()
+
+
+def test_metrics_requires_admin():
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(get_metrics(current_user=AuthenticatedUser(id=uuid.uuid4(), is_admin=False)))
+    assert e.value.status_code == 403
+
+    metrics = asyncio.run(get_metrics(current_user=AuthenticatedUser(id=uuid.uuid4(), is_admin=True)))
+    assert metrics.pools == {}
+    assert metrics.user_cache.hits >= 0
+
+
+def test_request_uses_one_session(tmp_path):
+    # The app runs on the test client's own event loop, so every checkout opens a new connection
+    url = f"sqlite:///{tmp_path / 'app.db'}"
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    user_id = uuid.uuid4()
+    with sessionmaker(bind=engine)() as db:
+        db.add(User(id=user_id, passphrase_hash="salt$hash"))
+        db.commit()
+    engine.dispose()
+
+    async_engine = create_async_engine(url.replace("sqlite", "sqlite+aiosqlite"), poolclass=NullPool)
+    sessions = []
+
+    async def counting_session():
+        async with AsyncSession(async_engine) as db:
+            sessions.append(db)
+            yield db
+
+    app.dependency_overrides[get_db_session] = counting_session
+    try:
+        token = create_access_token({"sub": str(user_id)})
+        response = TestClient(app).get("/api/v1/upload/", headers={"Authorization": f"Bearer {token}"})
+    finally:
+        app.dependency_overrides.clear()
+
+    assert response.status_code == 200
+    assert len(sessions) == 1
@@ -1,3 +1,7 @@
+import asyncio
+import uuid
+
+import pytest
 from fastapi.testclient import TestClient
 from main import app
 
@@ -36,4 +40,92 @@ def test_wrong_phrase(mocker):
         json={"passphrase": "wrong_passphrase"}
     )
     assert response.status_code == 401
-    assert response.json() == {"detail": "Invalid Passphrase"}
\ No newline at end of file
+    assert response.json() == {"detail": "Invalid Passphrase"}
+
+def test_login_uses_lookup_digest(mocker):
+    from app.core.security import hash_passphrase, passphrase_lookup_key
+    from app.services.auth_service import authenticate_user
+
+    user = mocker.MagicMock()
+    user.passphrase_hash = hash_passphrase("correct horse")
+    mock_db = mocker.MagicMock()
+    mock_db.scalar = mocker.AsyncMock(return_value=user)
+    mock_db.scalars = mocker.AsyncMock()
+
+    assert asyncio.run(authenticate_user(mock_db, "correct horse")) is user
+    # Only the indexed query is needed, no scan over all users
+    mock_db.scalars.assert_not_called()
+    assert passphrase_lookup_key("correct horse") == passphrase_lookup_key("correct horse")
+    assert passphrase_lookup_key("correct horse") != passphrase_lookup_key("wrong horse")
+
+
+def test_login_backfills_legacy_account(mocker):
+    from app.core.security import hash_passphrase, passphrase_lookup_key
+    from app.services.auth_service import authenticate_user
+
+    legacy_user = mocker.MagicMock()
+    legacy_user.passphrase_hash = hash_passphrase("correct horse")
+    mock_db = mocker.MagicMock()
+    mock_db.scalar = mocker.AsyncMock(return_value=None)
+    legacy_users = mocker.MagicMock()
+    legacy_users.all.return_value = [legacy_user]
+    mock_db.scalars = mocker.AsyncMock(return_value=legacy_users)
+    mock_db.commit = mocker.AsyncMock()
+    mock_db.refresh = mocker.AsyncMock()
+
+    assert asyncio.run(authenticate_user(mock_db, "correct horse")) is legacy_user
+    assert legacy_user.passphrase_lookup == passphrase_lookup_key("correct horse")
+    mock_db.commit.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_current_user_is_cached_until_deleted(sqlite_db):
+    from fastapi import HTTPException
+    from sqlalchemy import event
+    from app.core.auth import create_access_token, get_current_user
+    from app.core.user_cache import user_cache
+    from app.models.models import User
+
+    db, user_id, _ = sqlite_db
+    token = create_access_token({"sub": str(user_id)})
+    statements = []
+    event.listen(db.bind.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    before = user_cache.stats()
+
+    first = await get_current_user(token, db)
+    second = await get_current_user(token, db)
+
+    # Only the first request looks the user up
+    assert first == second
+    assert (first.id, first.is_admin) == (user_id, False)
+    assert len(statements) == 1
+    # The lookup does not leave a transaction open on the request's connection
+    assert not db.in_transaction()
+    after = user_cache.stats()
+    assert (after.hits - before.hits, after.misses - before.misses) == (1, 1)
+
+    # Deleting the user drops the cached entry
+    await db.delete(await db.get(User, user_id))
+    await db.commit()
+    with pytest.raises(HTTPException) as exc:
+        await get_current_user(token, db)
+    assert exc.value.status_code == 401
+
+
+def test_user_cache_expires_entries(mocker):
+    from app.core.user_cache import AuthenticatedUser, UserCache
+
+    clock = mocker.patch("app.core.user_cache.time.monotonic", return_value=100.0)
+    cache = UserCache(maxsize=1, ttl=30)
+    user = AuthenticatedUser(id=uuid.uuid4(), is_admin=True)
+    cache.put(user)
+
+    assert cache.get(user.id) == user
+    clock.return_value = 131.0
+    assert cache.get(user.id) is None
+
+    # The least recently used user makes room for a new one
+    cache.put(user)
+    cache.put(AuthenticatedUser(id=uuid.uuid4(), is_admin=False))
+    assert cache.get(user.id) is None
+    assert cache.stats().size == 1
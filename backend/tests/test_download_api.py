@@ -0,0 +1,327 @@
+import hashlib
+import io
+import os
+import zipfile
+from datetime import datetime
+
+import pytest
+from sqlalchemy import func, select
+
+from app.core.zip_stream import ZipEntry, stream_zip
+from app.models.models import File
+
+
+async def _unseen(db):
+    return await db.scalar(select(func.count()).select_from(File).where(File.seen == False))
+
+
+def test_stream_zip_is_readable_and_stored(tmp_path):
+    ciphertext = os.urandom(200_000)
+    path = tmp_path / "upload"
+    path.write_bytes(ciphertext)
+    created = datetime(2025, 5, 6, 7, 8, 10)
+
+    entries = [
+        ZipEntry(name="file.pdf", path=str(path), size=len(ciphertext), modified=created),
+        ZipEntry(name="key_info.txt", data=b"key", size=3, modified=created),
+    ]
+    chunks = list(stream_zip(entries, chunk_size=4096))
+
+    # The archive arrives in pieces, never as one buffer
+    assert max(len(chunk) for chunk in chunks) <= 4096
+    archive = zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+    assert archive.testzip() is None
+    assert archive.read("file.pdf") == ciphertext
+    assert archive.read("key_info.txt") == b"key"
+    assert all(info.compress_type == zipfile.ZIP_STORED for info in archive.infolist())
+    assert archive.getinfo("file.pdf").date_time == (2025, 5, 6, 7, 8, 10)
+
+
+def test_stream_zip_reads_each_file_once(mocker, tmp_path):
+    from app.core import zip_stream
+
+    path = tmp_path / "upload"
+    path.write_bytes(os.urandom(10_000))
+    entries = [ZipEntry(name="file.pdf", path=str(path), size=10_000, modified=datetime(2025, 5, 6))]
+    read = mocker.spy(zip_stream, "_read_chunks")
+
+    stream = stream_zip(entries)
+    # The local header leaves before the file is touched
+    first = next(stream)
+    assert first.startswith(b"PK\x03\x04")
+    read.assert_not_called()
+    archive = first + b"".join(stream)
+    assert read.call_count == 1
+    assert zipfile.ZipFile(io.BytesIO(archive)).testzip() is None
+
+
+@pytest.mark.anyio
+async def test_download_new_files_uses_constant_queries(stored_files):
+    from sqlalchemy import event
+    from app.api.v1.download import download_new_files
+
+    db = stored_files.db
+    for i in range(5):
+        await stored_files.add(f"file{i}")
+
+    statements = []
+    event.listen(db.bind.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    response = await download_new_files(since_date="2000-01-01", cursor=None, limit=None, db=db,
+                                        current_user=stored_files.admin)
+    body = b"".join([chunk async for chunk in response.body_iterator])
+
+    # One joined select and one bulk update, whatever the number of files, plus
+    # one update storing the checksums of these old uploads the first time
+    assert len(statements) == 3
+    assert await _unseen(db) == 0
+    stored = await db.scalars(select(File.sha256))
+    assert set(stored) == {hashlib.sha256(b"ciphertext").hexdigest()}
+    # The manifest comes first, followed by the encrypted files
+    names = zipfile.ZipFile(io.BytesIO(body)).namelist()
+    assert names[0] == "manifest.json"
+    assert len(names) == 6
+
+
+@pytest.mark.anyio
+async def test_download_new_files_pages_with_cursor(stored_files):
+    import uuid
+    from fastapi import HTTPException
+    from app.api.v1.download import download_new_files
+    from app.core.cursor import decode_cursor, encode_cursor
+
+    # All files share one timestamp, the id breaks the tie
+    created = datetime(2025, 5, 6, 7, 8, 9)
+    file_ids = {str((await stored_files.add(f"file{i}", created_at=created)).id) for i in range(5)}
+
+    async def download(cursor):
+        response = await download_new_files(since_date=None, cursor=cursor, limit=2, db=stored_files.db,
+                                            current_user=stored_files.admin)
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        return response.headers, zipfile.ZipFile(io.BytesIO(body)).namelist()
+
+    received = []
+    cursor = None
+    more = []
+    while True:
+        headers, names = await download(cursor)
+        received += [name.split("_")[0] for name in names if name != "manifest.json"]
+        more.append(headers["x-more-available"])
+        cursor = headers["x-next-cursor"]
+        if headers["x-more-available"] != "true":
+            break
+
+    # Every file arrives exactly once, in batches of at most two
+    assert more == ["true", "true", "false"]
+    assert sorted(received) == sorted(file_ids)
+    assert decode_cursor(cursor) == (created, max(uuid.UUID(i) for i in file_ids))
+
+    with pytest.raises(HTTPException) as exc:
+        await download(cursor)
+    assert exc.value.status_code == 404
+
+    with pytest.raises(HTTPException) as exc:
+        await download("not-a-cursor")
+    assert exc.value.status_code == 400
+    assert decode_cursor(encode_cursor(created, uuid.UUID(int=1))) == (created, uuid.UUID(int=1))
+
+
+def test_stream_zip_resumes_from_any_offset(tmp_path):
+    from app.core.zip_stream import archive_etag, archive_size
+
+    ciphertext = os.urandom(100_000)
+    path = tmp_path / "upload"
+    path.write_bytes(ciphertext)
+    created = datetime(2025, 5, 6, 7, 8, 10)
+    entries = [
+        ZipEntry(name="file.pdf", path=str(path), size=len(ciphertext), modified=created),
+        ZipEntry(name="key_info.txt", data=b"key", size=3, modified=created),
+    ]
+    archive = b"".join(stream_zip(entries))
+
+    assert archive_size(entries) == len(archive)
+    for start, end in [(0, 10), (10, None), (50_000, 100_040), (len(archive) - 7, None)]:
+        assert b"".join(stream_zip(entries, start=start, end=end)) == archive[start:end]
+    assert archive_etag(entries) == archive_etag([entry.model_copy() for entry in entries])
+    assert archive_etag(entries) != archive_etag(entries[:1])
+
+
+def test_stream_zip_resume_skips_files_with_known_crc(mocker, tmp_path):
+    import zlib
+    from app.core import zip_stream
+
+    ciphertext = os.urandom(100_000)
+    path = tmp_path / "upload"
+    path.write_bytes(ciphertext)
+    created = datetime(2025, 5, 6, 7, 8, 10)
+    entries = [
+        ZipEntry(name="key_info.txt", data=b"key", size=3, modified=created),
+        ZipEntry(name="file.pdf", path=str(path), size=len(ciphertext), modified=created,
+                 crc32=zlib.crc32(ciphertext)),
+    ]
+    archive = b"".join(stream_zip(entries))
+    assert zipfile.ZipFile(io.BytesIO(archive)).testzip() is None
+
+    # Resuming behind the file sends the trailer without opening the file
+    read = mocker.spy(zip_stream, "_read_chunks")
+    assert b"".join(stream_zip(entries, start=len(archive) - 50)) == archive[-50:]
+    assert all(call.args[0].path is None for call in read.call_args_list)
+
+
+@pytest.mark.anyio
+async def test_bundle_download_supports_ranges(stored_files):
+    from fastapi import HTTPException
+    from app.api.v1.download import download_bundle, download_new_files
+
+    db, admin = stored_files.db, stored_files.admin
+    for i in range(3):
+        await stored_files.add(f"file{i}", os.urandom(10_000), created_at=datetime(2025, 5, 6, 7, 8, i))
+
+    async def body(response):
+        return b"".join([chunk async for chunk in response.body_iterator])
+
+    response = await download_new_files(since_date=None, cursor=None, limit=None, db=db, current_user=admin)
+    archive = await body(response)
+    bundle_id, etag = response.headers["x-bundle-id"], response.headers["etag"]
+    assert int(response.headers["content-length"]) == len(archive)
+
+    async def fetch(range_header, if_range=etag):
+        return await download_bundle(bundle_id, range_header=range_header, if_range=if_range, db=db,
+                                     current_user=admin)
+
+    # Files already marked as seen stay in their bundle
+    partial = await fetch("bytes=12345-")
+    assert partial.status_code == 206
+    assert partial.headers["content-range"] == f"bytes 12345-{len(archive) - 1}/{len(archive)}"
+    assert await body(partial) == archive[12345:]
+
+    # A stale If-Range gets the whole archive
+    full = await fetch("bytes=12345-", if_range='"stale"')
+    assert full.status_code == 200
+    assert await body(full) == archive
+
+    with pytest.raises(HTTPException) as exc:
+        await fetch(f"bytes={len(archive)}-")
+    assert exc.value.status_code == 416
+
+
+@pytest.mark.anyio
+async def test_download_file_has_stable_etag(stored_files):
+    from app.api.v1.download import download_file
+
+    file = await stored_files.add("file")
+
+    response = await download_file(file.id, db=stored_files.db, current_user=stored_files.admin)
+
+    assert response.headers["etag"] == f'"{file.id.hex}-10"'
+    assert response.headers["accept-ranges"] == "bytes"
+
+
+@pytest.mark.anyio
+async def test_bundle_manifest_describes_files(stored_files):
+    import json
+    from base64 import b64decode
+    from app.api.v1.download import download_new_files
+
+    ciphertext = os.urandom(1000)
+    digest = hashlib.sha256(ciphertext).hexdigest()
+    for name, sha256 in [("new", digest), ("old", None)]:
+        await stored_files.add(name, ciphertext, key=b"ZW5jcnlwdGVk", nonce=b"\x00" * 12, size=1000, sha256=sha256)
+
+    response = await download_new_files(since_date=None, cursor=None, limit=None, db=stored_files.db,
+                                        current_user=stored_files.admin)
+    archive = zipfile.ZipFile(io.BytesIO(b"".join([chunk async for chunk in response.body_iterator])))
+    manifest = json.loads(archive.read("manifest.json"))
+
+    assert manifest["version"] == 1
+    assert len(manifest["files"]) == 2
+    for entry in manifest["files"]:
+        # Uploads without a recorded digest are hashed while the bundle is built
+        assert entry["sha256"] == digest
+        assert entry["size"] == 1000
+        assert entry["encrypted_key"] == "ZW5jcnlwdGVk"
+        assert b64decode(entry["nonce"]) == b"\x00" * 12
+        assert entry["public_key_id"] == str(stored_files.public_key_id)
+        assert archive.read(entry["name"]) == ciphertext
+
+
+@pytest.mark.anyio
+async def test_list_new_files_returns_manifest_entries(stored_files):
+    from app.api.v1.download import list_new_files
+
+    for i in range(3):
+        await stored_files.add(f"file{i}", created_at=datetime(2025, 5, 6, 7, 8, i))
+
+    async def listing(cursor):
+        return await list_new_files(since_date=None, cursor=cursor, limit=2, db=stored_files.db,
+                                    current_user=stored_files.admin)
+
+    first = await listing(None)
+    second = await listing(first.next_cursor)
+    last = await listing(second.next_cursor)
+
+    assert [len(first.files), len(second.files), len(last.files)] == [2, 1, 0]
+    assert (first.more_available, second.more_available) == (True, False)
+    assert [entry.name.split("_", 1)[1] for entry in first.files + second.files] == ["file0", "file1", "file2"]
+    assert last.next_cursor == second.next_cursor
+    assert await _unseen(stored_files.db) == 0
+
+
+def test_file_created_at_is_taken_at_insert():
+    from sqlalchemy import insert
+    from sqlalchemy.dialects import postgresql, sqlite
+
+    # now() would return the start of the upload's transaction
+    stmt = insert(File).values(created_at=File.__table__.c.created_at.default.arg)
+    assert "clock_timestamp()" in str(stmt.compile(dialect=postgresql.dialect()))
+    assert "CURRENT_TIMESTAMP" in str(stmt.compile(dialect=sqlite.dialect()))
+
+
+def test_backfill_checksums(mocker, tmp_path, sqlite_admin_db):
+    import uuid
+    import zlib
+    from app.models.models import SymmetricalKey
+    from app.services.bundle_service import backfill_checksums
+
+    mocker.patch("app.services.file_storage_service.settings.FILE_PATH", str(tmp_path))
+    db, user_id, public_key_id = sqlite_admin_db
+    key = SymmetricalKey(id=uuid.uuid4(), key=b"key", public_key_id=public_key_id, nonce=b"nonce")
+    stored = File(id=uuid.uuid4(), user_id=user_id, symetrical_key_id=key.id, path="stored",
+                  file_name="stored", content_type="application/pdf")
+    missing = File(id=uuid.uuid4(), user_id=user_id, symetrical_key_id=key.id, path="missing",
+                   file_name="missing", content_type="application/pdf")
+    (tmp_path / "stored").write_bytes(b"ciphertext")
+    db.add_all([key, stored, missing])
+    db.commit()
+
+    assert backfill_checksums(db) == 1
+    assert (stored.size, stored.sha256, stored.crc32) == (
+        10, hashlib.sha256(b"ciphertext").hexdigest(), zlib.crc32(b"ciphertext")
+    )
+    assert missing.sha256 is None
+    # Files that were already hashed are not read again
+    assert backfill_checksums(db) == 0
+
+
+
+def test_manifest_entry_names_cannot_leave_the_download_folder(mocker, tmp_path):
+    import uuid
+    from app.models.models import SymmetricalKey
+    from app.services.bundle_service import manifest_entry
+
+    mocker.patch("app.services.file_storage_service.settings.FILE_PATH", str(tmp_path))
+    (tmp_path / "stored").write_bytes(b"ciphertext")
+    aes_key = SymmetricalKey(key=b"a2V5", nonce=b"\x00" * 12, public_key_id=uuid.uuid4())
+
+    names = {}
+    for file_name in ["../../.bashrc", "..\\reports\\leak 2024.pdf", "..", "plain_name-1.pdf"]:
+        file = File(id=uuid.uuid4(), path="stored", file_name=file_name, sha256="0" * 64)
+        entry = manifest_entry(file, aes_key)
+        assert entry.name.startswith(f"{file.id}_")
+        names[file_name] = entry.name.split("_", 1)[1]
+
+    assert names == {
+        "../../.bashrc": "bashrc",
+        "..\\reports\\leak 2024.pdf": "leak_2024.pdf",
+        "..": "file",
+        "plain_name-1.pdf": "plain_name-1.pdf",
+    }
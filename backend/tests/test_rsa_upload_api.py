@@ -0,0 +1,96 @@
+import io
+import uuid
+
+import pytest
+from fastapi import HTTPException, UploadFile
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+from sqlalchemy import func, select
+
+from app.api.v1.rsa_upload import PublicKeyBatchRequest, PublicKeyItem, upload_public_key_batch, upload_public_keys
+from app.models.models import PublicKey, User
+
+
+def _public_pem(private_key=None):
+    private_key = private_key or rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode()
+
+
+@pytest.mark.anyio
+async def test_batch_upload_reports_each_key(sqlite_db):
+    from sqlalchemy import event, func, select
+
+    db, _, existing_id = sqlite_db
+    admin = User(id=uuid.uuid4(), passphrase_hash="salt$hash", is_admin=True)
+    new_ids = [uuid.uuid4(), uuid.uuid4()]
+    invalid_id = uuid.uuid4()
+    request = PublicKeyBatchRequest(keys=[
+        PublicKeyItem(id=new_ids[0], pem=_public_pem()),
+        PublicKeyItem(id=invalid_id, pem="not a key"),
+        PublicKeyItem(id=existing_id, pem=_public_pem()),
+        PublicKeyItem(id=new_ids[1], pem=_public_pem()),
+    ])
+
+    statements = []
+    event.listen(db.bind.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    response = await upload_public_key_batch(request, current_user=admin, db=db)
+
+    assert [(result.id, result.status) for result in response.results] == [
+        (new_ids[0], "created"), (invalid_id, "invalid"), (existing_id, "exists"), (new_ids[1], "created")
+    ]
+    # One lookup and one insert for the whole batch
+    assert len(statements) == 2
+    stored = select(func.count()).select_from(PublicKey).where(PublicKey.id.in_(new_ids), PublicKey.active == True)
+    assert await db.scalar(stored) == 2
+    assert await db.get(PublicKey, invalid_id) is None
+
+    # Sending the same batch again changes nothing
+    response = await upload_public_key_batch(request, current_user=admin, db=db)
+    assert [result.status for result in response.results] == ["exists", "invalid", "exists", "exists"]
+
+
+@pytest.mark.anyio
+async def test_single_upload_caches_key_only_once_stored(mocker, sqlite_db):
+    from app.core.key_cache import PublicKeyCache
+
+    cache = mocker.patch("app.api.v1.rsa_upload.public_key_cache", PublicKeyCache(8))
+    db, _, existing_id = sqlite_db
+    admin = User(id=uuid.uuid4(), passphrase_hash="salt$hash", is_admin=True)
+
+    def pem_file():
+        return UploadFile(file=io.BytesIO(_public_pem().encode()), filename="key.pem",
+                          headers={"content-type": "application/x-pem-file"})
+
+    # The ID is taken, the commit fails and nothing is cached
+    with pytest.raises(HTTPException) as e:
+        await upload_public_keys(existing_id, file=pem_file(), current_user=admin, db=db)
+    assert e.value.status_code == 409
+    assert len(cache) == 0
+
+    await upload_public_keys(uuid.uuid4(), file=pem_file(), current_user=admin, db=db)
+    assert len(cache) == 1
+
+
+@pytest.mark.anyio
+async def test_upload_rejects_keys_that_cannot_wrap_aes_keys(sqlite_db):
+    db, _, _ = sqlite_db
+    admin = User(id=uuid.uuid4(), passphrase_hash="salt$hash", is_admin=True)
+    ec_pem = _public_pem(ec.generate_private_key(ec.SECP256R1()))
+    short_pem = _public_pem(rsa.generate_private_key(public_exponent=65537, key_size=1024))
+    request = PublicKeyBatchRequest(keys=[PublicKeyItem(id=uuid.uuid4(), pem=ec_pem),
+                                          PublicKeyItem(id=uuid.uuid4(), pem=short_pem)])
+
+    response = await upload_public_key_batch(request, current_user=admin, db=db)
+    assert [result.status for result in response.results] == ["invalid", "invalid"]
+
+    ec_file = UploadFile(file=io.BytesIO(ec_pem.encode()), filename="key.pem",
+                         headers={"content-type": "application/x-pem-file"})
+    with pytest.raises(HTTPException) as e:
+        await upload_public_keys(uuid.uuid4(), file=ec_file, current_user=admin, db=db)
+    assert e.value.status_code == 400
+    assert await db.scalar(select(func.count()).select_from(PublicKey)) == 1
+
@@ -3,19 +3,26 @@ import pytest
 from fastapi import UploadFile
 from fastapi.testclient import TestClient
 
-from app.services.file_upload_service import encrypt_pdf, save_encrypted_file, save_aesgcm_key
 from main import app
 import uuid
 import io
 import os
+import asyncio
+import hashlib
+import zlib
+
+from sqlalchemy import func, select
 
 client = TestClient(app)
 
 
+async def _count(db, model, *conditions):
+    return await db.scalar(select(func.count()).select_from(model).where(*conditions))
+
+
 def test_upload_endpoint(mocker):
     # Mock für Datenbankfunktionen
-    mocker.patch("app.services.file_upload_service.save_encrypted_file", return_value=uuid.uuid4())
-    mocker.patch("app.services.file_upload_service.save_aesgcm_key")
+    mocker.patch("app.api.v1.upload.save_upload", return_value=uuid.uuid4())
 
     # Testdatei erstellen
     test_file = io.BytesIO(b"Test PDF content")
@@ -31,78 +38,10 @@ def test_upload_endpoint(mocker):
     assert response.json() == {"message": "success"}
 
 
-# Einheitentests
-def test_encrypt_pdf():
-    # Testdatei erstellen
-    test_content = b"Test PDF content"
-    test_file = io.BytesIO(test_content)
-    test_file.filename = "test_encrypt.pdf"
-
-    file = UploadFile(file=test_file, filename="test_encrypt.pdf")
-
-    # Funktion aufrufen
-    result = encrypt_pdf(file)
-
-    # Überprüfungen
-    assert result.file_name == "test_encrypt.pdf"
-    assert isinstance(result.ciphertext, bytes)
-    assert len(result.ciphertext) > 0
-    assert isinstance(result.nonce, bytes)
-    assert len(result.nonce) == 12
-    assert isinstance(result.key, bytes)
-    assert len(result.key) == 32  # 256 Bit = 32 Bytes
-
-
-def test_save_encrypted_file(mocker):
-    # Mock für Datenbankoperationen
-    mock_db = mocker.MagicMock()
-    mock_db.commit = mocker.MagicMock()
-    mock_db.refresh = mocker.MagicMock()
-    mock_db.add = mocker.MagicMock()
-
-    # Mock für den Dateisystemzugriff
-    mocker.patch("os.makedirs")
-    mock_open = mocker.patch("builtins.open", mocker.mock_open())
-    mocker.patch("os.path.exists", return_value=False)
-
-    # Mock für die Benutzereinführung
-    mocker.patch("app.services.file_upload_service.insert_random_user", return_value=uuid.uuid4())
-
-    # Funktion aufrufen
-    file_id = save_encrypted_file(mock_db, "test_file.pdf", b"encrypted_content", uuid.uuid4())
-
-    # Überprüfungen
-    assert isinstance(file_id, uuid.UUID)
-    mock_open.assert_called_once()
-    mock_db.add.assert_called_once()
-    mock_db.commit.assert_called()
-
-
-def test_save_aesgcm_key(mocker):
-    # Mock für Datenbankoperationen
-    mock_db = mocker.MagicMock()
-    mock_db.commit = mocker.MagicMock()
-    mock_db.refresh = mocker.MagicMock()
-    mock_db.add = mocker.MagicMock()
-
-    # Testdaten
-    test_key = os.urandom(32)
-    test_file_id = uuid.uuid4()
-    test_nonce = os.urandom(12)
-
-    # Funktion aufrufen
-    save_aesgcm_key(mock_db, test_key, test_file_id, test_nonce)
-
-    # Überprüfungen
-    mock_db.add.assert_called_once()
-    mock_db.commit.assert_called_once()
-
-
 # Edge Cases
 def test_upload_empty_file(mocker):
     # Mocks konfigurieren
-    mocker.patch("app.services.file_upload_service.save_encrypted_file", return_value=uuid.uuid4())
-    mocker.patch("app.services.file_upload_service.save_aesgcm_key")
+    mocker.patch("app.api.v1.upload.save_upload", return_value=uuid.uuid4())
 
     # Leere Datei erstellen
     empty_file = io.BytesIO(b"")
@@ -130,23 +69,24 @@ def test_upload_unsupported_file_type(mocker):
     assert response.status_code == 415
 
 
-def test_upload_duplicate_filename(mocker):
-    # Mocks für Datei-Existenz (simuliert bereits existierende Datei)
-    mocker.patch("os.path.exists",
-                 side_effect=[True, False])  # Erster Aufruf: Datei existiert, zweiter Aufruf: Datei existiert nicht
-    mocker.patch("os.makedirs")
-    mock_open = mocker.patch("builtins.open", mocker.mock_open())
+@pytest.mark.anyio
+async def test_upload_duplicate_filename(mocker, tmp_path, sqlite_db):
+    from app.models.models import File
+    from app.services.file_upload_service import save_upload
 
-    # Datenbankoperationen mocken
-    mock_db = mocker.MagicMock()
-    file_id = uuid.uuid4()
-    mocker.patch("app.services.file_upload_service.insert_random_user", return_value=uuid.uuid4())
+    # Storage paths come from the file ID, equal names no longer collide
+    mocker.patch("app.services.file_upload_service.settings.FILE_PATH", str(tmp_path))
+    db, user_id, public_key_id = sqlite_db
+    stored = []
+    for _ in range(2):
+        staged = tmp_path / ".upload-test"
+        staged.write_bytes(b"content")
+        file_id = await save_upload(db, str(staged), "duplicate.pdf", user_id, b"key", public_key_id, os.urandom(12))
+        stored.append(await db.get(File, file_id))
 
-    # Funktion direkt aufrufen
-    result = save_encrypted_file(mock_db, "duplicate.pdf", b"content")
-
-    # Überprüfen, ob die Datei mit einem geänderten Namen gespeichert wurde
-    assert "_1" in mock_open.call_args[0][0]
+    assert stored[0].path != stored[1].path
+    assert stored[0].file_name == stored[1].file_name == "duplicate_encrypted"
+    assert stored[0].path == f"{stored[0].id.hex[:2]}/{stored[0].id.hex[2:4]}/{stored[0].id.hex}"
 
 
 def test_upload_no_file():
@@ -154,4 +94,260 @@ def test_upload_no_file():
     response = client.post("/api/v1/upload/")
 
     # Überprüfungen
-    assert response.status_code != 200  # Sollte einen Fehler zurückgeben
\ No newline at end of file
+    assert response.status_code != 200  # Sollte einen Fehler zurückgeben
+
+def test_stream_cipher_round_trip():
+    from app.core.stream_cipher import encrypt_stream, decrypt_stream
+
+    key = os.urandom(32)
+    nonce = os.urandom(12)
+    # Empty, exactly one segment, and a partial trailing segment
+    for plaintext in (b"", os.urandom(64), os.urandom(200)):
+        container = io.BytesIO()
+        encrypt_stream(key, nonce, io.BytesIO(plaintext), container, 64)
+
+        output = io.BytesIO()
+        container.seek(0)
+        decrypt_stream(key, nonce, container, output)
+        assert output.getvalue() == plaintext
+
+
+def test_stream_cipher_rejects_truncation():
+    from cryptography.exceptions import InvalidTag
+    from app.core.stream_cipher import encrypt_stream, decrypt_stream
+
+    key = os.urandom(32)
+    nonce = os.urandom(12)
+    container = io.BytesIO()
+    encrypt_stream(key, nonce, io.BytesIO(os.urandom(200)), container, 64)
+
+    # Dropping the final segment must not decrypt to a shorter file
+    truncated = io.BytesIO(container.getvalue()[:-(200 - 3 * 64 + 16)])
+    with pytest.raises(InvalidTag):
+        decrypt_stream(key, nonce, truncated, io.BytesIO())
+
+
+def test_sanitize_and_encrypt(tmp_path):
+    from PyPDF2 import PdfWriter
+    from app.core.stream_cipher import decrypt_stream
+    from app.services.file_upload_service import sanitize_and_encrypt
+
+    pdf = PdfWriter()
+    pdf.add_blank_page(width=72, height=72)
+    pdf.add_metadata({"/Author": "Jane Whistle"})
+    pdf_bytes = io.BytesIO()
+    pdf.write(pdf_bytes)
+    pdf_bytes.seek(0)
+
+    output_path = tmp_path / "upload"
+    result = sanitize_and_encrypt(pdf_bytes, "leak.pdf", str(output_path))
+
+    assert result.file_name == "leak.pdf"
+    assert result.size == output_path.stat().st_size
+    assert result.sha256 == hashlib.sha256(output_path.read_bytes()).hexdigest()
+    assert result.crc32 == zlib.crc32(output_path.read_bytes())
+    plaintext = io.BytesIO()
+    with open(output_path, "rb") as f:
+        decrypt_stream(result.key, result.nonce, f, plaintext)
+    assert plaintext.getvalue().startswith(b"%PDF")
+    assert b"Jane Whistle" not in plaintext.getvalue()
+
+
+def test_run_in_pool_returns_result():
+    import asyncio
+    from app.core.workers import run_in_pool
+
+    assert asyncio.run(run_in_pool(pow, 2, 10)) == 1024
+
+
+def test_run_in_pool_rejects_when_queue_full(mocker):
+    import asyncio
+    import threading
+    from app.core.exceptions import ServiceUnavailableError
+
+    mocker.patch("app.core.workers._slots", threading.BoundedSemaphore(1))
+    from app.core import workers
+    workers._slots.acquire()
+
+    with pytest.raises(ServiceUnavailableError):
+        asyncio.run(workers.run_in_pool(pow, 2, 10))
+
+
+@pytest.mark.anyio
+async def test_key_allocator_hands_out_each_key_once(sqlite_db):
+    from app.core.exceptions import NoPublicKeyAvailable
+    from app.models.models import PublicKey
+    from app.services.key_allocator import PublicKeyAllocator
+
+    db, _, _ = sqlite_db
+    db.add_all([PublicKey(id=uuid.uuid4(), active=True, key=b"pem") for _ in range(2)])
+    await db.commit()
+
+    allocator = PublicKeyAllocator(prefetch=2)
+    claimed = [(await allocator.claim(db)).id for _ in range(3)]
+
+    assert len(set(claimed)) == 3
+    assert await _count(db, PublicKey, PublicKey.active == True) == 0
+    with pytest.raises(NoPublicKeyAvailable):
+        await allocator.claim(db)
+
+
+def test_public_key_cache_parses_once_and_evicts_on_use(mocker):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from app.core import key_cache
+    from app.services.file_upload_service import wrap_aes_key
+
+    pem = rsa.generate_private_key(public_exponent=65537, key_size=2048).public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    key_id = uuid.uuid4()
+    key_cache.public_key_cache.warm(key_id, pem)
+
+    load = mocker.spy(key_cache, "load_pem_public_key")
+    assert wrap_aes_key(key_id, pem, os.urandom(32))
+    load.assert_not_called()
+    # Consumed keys are gone, a second use would have to parse again
+    wrap_aes_key(key_id, pem, os.urandom(32))
+    load.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_save_upload_commits_once_after_move(mocker, tmp_path, sqlite_db):
+    from app.models.models import File, SymmetricalKey
+    from app.services.file_storage_service import resolve_path
+    from app.services.file_upload_service import save_upload
+
+    mocker.patch("app.services.file_upload_service.settings.FILE_PATH", str(tmp_path))
+    db, user_id, public_key_id = sqlite_db
+    staged = tmp_path / ".upload-test"
+    staged.write_bytes(b"ciphertext")
+    commit = mocker.spy(db, "commit")
+
+    file_id = await save_upload(db, str(staged), "leak.pdf", user_id, b"key", public_key_id, os.urandom(12))
+
+    commit.assert_called_once()
+    stored = await db.get(File, file_id)
+    assert not staged.exists()
+    assert open(resolve_path(stored.path), "rb").read() == b"ciphertext"
+    assert await _count(db, SymmetricalKey) == 1
+
+
+@pytest.mark.anyio
+async def test_save_upload_rolls_back_when_move_fails(mocker, tmp_path, sqlite_db):
+    from app.models.models import File, SymmetricalKey
+    from app.services.file_upload_service import save_upload
+
+    mocker.patch("app.services.file_upload_service.settings.FILE_PATH", str(tmp_path))
+    mocker.patch("app.services.file_upload_service.os.replace", side_effect=OSError("disk full"))
+    db, user_id, public_key_id = sqlite_db
+    staged = tmp_path / ".upload-test"
+    staged.write_bytes(b"ciphertext")
+
+    with pytest.raises(OSError):
+        await save_upload(db, str(staged), "leak.pdf", user_id, b"key", public_key_id, os.urandom(12))
+
+    assert await _count(db, File) == 0
+    assert await _count(db, SymmetricalKey) == 0
+
+
+def test_migrate_storage_layout(mocker, tmp_path, sqlite_admin_db):
+    from app.models.models import File, SymmetricalKey
+    from app.services.file_storage_service import migrate_storage_layout, resolve_path, storage_key
+
+    mocker.patch("app.services.file_storage_service.settings.FILE_PATH", str(tmp_path))
+    db, user_id, public_key_id = sqlite_admin_db
+    key = SymmetricalKey(id=uuid.uuid4(), key=b"key", public_key_id=public_key_id, nonce=b"nonce")
+    legacy_path = tmp_path / "leak_encrypted"
+    legacy_path.write_bytes(b"ciphertext")
+    file = File(id=uuid.uuid4(), user_id=user_id, symetrical_key_id=key.id, path=str(legacy_path),
+                file_name="leak_encrypted", content_type="application/pdf", seen=False)
+    db.add_all([key, file])
+    db.commit()
+
+    assert migrate_storage_layout(db) == 1
+    assert migrate_storage_layout(db) == 0
+
+    db.refresh(file)
+    assert file.path == storage_key(file.id)
+    assert open(resolve_path(file.path), "rb").read() == b"ciphertext"
+    assert not legacy_path.exists()
+
+
+@pytest.mark.anyio
+async def test_get_files_pages_newest_first(sqlite_db):
+    from datetime import datetime, timedelta
+    from fastapi import Response
+    from app.api.v1.upload import get_files
+    from app.models.models import File, SymmetricalKey, User
+
+    db, user_id, public_key_id = sqlite_db
+    key = SymmetricalKey(id=uuid.uuid4(), key=b"key", public_key_id=public_key_id, nonce=b"nonce")
+    start = datetime(2025, 1, 1)
+    files = [
+        File(id=uuid.uuid4(), user_id=user_id, symetrical_key_id=key.id, path=f"f{i}", file_name=f"leak{i}.pdf",
+             content_type="application/pdf", seen=i == 0, created_at=start + timedelta(minutes=i))
+        for i in range(5)
+    ]
+    db.add_all([key, *files])
+    await db.commit()
+    user = await db.get(User, user_id)
+
+    listed = []
+    cursor = None
+    while True:
+        response = Response()
+        page = await get_files(response=response, cursor=cursor, limit=2, db=db, current_user=user)
+        listed += page
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+
+    assert [entry.file_name for entry in listed] == [f"leak{i}.pdf" for i in reversed(range(5))]
+    assert listed[-1].seen and not listed[0].seen
+    assert set(type(listed[0]).model_fields) == {"id", "file_name", "created_at", "seen"}
+
+
+def test_upload_rejects_files_above_size_limit(mocker):
+    from app.api.v1.upload import upload_file
+    from app.core.exceptions import FileTooLarge
+    from app.core.user_cache import AuthenticatedUser
+
+    mocker.patch("app.api.v1.upload.settings.MAX_UPLOAD_SIZE", 16)
+    run_in_pool = mocker.patch("app.api.v1.upload.run_in_pool")
+    file = UploadFile(file=io.BytesIO(b"%PDF" + b"0" * 16), filename="big.pdf",
+                      headers={"content-type": "application/pdf"})
+
+    with pytest.raises(FileTooLarge):
+        asyncio.run(upload_file(file=file, current_user=AuthenticatedUser(id=uuid.uuid4(), is_admin=False),
+                                db=mocker.MagicMock()))
+    run_in_pool.assert_not_called()
+
+
+def test_sanitize_and_encrypt_reads_staged_copy(tmp_path):
+    from PyPDF2 import PdfWriter
+    from app.services.file_upload_service import sanitize_and_encrypt, stage_upload_source
+
+    pdf = PdfWriter()
+    pdf.add_blank_page(width=72, height=72)
+    upload = io.BytesIO()
+    pdf.write(upload)
+
+    # Process pool jobs get a path to a copy instead of the upload's bytes
+    source_path = stage_upload_source(upload)
+    try:
+        assert open(source_path, "rb").read() == upload.getvalue()
+        result = sanitize_and_encrypt(source_path, "leak.pdf", str(tmp_path / "upload"))
+    finally:
+        os.remove(source_path)
+    assert result.size == (tmp_path / "upload").stat().st_size
+
+
+def test_stored_file_name_drops_path_components():
+    from app.services.file_upload_service import _stored_file_name
+
+    assert _stored_file_name("report.final.pdf") == "report_encrypted"
+    assert _stored_file_name("../../etc/passwd") == "passwd_encrypted"
+    assert _stored_file_name("C:\\Users\\me\\Leak (1).pdf") == "Leak__1__encrypted"
+    assert _stored_file_name(".pdf") == "pdf_encrypted"
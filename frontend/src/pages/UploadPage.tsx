@@ -7,6 +7,12 @@ const UploadPage: React.FC = () => {
   const [uploadSuccess, setUploadSuccess] = useState(false);
   const [uploadError, setUploadError] = useState<string | null>(null);
   const [files, setFiles] = useState<any[]>([]);
+  // Cursor der nächsten, älteren Seite; null wenn alle Dateien geladen sind
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [loadingMore, setLoadingMore] = useState(false);
+  // Aktuelle Liste für das Polling, dessen Callback beim ersten Rendern erstellt wird
+  const filesRef = useRef<any[]>([]);
+  filesRef.current = files;
   const fileInputRef = useRef<HTMLInputElement>(null);
   // Neue Zustände für den Löschdialog
   const [showDeleteDialog, setShowDeleteDialog] = useState(false);
@@ -28,26 +34,54 @@ const UploadPage: React.FC = () => {
     };
   }, []);
 
+  const fetchFilePage = async (cursor: string | null) => {
+    const token = window.__WHISTLEDROP_AUTH_TOKEN__;
+    const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+    const response = await fetch(`/api/v1/upload/${query}`, {
+      headers: {
+        'Authorization': `Bearer ${token}`
+      }
+    });
+
+    if (!response.ok) {
+      throw new Error('Error fetching files');
+    }
+
+    const page: any[] = await response.json();
+    return { page, cursor: response.headers.get('X-Next-Cursor') };
+  };
+
   const fetchUploadedFiles = async () => {
     try {
-      const token = window.__WHISTLEDROP_AUTH_TOKEN__;
-      const response = await fetch('/api/v1/upload/', {
-        headers: {
-          'Authorization': `Bearer ${token}`
-        }
-      });
-      
-      if (!response.ok) {
-        throw new Error('Error fetching files');
+      // Nur die neueste Seite wird aktualisiert, bereits nachgeladene ältere Dateien bleiben erhalten
+      const { page, cursor } = await fetchFilePage(null);
+      const current = filesRef.current;
+      const last = cursor ? current.findIndex(file => file.id === page[page.length - 1].id) : -1;
+      if (last >= 0 && last + 1 < current.length) {
+        setFiles([...page, ...current.slice(last + 1)]);
+      } else {
+        setFiles(page);
+        setNextCursor(cursor);
       }
-      
-      const data = await response.json();
-      setFiles(data);
     } catch (err) {
       console.error('Error:', err);
     }
   };
 
+  const loadMoreFiles = async () => {
+    if (!nextCursor) return;
+    setLoadingMore(true);
+    try {
+      const { page, cursor } = await fetchFilePage(nextCursor);
+      setFiles(prev => [...prev, ...page]);
+      setNextCursor(cursor);
+    } catch (err) {
+      console.error('Error:', err);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const handleFileChange = (e: React.ChangeEvent<HTMLInputElement>) => {
     if (e.target.files && e.target.files[0]) {
       setSelectedFile(e.target.files[0]);
@@ -504,6 +538,14 @@ const UploadPage: React.FC = () => {
             Did not find any uploaded files.
           </p>
         )}
+
+        {nextCursor && (
+          <div style={{ textAlign: 'center', marginTop: '1rem' }}>
+            <Button onClick={loadMoreFiles} disabled={loadingMore}>
+              {loadingMore ? 'Loading...' : 'Load older files'}
+            </Button>
+          </div>
+        )}
       </div>
 
       {/* Lösch-Bestätigungsdialog */}
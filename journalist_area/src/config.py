@@ -1,6 +1,26 @@
 import os
+import re
 import configparser
 
+# Same whitelist the server applies to uploaded file names
+UNSAFE_NAME_CHARACTERS = re.compile(r"[^A-Za-z0-9._-]")
+MAX_NAME_LENGTH = 255
+
+def safe_file_name(name, fallback="file"):
+    """
+    Reduces a name taken from a bundle manifest to a single, harmless path component.
+
+    Args:
+        name (str): Name as listed by the server
+        fallback (str, optional): Name used when nothing usable remains. Defaults to "file".
+
+    Returns:
+        str: File name without any directory part
+    """
+    name = os.path.basename(name.replace("\\", "/"))
+    name = UNSAFE_NAME_CHARACTERS.sub("_", name).lstrip(".")
+    return name[:MAX_NAME_LENGTH] or fallback
+
 def add_onion_to_config(onion, config_file_path, section="Tor", key="Onion"):
     """
     Adds or updates a URL in an INI configuration file.
@@ -3,39 +3,79 @@ import sqlite3
 import argparse
 import glob
 import json
+import struct
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.serialization import load_pem_private_key
 from base64 import b64decode
 import shutil
+import tempfile
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+import queue
+import threading
+from src.config import safe_file_name
 
 DATABASE_PATH = "./meine_datenbank.db"
 DEFAULT_INPUT_DIR = "./downloads"
 DEFAULT_OUTPUT_DIR = "./decrypted_files"
 
-def load_private_key_from_db(public_key_id):
-    """Loads the private key from the database based on the ID."""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT private_key FROM schluesselpaare 
-        WHERE id = ?
-    """, (public_key_id,))
-    
-    result = cursor.fetchone()
-    conn.close()
+# Bound parameters per key query, SQLite allows 999 in older versions
+QUERY_BATCH_SIZE = 500
+
+# Downloaded files waiting for a free decryption worker
+PIPELINE_QUEUE_SIZE = 16
+
+# Private keys of the jobs a worker is running, PEM data by public key ID and keys parsed so far
+_private_key_pems = {}
+_private_keys = {}
+
+# Outcome of decrypting one file, output_path is None and error is set on failure
+DecryptResult = namedtuple("DecryptResult", ["name", "output_path", "error"])
+
+# Chunked AES-GCM container written by the server (see backend app/core/stream_cipher.py)
+STREAM_MAGIC = b"WDSTREAM"
+STREAM_VERSION = 1
+STREAM_HEADER = struct.Struct(">8sBI")
+TAG_SIZE = 16
+CHUNK_SIZE = 64 * 1024  # Read buffer for files in the single message format
 
-    if not result:
-        raise ValueError(f"No private key found for ID {public_key_id}!")
+def load_private_keys_from_db(public_key_ids=None):
+    """Loads the PEM private keys for all given IDs, or all keys, over one connection."""
+    private_keys = {}
     
-    private_key_pem = result[0]
-    private_key = load_pem_private_key(
-        private_key_pem,
-        password=None
-    )
+    conn = sqlite3.connect(DATABASE_PATH)
+    try:
+        cursor = conn.cursor()
+        if public_key_ids is None:
+            cursor.execute("SELECT id, private_key FROM schluesselpaare")
+            return dict(cursor.fetchall())
+        
+        public_key_ids = list(dict.fromkeys(public_key_ids))
+        # Stay below SQLite's limit of bound parameters per statement
+        for start in range(0, len(public_key_ids), QUERY_BATCH_SIZE):
+            batch = public_key_ids[start:start + QUERY_BATCH_SIZE]
+            cursor.execute(f"""
+                SELECT id, private_key FROM schluesselpaare 
+                WHERE id IN ({", ".join("?" * len(batch))})
+            """, batch)
+            private_keys.update(cursor.fetchall())
+    finally:
+        conn.close()
     
+    return private_keys
+
+def get_private_key(public_key_id):
+    """Returns the private key for an ID, parsing every PEM at most once per process."""
+    private_key = _private_keys.get(public_key_id)
+    if private_key is None:
+        private_key_pem = _private_key_pems.get(public_key_id)
+        if private_key_pem is None:
+            raise ValueError(f"No private key found for ID {public_key_id}!")
+        private_key = load_pem_private_key(private_key_pem, password=None)
+        _private_keys[public_key_id] = private_key
     return private_key
 
 
@@ -67,111 +107,225 @@ def decrypt_aes_key(encrypted_key, private_key):
         print(f"Error decrypting AES key: {e}")
         raise
 
+def segment_nonce(nonce, index, last):
+    """Derives the nonce of one segment of a chunked container."""
+    return nonce[:7] + struct.pack(">IB", index, 1 if last else 0)
+
+def decrypt_segments(aesgcm, nonce, header, source, destination):
+    """Decrypts the segments of a chunked container one by one."""
+    _, version, segment_size = STREAM_HEADER.unpack(header)
+    if version != STREAM_VERSION:
+        raise ValueError(f"Unsupported container version {version}")
+
+    segment_length = segment_size + TAG_SIZE
+    index = 0
+    segment = source.read(segment_length)
+    while True:
+        if len(segment) < TAG_SIZE:
+            raise ValueError("Encrypted file is truncated")
+        # The final segment is flagged in its nonce, so look one segment ahead
+        next_segment = source.read(segment_length)
+        last = not next_segment
+        destination.write(aesgcm.decrypt(segment_nonce(nonce, index, last), segment, header))
+        if last:
+            return
+        segment = next_segment
+        index += 1
+
+def decrypt_message(aes_key, nonce, source, size, destination):
+    """Decrypts a file that is a single AES-GCM message through a fixed size buffer."""
+    if size < TAG_SIZE:
+        raise ValueError("Encrypted file is truncated")
+
+    # The tag is appended to the ciphertext, it is needed before decryption starts
+    source.seek(size - TAG_SIZE)
+    tag = source.read(TAG_SIZE)
+    source.seek(0)
+
+    decryptor = Cipher(algorithms.AES(aes_key), modes.GCM(nonce, tag)).decryptor()
+    remaining = size - TAG_SIZE
+    while remaining:
+        chunk = source.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            raise ValueError("Encrypted file is truncated")
+        remaining -= len(chunk)
+        destination.write(decryptor.update(chunk))
+    # Raises InvalidTag if the file was modified
+    decryptor.finalize()
+
 def decrypt_file(encrypted_file_path, aes_key, nonce, output_file_path):
-    """Decrypts a file with AES-GCM."""
+    """Decrypts a file with AES-GCM, either chunked or in one piece, with bounded memory. Raises on failure."""
+    # Plaintext goes to a temporary file and only reaches the output path once it is authenticated
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(output_file_path) or ".", prefix=".decrypt-")
     try:
-        # Read the encrypted file
-        with open(encrypted_file_path , 'rb') as file:
-            encrypted_data = file.read()
+        with open(encrypted_file_path, 'rb') as file, os.fdopen(fd, 'wb') as output:
+            header = file.read(STREAM_HEADER.size)
+
+            if header.startswith(STREAM_MAGIC):
+                decrypt_segments(AESGCM(aes_key), nonce, header, file, output)
+            else:
+                # Files uploaded before the chunked format are one AES-GCM message
+                decrypt_message(aes_key, nonce, file, os.fstat(file.fileno()).st_size, output)
+
+        os.replace(temp_path, output_file_path)
+        return True
+    except Exception:
+        # Never leave unauthenticated output behind
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def decrypt_entry(entry, input_dir, output_dir):
+    """Decrypts the file of one manifest entry. Runs in a worker process and never raises."""
+    filename = entry["name"]
+    try:
+        # Same name the download wrote the file under
+        stored_name = safe_file_name(filename)
+        file_path = os.path.join(input_dir, stored_name)
+        if not os.path.exists(file_path):
+            return DecryptResult(filename, None, "Encrypted file not found")
         
-        # Decrypt with AES-GCM
-        aesgcm = AESGCM(aes_key)
-        decrypted_data = aesgcm.decrypt(nonce, encrypted_data, None)
+        private_key = get_private_key(entry["public_key_id"])
+
+        # Decrypt the AES key
+        aes_key = decrypt_aes_key(entry["encrypted_key"], private_key)
+        nonce = b64decode(entry["nonce"])
+        # Create the output path
+        original_filename = safe_file_name(stored_name.split('_', 1)[-1])
+        output_file_path = os.path.join(output_dir, original_filename) + ".pdf"
         
-        # Write the decrypted file
-        with open(output_file_path, 'wb') as file:
-            file.write(decrypted_data)
-            
-        return True
+        # Decrypt the file
+        decrypt_file(file_path, aes_key, nonce, output_file_path)
+        return DecryptResult(filename, output_file_path, None)
     except Exception as e:
-        print(f"Error decrypting {encrypted_file_path}: {str(e)}")
-        return False
+        return DecryptResult(filename, None, error_message(e))
 
-def process_files(input_dir, output_dir):
-    """Processes all files in the input directory."""
-    # Ensure the output directory exists
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Find all file pairs (file and associated key_info.txt)
-    success_count = 0
-    error_count = 0
-    
-    # Collect all files without the key_info.txt files
-    files = [f for f in os.listdir(input_dir) 
-             if os.path.isfile(os.path.join(input_dir, f)) and not f.endswith('_key_info.txt')]
-    
-    for filename in files:
-        try:
-            file_path = os.path.join(input_dir, filename)
-            file_id = filename.split('_')[0]  # Extract the file ID
-            key_info_path = os.path.join(input_dir, f"{file_id}_key_info.txt")
-            
-            if not os.path.exists(key_info_path):
-                print(f"Key info for {filename} not found!")
-                error_count += 1
-                continue
-            
-            # Read the key info
-            with open(key_info_path, 'r') as key_file:
-                key_info = key_file.read()
-            
-            # Extract encrypted key and Public Key ID
-            key_lines = key_info.split('\n')
-            encrypted_key = key_lines[0].replace("Encrypted Key: ", "")
-            nonce = key_lines[1].replace("Nonce: ", "")
-            public_key_id = key_lines[2].replace("Public Key ID: ", "")
-            # Here begins the special part for SQLite
-            # Load the private key
-            private_key = load_private_key_from_db(public_key_id)
-
-            # Safe alternative to eval() for strings containing Python literals
-            import ast
-            try:
-                encrypted_key = ast.literal_eval(encrypted_key)
-                nonce = ast.literal_eval(nonce)
-            except (ValueError, SyntaxError) as e:
-                print(f"Error parsing key data: {e}")
-                raise
-
-            # Decrypt the AES key
-            aes_key = decrypt_aes_key(encrypted_key, private_key)
-            print(f"Decrypted AES key: {aes_key}")
-            # Create the output path
-            original_filename = '_'.join(filename.split('_')[1:])
-            output_file_path = os.path.join(output_dir, original_filename)
-            
-            # Decrypt the file
-            if decrypt_file(file_path, aes_key, nonce, output_file_path + ".pdf"):
-                success_count += 1
-                print(f"File successfully decrypted: {output_file_path}")
-            else:
-                error_count += 1
-        
-        except Exception as e:
-            print(f"Error processing {filename}: {str(e)}")
-            error_count += 1
+def decrypt_entry_with_key(entry, private_key_pem, input_dir, output_dir):
+    """Decrypts one entry with the private key sent along with it. The worker forgets the key afterwards."""
+    public_key_id = entry["public_key_id"]
+    if private_key_pem is not None:
+        _private_key_pems[public_key_id] = private_key_pem
+    try:
+        return decrypt_entry(entry, input_dir, output_dir)
+    finally:
+        _private_key_pems.pop(public_key_id, None)
+        _private_keys.pop(public_key_id, None)
+
+def print_summary(results):
+    """Prints the number of decrypted files and every failure."""
+    success_count = len([result for result in results if result.error is None])
+    error_count = len(results) - success_count
     
     print(f"\nSummary:")
     print(f"Successfully decrypted: {success_count} files")
     print(f"Errors: {error_count} files")
-    return success_count, error_count
-
-def decrypt_all():
-    # parser = argparse.ArgumentParser(description="Decrypts files with RSA private keys and AES.")
-    #
-    # parser.add_argument(
-    #     "-i", "--input",
-    #     default=DEFAULT_INPUT_DIR,
-    #     help=f"Input directory with encrypted files (default: {DEFAULT_INPUT_DIR})"
-    # )
-    #
-    # parser.add_argument(
-    #     "-o", "--output",
-    #     default=DEFAULT_OUTPUT_DIR,
-    #     help=f"Output directory for decrypted files (default: {DEFAULT_OUTPUT_DIR})"
-    # )
-    #
-    # args = parser.parse_args()
-    #
-    print(f"Decrypting files from ./downloads to ./decrypted_files")
-    process_files(DEFAULT_INPUT_DIR, DEFAULT_OUTPUT_DIR)
+    for result in results:
+        if result.error is not None:
+            print(f"  {result.name}: {result.error}")
+
+class DecryptPipeline:
+    """Decrypts files while the rest of a download is still arriving."""
+
+    def __init__(self, input_dir, output_dir, jobs=1, queue_size=PIPELINE_QUEUE_SIZE):
+        os.makedirs(output_dir, exist_ok=True)
+        self._input_dir = input_dir
+        self._output_dir = output_dir
+        # Downloads block once queue_size files wait and every worker is busy
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._slots = threading.Semaphore(jobs)
+        # Name and future of every file in submission order, failed lookups get a finished future
+        self._jobs = []
+        self._submitted = 0
+        self._done = 0
+        self._lock = threading.Lock()
+        
+        # The keys of files still to come are not known yet. Each job carries the
+        # one key it needs, so no worker ever holds keys of other files.
+        self._executor = ProcessPoolExecutor(max_workers=jobs)
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, entry):
+        """Queues the manifest entry of a file that is complete on disk."""
+        with self._lock:
+            self._submitted += 1
+        self._queue.put(entry)
+
+    def _dispatch(self):
+        # Runs until close, a failing batch only fails its own files
+        while (entries := self._next_entries()):
+            try:
+                # One key lookup for every file that is waiting
+                private_key_pems = load_private_keys_from_db(entry["public_key_id"] for entry in entries)
+            except Exception as e:
+                for entry in entries:
+                    self._fail(entry["name"], f"Loading the private key failed: {error_message(e)}")
+                continue
+            for entry in entries:
+                self._slots.acquire()
+                try:
+                    future = self._executor.submit(decrypt_entry_with_key, entry,
+                                                   private_key_pems.get(entry["public_key_id"]),
+                                                   self._input_dir, self._output_dir)
+                except Exception as e:
+                    self._slots.release()
+                    self._fail(entry["name"], error_message(e))
+                    continue
+                self._jobs.append((entry["name"], future))
+                future.add_done_callback(lambda future, name=entry["name"]: self._finished(name, future))
+
+    def _next_entries(self):
+        """Waits for the next entry and takes every other one already queued, empty once closed."""
+        entries = []
+        entry = self._queue.get()
+        while entry is not None:
+            entries.append(entry)
+            try:
+                entry = self._queue.get_nowait()
+            except queue.Empty:
+                return entries
+        # Entries queued before close are still handed out, the end marker goes back for the next call
+        if entries:
+            self._queue.put(None)
+        return entries
+
+    def _fail(self, name, error):
+        """Records a file that never reached a worker."""
+        future = Future()
+        future.set_result(DecryptResult(name, None, error))
+        self._jobs.append((name, future))
+        self._report(future.result())
+
+    def _finished(self, name, future):
+        self._slots.release()
+        self._report(job_result(name, future))
+
+    def _report(self, result):
+        with self._lock:
+            self._done += 1
+            status = "ok" if result.error is None else f"failed: {result.error}"
+            print(f"[{self._done}/{self._submitted}] {result.name} {status}")
+
+    def close(self):
+        """Waits for all queued files and returns their results in submission order."""
+        self._queue.put(None)
+        self._dispatcher.join()
+        self._executor.shutdown(wait=True)
+        results = [job_result(name, future) for name, future in self._jobs]
+        print_summary(results)
+        return results
+
+def error_message(error):
+    """Describes an exception for a DecryptResult."""
+    return str(error) or type(error).__name__
+
+def job_result(name, future):
+    """Returns the result of a finished job, a worker that died counts as a failed file."""
+    error = future.exception()
+    if error is not None:
+        return DecryptResult(name, None, error_message(error))
+    return future.result()
+
+def decrypt_pipeline(jobs=1):
+    """Starts a pipeline that decrypts downloaded files from ./downloads as they are handed over."""
+    return DecryptPipeline(DEFAULT_INPUT_DIR, DEFAULT_OUTPUT_DIR, jobs=jobs)
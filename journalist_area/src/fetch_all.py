@@ -4,25 +4,29 @@ from email.feedparser import headerRE
 
 import requests
 import zipfile
-import io
-from datetime import datetime, timedelta
+import hashlib
+import json
+import queue
+import secrets
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import os.path
 from dotenv import load_dotenv
+from src.config import safe_file_name
 
 load_dotenv()
 
 DOWNLOAD_FOLDER = os.getenv("DOWNLOAD_FOLDER", "./downloads")
+FETCH_BATCH_SIZE = int(os.getenv("FETCH_BATCH_SIZE", "100"))  # Files per request
+MAX_RETRIES = int(os.getenv("FETCH_MAX_RETRIES", "5"))  # Resume attempts per bundle
+CHUNK_SIZE = 64 * 1024  # Bytes written to disk at a time
 
-CONFIG_FILE = "./config.ini"
+# Every bundle starts with a manifest, kept next to the files as <bundle>.manifest.json
+MANIFEST_NAME = "manifest.json"
+MANIFEST_SUFFIX = ".manifest.json"
 
-# Helper function for formatting date/time
-def format_datetime(dt):
-    # add one second to the datetime object
-    if isinstance(dt, datetime):
-        dt = dt + timedelta(seconds=1)
-    if dt:
-        return dt.strftime('%Y-%m-%d %H:%M:%S')
-    return None
+CONFIG_FILE = "./config.ini"
 
 # Helper function for parsing date/time strings
 def parse_datetime(dt_str):
@@ -30,19 +34,27 @@ def parse_datetime(dt_str):
         return datetime.strptime(dt_str, '%Y-%m-%d %H:%M:%S')
     return None
 
-# Read the last fetch date from the INI file
-def get_last_fetch_date():
+# Read a value of the [fetch] section from the INI file
+def get_fetch_setting(name):
     config = configparser.ConfigParser()
     
     if os.path.exists(CONFIG_FILE):
         config.read(CONFIG_FILE)
-        if 'fetch' in config and 'last_date' in config['fetch']:
-            return config['fetch']['last_date']
+        if 'fetch' in config and name in config['fetch']:
+            return config['fetch'][name]
     
     return None
 
-# Save the latest fetch date to the INI file
-def save_last_fetch_date(last_date):
+# Read the last fetch date from the INI file, written by older versions
+def get_last_fetch_date():
+    return get_fetch_setting('last_date')
+
+# Read the cursor of the last fetched batch from the INI file
+def get_last_cursor():
+    return get_fetch_setting('cursor')
+
+# Save the cursor of the last fetched batch to the INI file
+def save_last_cursor(cursor):
     config = configparser.ConfigParser()
     
     if os.path.exists(CONFIG_FILE):
@@ -51,7 +63,7 @@ def save_last_fetch_date(last_date):
     if 'fetch' not in config:
         config['fetch'] = {}
     
-    config['fetch']['last_date'] = last_date
+    config['fetch']['cursor'] = cursor
     
     with open(CONFIG_FILE, 'w') as configfile:
         config.write(configfile)
@@ -59,49 +71,309 @@ def save_last_fetch_date(last_date):
 # Ensure that the download folder exists
 os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
 
-def start_fetching(token, tor_get):
-    # Get the last fetch date
-    last_fetch_date = get_last_fetch_date()
+# Short name for a bundle, usable in file names
+def bundle_tag(bundle_id):
+    return hashlib.sha256(bundle_id.encode()).hexdigest()[:16]
+
+# The ETag a part file was downloaded under is kept next to it, so a resume
+# only appends bytes from the very same archive
+def read_part_etag(etag_path):
+    if os.path.exists(etag_path):
+        with open(etag_path) as etag_file:
+            return etag_file.read().strip() or None
+    return None
+
+def write_part_etag(etag_path, etag):
+    with open(etag_path, 'w') as etag_file:
+        etag_file.write(etag)
+
+# Download a bundle into a part file, resuming it after dropped connections
+def download_bundle(response, headers, tor_get):
+    bundle_id = response.headers["X-Bundle-Id"]
+    size = int(response.headers["Content-Length"])
+    part_path = os.path.join(DOWNLOAD_FOLDER, f".bundle-{bundle_tag(bundle_id)}.part")
+    etag_path = f"{part_path}.etag"
+    
+    # A previous run may have left part of this bundle behind. Without the ETag
+    # it was downloaded under there is no telling which archive it belongs to.
+    etag = read_part_etag(etag_path)
+    if os.path.exists(part_path) and os.path.getsize(part_path) > 0 and etag:
+        response.close()
+        response = None
+    elif os.path.exists(part_path):
+        os.remove(part_path)
     
-    # If no last fetch date is available, we set it to an early date
-    if not last_fetch_date:
-        print("No previous fetch date found. Will fetch all files.")
-        # ISO Format for the API: YYYY-MM-DD
-        fetch_date_for_api = "2000-01-01"
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            if response is None:
+                offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+                if offset == size:
+                    break
+                if offset > size:
+                    os.remove(part_path)
+                    offset = 0
+                print(f"Resuming download at {offset} of {size} bytes")
+                response = tor_get(
+                    f"/download/bundles/{bundle_id}",
+                    headers={**headers, "Range": f"bytes={offset}-", "If-Range": etag},
+                    stream=True
+                )
+                if response.status_code not in (200, 206):
+                    print(f"Error resuming download: {response.status_code} - {response.text}")
+                    return None
+            
+            # 206 continues the part file, 200 means the bundle changed and starts over
+            mode = "ab" if response.status_code == 206 else "wb"
+            if response.status_code == 200:
+                size = int(response.headers["Content-Length"])
+                etag = response.headers["ETag"]
+                # Recorded before the first byte, the part file never outlives its ETag
+                write_part_etag(etag_path, etag)
+            
+            with open(part_path, mode) as part_file:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    part_file.write(chunk)
+        except requests.exceptions.RequestException as e:
+            print(f"Download interrupted: {e}")
+        finally:
+            if response is not None:
+                response.close()
+            response = None
+        
+        if os.path.getsize(part_path) == size:
+            break
+    
+    if not os.path.exists(part_path) or os.path.getsize(part_path) != size:
+        print("Giving up on the download, it will be resumed on the next fetch")
+        return None
+    
+    if os.path.exists(etag_path):
+        os.remove(etag_path)
+    return part_path
+
+# Copy one archive member to disk, checking its digest before it replaces the target
+def extract_entry(zip_ref, entry):
+    target_path = os.path.join(DOWNLOAD_FOLDER, safe_file_name(entry["name"]))
+    fd, temp_path = tempfile.mkstemp(dir=DOWNLOAD_FOLDER, prefix=".extract-")
+    try:
+        digest = hashlib.sha256()
+        with zip_ref.open(entry["name"]) as member, os.fdopen(fd, 'wb') as output:
+            while chunk := member.read(CHUNK_SIZE):
+                digest.update(chunk)
+                output.write(chunk)
+        
+        if digest.hexdigest() != entry["sha256"]:
+            raise ValueError(f"Digest mismatch for {entry['name']}")
+        os.replace(temp_path, target_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+# Extract the files of a downloaded bundle one by one, then the manifest that describes them
+def extract_bundle(bundle_path, bundle_id, on_file=None):
+    with zipfile.ZipFile(bundle_path) as zip_ref:
+        manifest_data = zip_ref.read(MANIFEST_NAME)
+        manifest = json.loads(manifest_data)
+        
+        for entry in manifest["files"]:
+            extract_entry(zip_ref, entry)
+            if on_file:
+                on_file(entry)
+    
+    # The manifest is written last, decryption only sees files that are complete
+    manifest_path = os.path.join(DOWNLOAD_FOLDER, f"{bundle_tag(bundle_id)}{MANIFEST_SUFFIX}")
+    with open(manifest_path, 'wb') as manifest_file:
+        manifest_file.write(manifest_data)
+    return len(manifest["files"])
+
+# Query parameters for the first batch, continuing where the last fetch stopped
+def initial_fetch_params():
+    cursor = get_last_cursor()
+    params = {"limit": FETCH_BATCH_SIZE}
+    
+    if cursor:
+        print("Fetching files added since the last fetch")
+        params["cursor"] = cursor
     else:
-        # Convert the saved date to ISO format for the API
-        parsed_date = parse_datetime(last_fetch_date)
-        fetch_date_for_api = parsed_date.strftime('%Y-%m-%d')
-        print(f"Fetching files newer than {fetch_date_for_api}")
+        last_fetch_date = get_last_fetch_date()
+        if last_fetch_date:
+            # Date of a fetch made before cursors existed
+            fetch_date_for_api = parse_datetime(last_fetch_date).strftime('%Y-%m-%d')
+            print(f"Fetching files newer than {fetch_date_for_api}")
+            params["since_date"] = fetch_date_for_api
+        else:
+            print("No previous fetch found. Will fetch all files.")
+    return params
+
+# on_file is called with the manifest entry of every file once it is complete on disk
+def start_fetching(token, tor_get, on_file=None):
+    params = initial_fetch_params()
 
     headers = {
         "Authorization": f"Bearer {token}"
     }
 
-    # Send API request
-    response = tor_get(
-        f"/download/new-files/?since_date={fetch_date_for_api}",
-        headers=headers
-    )
-    
-    # Error handling
-    if response.status_code == 404:
-        print("No new files found since the specified date")
-    elif response.status_code != 200:
-        print(f"Error fetching files: {response.status_code} - {response.text}")
-    else:
-        # Extract the ZIP file
-        with zipfile.ZipFile(io.BytesIO(response.content)) as zip_ref:
-            # List of files we extract
-            file_list = zip_ref.namelist()
-            print(f"Found {len([f for f in file_list if not f.endswith('_key_info.txt')])} new file(s)")
+    total = 0
+    while True:
+        # Send API request
+        response = tor_get(
+            "/download/new-files/",
+            headers=headers,
+            params=params,
+            stream=True
+        )
+        
+        # Error handling
+        if response.status_code == 404:
+            print("No new files found")
+            break
+        elif response.status_code != 200:
+            print(f"Error fetching files: {response.status_code} - {response.text}")
+            break
+        
+        cursor = response.headers["X-Next-Cursor"]
+        bundle_id = response.headers["X-Bundle-Id"]
+        more_available = response.headers.get("X-More-Available") == "true"
+        bundle_path = download_bundle(response, headers, tor_get)
+        if bundle_path is None:
+            break
+        
+        try:
+            count = extract_bundle(bundle_path, bundle_id, on_file)
+        except (zipfile.BadZipFile, KeyError, ValueError) as e:
+            # The cursor stays put, so the batch is downloaded again next time
+            print(f"Error extracting bundle: {e}")
+            break
+        finally:
+            os.remove(bundle_path)
+        total += count
+        print(f"Found {count} new file(s)")
+        
+        # Only move on once the batch is safely on disk
+        save_last_cursor(cursor)
+        params = {"limit": FETCH_BATCH_SIZE, "cursor": cursor}
+        
+        if not more_available:
+            break
+    
+    if total:
+        print(f"All {total} file(s) have been downloaded to {DOWNLOAD_FOLDER}")
+
+# Download one listed file into a part file, resuming it and checking its digest
+def download_entry(entry, headers, circuit_get):
+    name = safe_file_name(entry["name"])
+    target_path = os.path.join(DOWNLOAD_FOLDER, name)
+    part_path = os.path.join(DOWNLOAD_FOLDER, f".{name}.part")
+    if os.path.exists(target_path):
+        # Only verified files are ever renamed to their final name
+        return True
+    
+    for attempt in range(MAX_RETRIES + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset > entry["size"]:
+            os.remove(part_path)
+            offset = 0
+        
+        if offset < entry["size"]:
+            # Stored files never change, so a partial download can always be continued
+            request_headers = dict(headers)
+            if offset:
+                request_headers["Range"] = f"bytes={offset}-"
+            response = None
+            try:
+                response = circuit_get(f"/download/{entry['id']}", headers=request_headers, stream=True)
+                if response.status_code not in (200, 206):
+                    print(f"Error downloading {name}: {response.status_code} - {response.text}")
+                    continue
+                mode = "ab" if response.status_code == 206 else "wb"
+                with open(part_path, mode) as part_file:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        part_file.write(chunk)
+            except requests.exceptions.RequestException as e:
+                print(f"Download of {name} interrupted: {e}")
+                continue
+            finally:
+                if response is not None:
+                    response.close()
+        
+        if os.path.getsize(part_path) != entry["size"]:
+            continue
+        
+        digest = hashlib.sha256()
+        with open(part_path, "rb") as part_file:
+            while chunk := part_file.read(CHUNK_SIZE):
+                digest.update(chunk)
+        if digest.hexdigest() != entry["sha256"]:
+            print(f"Digest mismatch for {name}, downloading it again")
+            os.remove(part_path)
+            continue
+        
+        os.replace(part_path, target_path)
+        return True
+    
+    return False
+
+def start_parallel_fetching(token, tor_get, open_circuit, circuits, on_file=None):
+    # Every circuit has its own session, a worker borrows one circuit per file
+    params = initial_fetch_params()
+    headers = {
+        "Authorization": f"Bearer {token}"
+    }
+    
+    isolation = secrets.token_hex(8)
+    idle_circuits = queue.Queue()
+    for index in range(circuits):
+        idle_circuits.put(open_circuit(f"{isolation}-{index}"))
+    
+    def fetch(entry):
+        circuit_get = idle_circuits.get()
+        try:
+            ok = download_entry(entry, headers, circuit_get)
+        finally:
+            idle_circuits.put(circuit_get)
+        if ok and on_file:
+            on_file(entry)
+        return ok
+    
+    total = 0
+    with ThreadPoolExecutor(max_workers=circuits) as executor:
+        while True:
+            response = tor_get("/download/new-files/manifest", headers=headers, params=params)
+            if response.status_code != 200:
+                print(f"Error fetching files: {response.status_code} - {response.text}")
+                break
             
-            # Extract all files
-            zip_ref.extractall(DOWNLOAD_FOLDER)
+            listing = response.json()
+            entries = listing["files"]
+            if not entries:
+                if not listing["more_available"] and not total:
+                    print("No new files found")
+                if listing["next_cursor"]:
+                    save_last_cursor(listing["next_cursor"])
+                if not listing["more_available"]:
+                    break
+                params = {"limit": FETCH_BATCH_SIZE, "cursor": listing["next_cursor"]}
+                continue
             
-            print(f"All files have been downloaded to {DOWNLOAD_FOLDER}")
-        
-        # Update the date to today
-        current_date = format_datetime(datetime.now())
-        save_last_fetch_date(current_date)
-        print(f"Updated last fetch date to {current_date}")
+            print(f"Found {len(entries)} new file(s), downloading over {circuits} circuit(s)")
+            results = list(executor.map(fetch, entries))
+            failed = [entry["name"] for entry, ok in zip(entries, results) if not ok]
+            if failed:
+                # The cursor stays put, finished files are skipped on the next fetch
+                print(f"Could not download {len(failed)} file(s), they will be fetched again next time")
+                break
+            total += len(entries)
+            
+            # The manifest goes last, decryption only sees files that are complete
+            manifest_path = os.path.join(DOWNLOAD_FOLDER, f"{bundle_tag(listing['next_cursor'])}{MANIFEST_SUFFIX}")
+            with open(manifest_path, 'w') as manifest_file:
+                json.dump({"version": listing["version"], "files": entries}, manifest_file)
+            
+            save_last_cursor(listing["next_cursor"])
+            params = {"limit": FETCH_BATCH_SIZE, "cursor": listing["next_cursor"]}
+            if not listing["more_available"]:
+                break
+    
+    if total:
+        print(f"All {total} file(s) have been downloaded to {DOWNLOAD_FOLDER}")
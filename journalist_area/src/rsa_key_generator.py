@@ -1,9 +1,12 @@
 #Lib. cryptography
+import os
+import time
 import uuid
 import argparse
 import sqlite3
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 def generate_rsa_keys(key_size: int):
     # Generate private key
@@ -26,23 +29,29 @@ def generate_rsa_keys(key_size: int):
         format=serialization.PublicFormat.SubjectPublicKeyInfo
     )
 
-    print("RSA key pair successfully generated.")
     #print("Private Key: ", pem_private)
     #print("Public Key: ", pem_public)
     return pem_private, pem_public
 
 
-def generate_multiple_keys(count: int, key_size: int):
+def iter_generated_keys(count: int, key_size: int, workers: int = None):
+    # Generate key pairs on all cores and yield them as they are finished
     if count < 1:
         raise ValueError("Number of keys must be greater than 0.")
-    keys = []
-    while count > 0:
-        tmp = generate_rsa_keys(key_size)
-        keys.append(tmp)
-        count -= 1
-    return keys
-
-def write_keys_to_database(keys: list):
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, count)) as executor:
+        futures = [executor.submit(generate_rsa_keys, key_size) for _ in range(count)]
+        for done, future in enumerate(as_completed(futures), start=1):
+            yield future.result()
+            print(f"\rGenerated {done}/{count} RSA key pair(s)", end="", flush=True)
+
+    elapsed = time.perf_counter() - started
+    print(f"\n{count} RSA key pair(s) generated in {elapsed:.1f}s ({count / elapsed:.1f} keys/s)")
+
+
+def write_keys_to_database(keys):
+    # Accepts any iterable of key pairs, a generator is written while it is being produced
     # Connection to SQLite database (file is created if it doesn't exist)
     conn = sqlite3.connect("./meine_datenbank.db")
     cursor = conn.cursor()
@@ -57,11 +66,11 @@ def write_keys_to_database(keys: list):
         )
     """)
 
-    for key_pair in keys:
-        cursor.execute("""
-                   INSERT INTO schluesselpaare (id, private_key, public_key, uploaded)
-                   VALUES (?, ?, ?, ?)
-                   """, (str(uuid.uuid4()), key_pair[0], key_pair[1], False))
+    # All rows go in with one statement and one transaction
+    cursor.executemany("""
+               INSERT INTO schluesselpaare (id, private_key, public_key, uploaded)
+               VALUES (?, ?, ?, ?)
+               """, ((str(uuid.uuid4()), key_pair[0], key_pair[1], False) for key_pair in keys))
 
     conn.commit()
     conn.close()
@@ -87,6 +96,4 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     #print("Number: ", args.number, " | Size of Key: ", args.size)
-    key = generate_multiple_keys(count=args.number, key_size=args.size)
-    
-    write_keys_to_database(keys = key)
+    write_keys_to_database(keys=iter_generated_keys(count=args.number, key_size=args.size))
@@ -7,6 +7,7 @@ load_dotenv()  # Load .env file
 
 
 DATABASE_URL_ADMIN = os.getenv("DATABASE_REMOTE_URL_ADMIN")
+UPLOAD_BATCH_SIZE = int(os.getenv("KEY_UPLOAD_BATCH_SIZE", "100"))  # Keys per request
 #print("Database path:", datenbankpfad)
 
 
@@ -26,39 +27,42 @@ def get_public_keys():
     conn.close()
     return public_keys,ids
 
-def update_local_database():
+def mark_keys_uploaded(ids):
+    # Only keys the server confirmed are marked, the rest is sent again next time
     conn = sqlite3.connect("./meine_datenbank.db")
     cursor = conn.cursor()
 
-    cursor.execute("UPDATE schluesselpaare SET uploaded = True WHERE uploaded == False")
+    cursor.executemany("UPDATE schluesselpaare SET uploaded = True WHERE id = ?", [(key_id,) for key_id in ids])
     conn.commit()
     conn.close()
 
-def create_temp_key_file(key, index, directory="temp_keys"):
-    os.makedirs(directory, exist_ok=True)
-    filename = os.path.join(directory, f"public_key_{index}.pem")
-    with open(filename, "wb") as f:
-        f.write(key)
-    return filename
-
-def upload_key_file(filepath, token, tor_post, key_id=None, ):
-    # URL of the server endpoint
-
-    # Data to be sent in the LOGIN_POST request
+def upload_keys(keys, ids, token, tor_post, batch_size=UPLOAD_BATCH_SIZE):
+    # Send the keys straight from memory, many per request
     headers = {
         "Authorization": f"Bearer {token}"
     }
 
-    # Open file and send
-    with open(filepath, "rb") as f:
-        files = {"file": (os.path.basename(filepath), f, "application/x-pem-file")}
-        response = tor_post("/publickey/" + str(key_id), files=files, headers=headers)
-        print("Response:", response.text)
+    uploaded = []
+    for start in range(0, len(keys), batch_size):
+        batch = [
+            {"id": str(key_id), "pem": key.decode("utf-8")}
+            for key, key_id in zip(keys[start:start + batch_size], ids[start:start + batch_size])
+        ]
+        response = tor_post("/publickey/batch", json={"keys": batch}, headers=headers)
+        if response.status_code != 200:
+            print(f"Error uploading keys: {response.status_code} - {response.text}")
+            continue
+
+        for result in response.json()["results"]:
+            # Keys that already exist were stored by an earlier attempt
+            if result["status"] in ("created", "exists"):
+                uploaded.append(result["id"])
+            else:
+                print(f"Key {result['id']} was rejected: {result.get('detail')}")
+
+    return uploaded
 
 if __name__ == '__main__':
     keys, ids = get_public_keys()
 
-    print(f"{len(keys)} keys found.")
-    for index, key in enumerate(keys):
-        filename = create_temp_key_file(key, index)
-        upload_key_file(filename, ids[index])
+    print(f"{len(keys)} keys found. Upload them with: python whistle_interface.py upload")
@@ -0,0 +1,31 @@
+import os
+import tempfile
+
+import pytest
+
+# fetch_all creates its download folder on import, keep it out of the working tree
+os.environ.setdefault("DOWNLOAD_FOLDER", tempfile.mkdtemp(prefix="whistledrop-downloads-"))
+
+from src import decrypt_files, fetch_all
+from src.rsa_key_generator import write_keys_to_database
+
+
+@pytest.fixture
+def downloads(monkeypatch, tmp_path):
+    # Downloads, part files and the fetch cursor of a test live in tmp_path
+    folder = tmp_path / "downloads"
+    folder.mkdir()
+    monkeypatch.setattr(fetch_all, "DOWNLOAD_FOLDER", str(folder))
+    monkeypatch.setattr(fetch_all, "CONFIG_FILE", str(tmp_path / "config.ini"))
+    monkeypatch.setattr(fetch_all, "MAX_RETRIES", 2)
+    return folder
+
+
+@pytest.fixture
+def key_db(monkeypatch, tmp_path):
+    # The key scripts open ./meine_datenbank.db, so the test runs inside tmp_path
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / "meine_datenbank.db"
+    monkeypatch.setattr(decrypt_files, "DATABASE_PATH", str(path))
+    write_keys_to_database([])
+    return path
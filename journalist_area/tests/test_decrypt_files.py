@@ -0,0 +1,161 @@
+import os
+import sqlite3
+import threading
+import uuid
+from base64 import b64encode
+from concurrent.futures import Future
+
+import pytest
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from src import decrypt_files
+from src.decrypt_files import DecryptPipeline
+
+PRIVATE_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+class InlineExecutor:
+    """Runs jobs in the calling thread, submitting a file listed in fail_submit raises."""
+
+    fail_submit = set()
+
+    def __init__(self, max_workers):
+        pass
+
+    def submit(self, fn, entry, *args):
+        if entry["name"] in self.fail_submit:
+            raise RuntimeError("process pool is broken")
+        future = Future()
+        try:
+            future.set_result(fn(entry, *args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+@pytest.fixture
+def pipeline_dirs(monkeypatch, tmp_path, key_db):
+    monkeypatch.setattr(decrypt_files, "ProcessPoolExecutor", InlineExecutor)
+    monkeypatch.setattr(InlineExecutor, "fail_submit", set())
+    return tmp_path / "downloads", tmp_path / "decrypted"
+
+
+def _store_key(key_db):
+    key_id = str(uuid.uuid4())
+    pem = PRIVATE_KEY.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                    serialization.NoEncryption())
+    with sqlite3.connect(key_db) as conn:
+        conn.execute("INSERT INTO schluesselpaare (id, public_key, private_key) VALUES (?, '', ?)", (key_id, pem))
+    return key_id
+
+
+def _encrypted_entry(input_dir, name, plaintext, public_key_id):
+    # A file in the single message format, the way older uploads are stored
+    aes_key = AESGCM.generate_key(bit_length=256)
+    nonce = os.urandom(12)
+    input_dir.mkdir(exist_ok=True)
+    (input_dir / name).write_bytes(AESGCM(aes_key).encrypt(nonce, plaintext, None))
+    encrypted_key = PRIVATE_KEY.public_key().encrypt(aes_key, padding.OAEP(
+        mgf=padding.MGF1(algorithm=hashes.SHA256()),
+        algorithm=hashes.SHA256(),
+        label=None
+    ))
+    return {"name": name, "public_key_id": public_key_id, "encrypted_key": b64encode(encrypted_key).decode(),
+            "nonce": b64encode(nonce).decode()}
+
+
+def _close(pipeline):
+    # A dispatcher that died would leave close() waiting forever
+    results = []
+    closer = threading.Thread(target=lambda: results.extend(pipeline.close()), daemon=True)
+    closer.start()
+    closer.join(timeout=10)
+    assert not closer.is_alive(), "the pipeline did not finish"
+    return results
+
+
+def test_load_private_keys_from_db_batches_lookups(monkeypatch, key_db):
+    key_ids = [_store_key(key_db) for _ in range(7)]
+    monkeypatch.setattr(decrypt_files, "QUERY_BATCH_SIZE", 3)
+    statements = []
+    sqlite_connect = sqlite3.connect
+
+    def connect(path):
+        conn = sqlite_connect(path)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(decrypt_files.sqlite3, "connect", connect)
+
+    private_keys = decrypt_files.load_private_keys_from_db(key_ids + key_ids[:2] + ["unknown"])
+
+    assert set(private_keys) == set(key_ids)
+    # Eight distinct IDs in batches of three
+    assert len([statement for statement in statements if "SELECT" in statement]) == 3
+
+
+def test_pipeline_decrypts_submitted_files(pipeline_dirs, key_db):
+    input_dir, output_dir = pipeline_dirs
+    key_id = _store_key(key_db)
+    entries = [_encrypted_entry(input_dir, f"id{i}_report{i}", f"document {i}".encode(), key_id) for i in range(3)]
+
+    pipeline = DecryptPipeline(str(input_dir), str(output_dir), jobs=2)
+    for entry in entries:
+        pipeline.submit(entry)
+    results = _close(pipeline)
+
+    assert [result.error for result in results] == [None] * 3
+    for i in range(3):
+        assert (output_dir / f"report{i}.pdf").read_bytes() == f"document {i}".encode()
+
+
+def test_pipeline_fails_files_of_a_batch_whose_key_lookup_failed(monkeypatch, pipeline_dirs, capsys):
+    input_dir, output_dir = pipeline_dirs
+
+    def broken_lookup(public_key_ids):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(decrypt_files, "load_private_keys_from_db", broken_lookup)
+
+    # More files than the queue holds, submit must not block on a dead dispatcher
+    pipeline = DecryptPipeline(str(input_dir), str(output_dir), queue_size=1)
+    for i in range(5):
+        pipeline.submit({"name": f"id{i}_report", "public_key_id": "key"})
+    results = _close(pipeline)
+
+    assert [result.name for result in results] == [f"id{i}_report" for i in range(5)]
+    assert {result.error for result in results} == {"Loading the private key failed: database is locked"}
+    assert "[5/5]" in capsys.readouterr().out
+
+
+def test_pipeline_keeps_going_after_a_failed_submit(pipeline_dirs, key_db):
+    input_dir, output_dir = pipeline_dirs
+    key_id = _store_key(key_db)
+    entries = [_encrypted_entry(input_dir, f"id{i}_report{i}", b"document", key_id) for i in range(3)]
+    InlineExecutor.fail_submit.add(entries[1]["name"])
+
+    pipeline = DecryptPipeline(str(input_dir), str(output_dir))
+    for entry in entries:
+        pipeline.submit(entry)
+    results = _close(pipeline)
+
+    assert [result.error for result in results] == [None, "process pool is broken", None]
+    assert sorted(os.listdir(output_dir)) == ["report0.pdf", "report2.pdf"]
+
+
+def test_pipeline_reports_missing_keys_per_file(pipeline_dirs, key_db):
+    input_dir, output_dir = pipeline_dirs
+    entry = _encrypted_entry(input_dir, "id1_report", b"document", "unknown")
+
+    pipeline = DecryptPipeline(str(input_dir), str(output_dir))
+    pipeline.submit(entry)
+    pipeline.submit({**entry, "name": "id2_missing"})
+    results = _close(pipeline)
+
+    assert [result.error for result in results] == ["No private key found for ID unknown!", "Encrypted file not found"]
+    assert os.listdir(output_dir) == []
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import threading
+
+import requests
+
+from src import fetch_all
+
+BUNDLE = os.urandom(5000)
+
+
+class FakeResponse:
+    """Streams a body in small chunks and can drop the connection part way through."""
+
+    def __init__(self, status_code, body=b"", headers=None, fail_after=None, payload=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.fail_after = fail_after
+        self.payload = payload
+        self.text = ""
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        end = len(self.body) if self.fail_after is None else self.fail_after
+        for start in range(0, end, 1000):
+            yield self.body[start:min(start + 1000, end)]
+        if self.fail_after is not None:
+            raise requests.exceptions.ConnectionError("connection reset")
+
+    def json(self):
+        return self.payload
+
+    def close(self):
+        self.closed = True
+
+
+def _bundle_response(body, etag='"v1"', **kwargs):
+    headers = {"X-Bundle-Id": "bundle-1", "Content-Length": str(len(body)), "ETag": etag}
+    return FakeResponse(200, body, headers, **kwargs)
+
+
+def _part_path(folder):
+    return folder / f".bundle-{fetch_all.bundle_tag('bundle-1')}.part"
+
+
+def test_download_bundle_resumes_after_truncated_download(downloads):
+    requests_made = []
+
+    def tor_get(url, headers, stream):
+        requests_made.append((url, headers))
+        return FakeResponse(206, BUNDLE[2000:])
+
+    path = fetch_all.download_bundle(_bundle_response(BUNDLE, fail_after=2000), {"Authorization": "Bearer t"}, tor_get)
+
+    assert open(path, "rb").read() == BUNDLE
+    assert requests_made == [("/download/bundles/bundle-1",
+                              {"Authorization": "Bearer t", "Range": "bytes=2000-", "If-Range": '"v1"'})]
+    # The ETag sidecar only lives as long as the part file is incomplete
+    assert not os.path.exists(f"{path}.etag")
+
+
+def test_download_bundle_continues_part_file_of_previous_run(downloads):
+    _part_path(downloads).write_bytes(BUNDLE[:3000])
+    fetch_all.write_part_etag(f"{_part_path(downloads)}.etag", '"v1"')
+    first = _bundle_response(BUNDLE)
+
+    path = fetch_all.download_bundle(first, {}, lambda url, headers, stream: FakeResponse(206, BUNDLE[3000:]))
+
+    assert first.closed
+    assert open(path, "rb").read() == BUNDLE
+
+
+def test_download_bundle_starts_over_when_etag_changed(downloads):
+    _part_path(downloads).write_bytes(b"x" * 3000)
+    fetch_all.write_part_etag(f"{_part_path(downloads)}.etag", '"v1"')
+    changed = os.urandom(4000)
+
+    # If-Range does not match the new archive, so the server sends all of it
+    path = fetch_all.download_bundle(_bundle_response(BUNDLE), {},
+                                     lambda url, headers, stream: _bundle_response(changed, etag='"v2"'))
+
+    assert open(path, "rb").read() == changed
+
+
+def test_download_bundle_discards_part_file_without_etag(downloads):
+    _part_path(downloads).write_bytes(b"x" * 3000)
+
+    def tor_get(url, headers, stream):
+        raise AssertionError("the fresh response must be used")
+
+    path = fetch_all.download_bundle(_bundle_response(BUNDLE), {}, tor_get)
+
+    assert open(path, "rb").read() == BUNDLE
+
+
+def test_download_bundle_gives_up_after_retries(downloads):
+    path = fetch_all.download_bundle(_bundle_response(BUNDLE, fail_after=1000), {},
+                                     lambda url, headers, stream: FakeResponse(206, BUNDLE[1000:], fail_after=0))
+
+    assert path is None
+    # The part file and its ETag are kept for the next fetch
+    assert _part_path(downloads).stat().st_size == 1000
+    assert fetch_all.read_part_etag(f"{_part_path(downloads)}.etag") == '"v1"'
+
+
+def _entry(name, content):
+    return {"id": name, "name": name, "size": len(content), "sha256": hashlib.sha256(content).hexdigest()}
+
+
+def test_download_entry_resumes_part_file(downloads):
+    entry = _entry("id1_report", BUNDLE)
+    (downloads / ".id1_report.part").write_bytes(BUNDLE[:1500])
+    requests_made = []
+
+    def circuit_get(url, headers, stream):
+        requests_made.append((url, headers))
+        return FakeResponse(206, BUNDLE[1500:])
+
+    assert fetch_all.download_entry(entry, {}, circuit_get)
+    assert requests_made == [("/download/id1_report", {"Range": "bytes=1500-"})]
+    assert (downloads / "id1_report").read_bytes() == BUNDLE
+    assert not (downloads / ".id1_report.part").exists()
+
+
+def test_download_entry_downloads_again_on_digest_mismatch(downloads):
+    entry = _entry("id1_report", BUNDLE)
+    (downloads / ".id1_report.part").write_bytes(b"x" * len(BUNDLE))
+
+    assert fetch_all.download_entry(entry, {}, lambda url, headers, stream: FakeResponse(200, BUNDLE))
+    assert (downloads / "id1_report").read_bytes() == BUNDLE
+
+
+def test_download_entry_keeps_names_inside_the_download_folder(downloads):
+    content = b"ciphertext"
+    entry = {**_entry("../../id1_escape", content), "id": "id1"}
+
+    assert fetch_all.download_entry(entry, {}, lambda url, headers, stream: FakeResponse(200, content))
+    assert os.listdir(downloads) == ["id1_escape"]
+
+
+def test_parallel_fetching_spreads_files_over_circuits(downloads):
+    files = {f"id{i}_file{i}": os.urandom(3000) for i in range(6)}
+    entries = [_entry(name, content) for name, content in files.items()]
+    listing = {"version": 1, "files": entries, "next_cursor": "cursor-1", "more_available": False}
+    opened = []
+    circuits = {}
+    in_flight = []
+    lock = threading.Lock()
+
+    def open_circuit(isolation):
+        opened.append(isolation)
+
+        def circuit_get(url, headers, stream):
+            with lock:
+                # A circuit is never lent to two downloads at once
+                assert isolation not in in_flight
+                in_flight.append(isolation)
+                circuits[isolation] = circuits.get(isolation, 0) + 1
+            try:
+                return FakeResponse(200, files[url.rsplit("/", 1)[1]])
+            finally:
+                with lock:
+                    in_flight.remove(isolation)
+        return circuit_get
+
+    def tor_get(url, headers, params):
+        assert url == "/download/new-files/manifest"
+        return FakeResponse(200, payload=listing)
+
+    received = []
+    fetch_all.start_parallel_fetching("token", tor_get, open_circuit, circuits=3, on_file=received.append)
+
+    # Every circuit gets its own isolation ID and is reused for later files
+    assert len(set(opened)) == 3
+    assert set(circuits) <= set(opened)
+    assert sum(circuits.values()) == len(files)
+    assert sorted(entry["name"] for entry in received) == sorted(files)
+    for name, content in files.items():
+        assert (downloads / name).read_bytes() == content
+    manifest_path = downloads / f"{fetch_all.bundle_tag('cursor-1')}{fetch_all.MANIFEST_SUFFIX}"
+    assert json.loads(manifest_path.read_text())["files"] == entries
+    assert fetch_all.get_last_cursor() == "cursor-1"
@@ -0,0 +1,74 @@
+import sqlite3
+
+from cryptography.hazmat.primitives import serialization
+
+from src import rsa_key_generator
+from src.rsa_key_generator import iter_generated_keys, write_keys_to_database
+from src.rsa_key_uploader import get_public_keys, mark_keys_uploaded, upload_keys
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload=None):
+        self.status_code = status_code
+        self.payload = payload
+        self.text = ""
+
+    def json(self):
+        return self.payload
+
+
+def _rows(key_db):
+    with sqlite3.connect(key_db) as conn:
+        return conn.execute("SELECT id, public_key, private_key, uploaded FROM schluesselpaare").fetchall()
+
+
+def test_generated_keys_are_written_in_one_statement(monkeypatch, key_db):
+    statements = []
+    sqlite_connect = sqlite3.connect
+
+    def connect(path):
+        conn = sqlite_connect(path)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(rsa_key_generator.sqlite3, "connect", connect)
+
+    write_keys_to_database(iter_generated_keys(count=3, key_size=1024, workers=2))
+
+    rows = _rows(key_db)
+    assert len({row[0] for row in rows}) == 3
+    for _, public_pem, private_pem, uploaded in rows:
+        private_key = serialization.load_pem_private_key(private_pem, password=None)
+        assert private_key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        ) == public_pem
+        assert not uploaded
+    # executemany runs its INSERT once per row, all of them before the single COMMIT
+    inserts = [i for i, statement in enumerate(statements) if "INSERT" in statement]
+    commits = [i for i, statement in enumerate(statements) if statement == "COMMIT"]
+    assert len(inserts) == 3 and len(commits) == 1 and commits[0] > inserts[-1]
+
+
+def test_upload_keys_sends_batches_and_returns_confirmed_ids(key_db):
+    write_keys_to_database((f"private {i}", f"public {i}") for i in range(5))
+    keys, ids = get_public_keys()
+    requests_made = []
+
+    def tor_post(url, json, headers):
+        requests_made.append((url, [key["id"] for key in json["keys"]]))
+        if len(requests_made) == 2:
+            return FakeResponse(503)
+        statuses = ["created", "exists", "invalid"]
+        return FakeResponse(200, {"results": [
+            {"id": key["id"], "status": statuses[i % 3], "detail": None} for i, key in enumerate(json["keys"])
+        ]})
+
+    uploaded = upload_keys(keys, ids, "token", tor_post, batch_size=2)
+
+    assert requests_made == [("/publickey/batch", ids[0:2]), ("/publickey/batch", ids[2:4]),
+                             ("/publickey/batch", ids[4:5])]
+    # The failed request and the rejected key stay pending for the next upload
+    assert uploaded == [ids[0], ids[1], ids[4]]
+
+    mark_keys_uploaded(uploaded)
+    assert get_public_keys()[1] == [ids[2], ids[3]]
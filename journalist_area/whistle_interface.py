@@ -1,11 +1,11 @@
 import argparse
 
 from src.config import add_onion_to_config
-from src.rsa_key_generator import generate_multiple_keys, write_keys_to_database
-from src.rsa_key_uploader import get_public_keys, create_temp_key_file, upload_key_file, update_local_database
+from src.rsa_key_generator import iter_generated_keys, write_keys_to_database
+from src.rsa_key_uploader import get_public_keys, upload_keys, mark_keys_uploaded
 from src.clear_my_database import clear_everything
-from src.fetch_all import start_fetching
-from src.decrypt_files import decrypt_all
+from src.fetch_all import start_fetching, start_parallel_fetching
+from src.decrypt_files import decrypt_pipeline
 import dotenv
 import os
 import requests
@@ -13,7 +13,19 @@ import configparser
 
 dotenv.load_dotenv()
 
-session = requests.Session()
+TOR_PROXY = "127.0.0.1:9150"
+
+def create_tor_session(isolation_id=None):
+    # Tor puts streams with different SOCKS credentials on different circuits
+    tor_session = requests.Session()
+    credentials = f"{isolation_id}:{isolation_id}@" if isolation_id else ""
+    tor_session.proxies = {
+        'http': f'socks5h://{credentials}{TOR_PROXY}',
+        'https': f'socks5h://{credentials}{TOR_PROXY}'
+    }
+    return tor_session
+
+session = create_tor_session()
 
 # Create config parser
 config = configparser.ConfigParser()
@@ -22,12 +34,6 @@ config = configparser.ConfigParser()
 if os.path.exists('./config.ini'):
     config.read('./config.ini')
 
-# Set default proxy (e.g., for Tor)
-session.proxies = {
-    'http': 'socks5h://127.0.0.1:9150',
-    'https': 'socks5h://127.0.0.1:9150'
-}
-
 BASE_URL: str = f"http://{config['Tor']['Onion'] if os.path.exists('./config.ini') and 'Tor' in config and 'Onion' in config['Tor'] else 'localhost'}/api/v1"
 
 # Optional: Set a default timeout (via a wrapper function)
@@ -43,24 +49,37 @@ def tor_post(url, **kwargs):
 def upload(count: int, token: str):
 
     DEFAULT_SIZE = 2048
-    key_list = generate_multiple_keys(count=count, key_size=DEFAULT_SIZE)
-
-    write_keys_to_database(keys=key_list)
+    # Keys are stored while the remaining ones are still being generated
+    write_keys_to_database(keys=iter_generated_keys(count=count, key_size=DEFAULT_SIZE))
     print(count, "RSA Key(s) created ")
 
     keys, ids = get_public_keys()
 
     print(f"{len(keys)} Found key.")
-    for index, key in enumerate(keys):
-        filename = create_temp_key_file(key, index)
-        upload_key_file(filename, token, tor_post, ids[index])
-
-    print("..and uploaded to server")
-
-    update_local_database()
-
-def download(token: str):
-    start_fetching(token, tor_get=tor_get)
+    uploaded = upload_keys(keys, ids, token, tor_post)
+    mark_keys_uploaded(uploaded)
+
+    print(f"..and {len(uploaded)} uploaded to server")
+
+# GET function bound to a session on its own Tor circuit
+def open_circuit(isolation_id):
+    circuit = create_tor_session(isolation_id)
+
+    def circuit_get(url, **kwargs):
+        return circuit.get(BASE_URL + url, timeout=30, **kwargs)
+    return circuit_get
+
+def download(token: str, circuits: int = 1, jobs: int = 1):
+    # Files are decrypted while the remaining ones are still downloading
+    pipeline = decrypt_pipeline(jobs=jobs)
+    try:
+        if circuits > 1:
+            start_parallel_fetching(token, tor_get=tor_get, open_circuit=open_circuit, circuits=circuits,
+                                    on_file=pipeline.submit)
+        else:
+            start_fetching(token, tor_get=tor_get, on_file=pipeline.submit)
+    finally:
+        pipeline.close()
 
 def cleanup():
     clear_everything()
@@ -96,6 +115,8 @@ def main():
     # Download
     download_parser = subparsers.add_parser("download", help="Downloads all files from the server")
     download_parser.add_argument("-d", help="Run in debug mode", action="store_true")
+    download_parser.add_argument("--circuits", type=int, default=1, help="Download files one by one over this many parallel Tor circuits (default: 1, one bundle at a time)")
+    download_parser.add_argument("--jobs", type=int, default=1, help="Number of files decrypted in parallel (default: 1)")
 
     config_parser = subparsers.add_parser("config", help="Configure your whistledrop interface")
     config_parser.add_argument("--onion", help="add your onion adress", type=str)
@@ -112,8 +133,7 @@ def main():
         upload(args.count, token)
     elif args.command == "download":
         token = authenticate_user()
-        download(token)
-        decrypt_all()
+        download(token, circuits=max(1, args.circuits), jobs=max(1, args.jobs))
     elif args.command == "cleanup":
         cleanup()
     elif args.command == "config":